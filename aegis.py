@@ -2,6 +2,7 @@ import numpy as np
 import pdb
 import scipy as sp
 import scipy.interpolate
+import scipy.sparse
 import scipy.integrate as integrate
 import astropy.units as units
 import astropy.cosmology as cosmo
@@ -9,15 +10,35 @@ import healpy as hp
 import torch
 from astropy.io import fits
 import copy
+import functools
+import hashlib
+import time
+import tracemalloc
+import aegis_kernels
 
 '''
 Astrophysical Event Generator for Integration with Simulation-based inference
 The class is used to generate simulations of photon maps.
 '''
 
+def instrumented_stage(stage_name):
+    '''
+    Decorator for the stages of the simulation. When the aegis instance was created with instrument = True,
+    the wall time, number of sources/photons in and out, and bytes allocated by the stage are appended
+    to the current simulation record (see aegis.get_simulation_record)
+    '''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            if not getattr(self, 'instrument', False):
+                return func(self, *args, **kwargs)
+            return self.run_instrumented_stage(stage_name, func, args, kwargs)
+        return wrapper
+    return decorator
+
 class aegis():
 
-    def __init__(self, abundance_luminosity_and_spectrum_list, source_class_list, parameter_range, energy_range, luminosity_range, max_radius, exposure, angular_cut = np.pi, lat_cut = 0, flux_cut = np.inf, energy_range_gen = [], angular_cut_gen = 0, lat_cut_gen = 0, cosmology = None, z_range = [], verbose = False):
+    def __init__(self, abundance_luminosity_and_spectrum_list, source_class_list, parameter_range, energy_range, luminosity_range, max_radius, exposure, angular_cut = np.pi, lat_cut = 0, flux_cut = np.inf, energy_range_gen = [], angular_cut_gen = 0, lat_cut_gen = 0, cosmology = None, z_range = [], verbose = False, instrument = False, instrument_callback = None, instrument_final_stage = 'mock_observe', map_sampler = 'auto', backend = 'numpy'):
         #super().__init__(parameter_range)
         
         self.GC_to_earth = 8.5 #kpc
@@ -86,6 +107,52 @@ class aegis():
         #Number of types of sources contributing photons
         self.N_source_classes = len(abundance_luminosity_and_spectrum_list)
 
+        #per-stage timers, counters and memory. instrument_callback(record) is called with every finished simulation record.
+        #A record is finished when the outermost call of instrument_final_stage returns (e.g. 'get_roi_map_summary' or
+        #'get_counts_histogram_from_roi_map' to include the summaries) or when the next simulation starts; stages called
+        #later on their own are recorded and emitted separately
+        self.instrument = instrument
+        self.instrument_callback = instrument_callback
+        self.instrument_final_stage = instrument_final_stage
+        self.simulation_record = None
+        self.stage_stack = []
+
+        #sampling tables of healpix_map sources (keyed by the map function's map_key, or by get_map_key) and latitude cut masks
+        #map_sampler is 'flat' (one energy x pixel table), 'hierarchical' (NEST pyramid over pixels, then energies per pixel)
+        #or 'auto', which uses the hierarchical sampler for maps with more than map_sampler_threshold energy x pixel cells
+        if map_sampler not in ('auto', 'flat', 'hierarchical'):
+            raise Exception("map_sampler must be 'auto', 'flat' or 'hierarchical'")
+        self.map_sampler = map_sampler
+        self.map_sampler_threshold = 2**24
+        self.map_samplers = {}
+        self.map_keys = {}
+        self.lat_cut_masks = {}
+
+        #solid angle and latitude sampling tables of the generation region, per (angular_cut_gen, lat_cut_gen)
+        self.allowed_region_samplers = {}
+
+        #instrument response parameters read from the FITS files (per file and event type), and the PSF pixel kernels, PSF beam
+        #window functions and energy dispersion response matrices used by expected_map and mock_observe_binned
+        self.irf_params = {}
+        self.psf_kernels = {}
+        self.psf_beam_windows = {}
+        self.edisp_matrices = {}
+        self.edisp_responses = {}
+        self.region_coverages = {}
+
+        #array backend of the random draws, observation steps and summaries. 'torch' draws every random number of the source,
+        #photon and observation stages from torch's generator, runs the per-photon steps as torch tensor ops on torch's
+        #intra-op thread pool and returns summaries as tensors by default. Use seed() to seed the numpy and torch generators
+        #together, since the parameter draws, numpy-backend code and user callables (e.g. multi-spectra functions) use numpy.
+        #Both backends draw from the same distributions; photon_info arrays stay numpy (zero-copy views of the torch results)
+        #'numba' keeps the numpy random stream but runs the per-photon steps through the fused kernels of aegis_kernels,
+        #which are compiled and parallelized when numba is installed and fall back to their NumPy versions otherwise
+        if backend not in ('numpy', 'torch', 'numba'):
+            raise Exception("backend must be 'numpy', 'torch' or 'numba'")
+        if backend == 'numba' and not aegis_kernels.HAVE_NUMBA:
+            print('!!!!WARNING!!!!\n numba is not installed\n numba backend runs the NumPy versions of its kernels\n!!!!WARNING!!!!')
+        self.backend = backend
+
         self.verbose = verbose
         if (self.verbose):
             # print("Analysis Type: " + self.analysis_type)
@@ -107,6 +174,121 @@ class aegis():
             print("lat_cut_gen = ", self.lat_cut_gen)
             print("lat_cut_mask = ", self.lat_cut_mask)
             print("N_source_classes = ", self.N_source_classes)
+            print("backend = ", self.backend)
+
+    ##########################################################################
+    '''
+    Instrumentation
+
+    '''
+    ##########################################################################
+
+    def start_simulation_record(self, input_params = None):
+        # Starts a new per-simulation record, finishing (and emitting) any record still open
+        if self.simulation_record is not None:
+            self.finish_simulation_record()
+        if isinstance(input_params, torch.Tensor):
+            input_params = input_params.numpy()
+        self.simulation_record = {'input_params': None if input_params is None else np.array(input_params, dtype = float).tolist(),
+                                  'start_time': time.time(),
+                                  'stages': []}
+        return self.simulation_record
+
+    def finish_simulation_record(self):
+        # Closes the current record, passes it to instrument_callback and returns it
+        record = self.simulation_record
+        if record is None:
+            return None
+        record['total_time_s'] = time.time() - record['start_time']
+        self.simulation_record = None
+        if self.instrument_callback is not None:
+            self.instrument_callback(record)
+        self.last_simulation_record = record
+        return record
+
+    def get_simulation_record(self):
+        # Returns the record currently being filled, or the last finished record
+        if self.simulation_record is not None:
+            return self.simulation_record
+        return getattr(self, 'last_simulation_record', None)
+
+    def count_sources_or_photons(self, obj):
+        # Number of sources or photons held by the input or output of a stage
+        if isinstance(obj, dict):
+            if 'energies' in obj:
+                return int(np.size(obj['energies']))
+            if 'luminosities' in obj:
+                return int(np.size(obj['luminosities']) + np.size(obj['single_p_distances']))
+        if isinstance(obj, (np.ndarray, torch.Tensor)):
+            return int(np.prod(obj.shape))
+        if isinstance(obj, (tuple, list)) and len(obj) > 0 and all(isinstance(o, (dict, np.ndarray)) for o in obj):
+            counts = [self.count_sources_or_photons(o) for o in obj]
+            return None if None in counts else int(sum(counts))
+        return None
+
+    def run_instrumented_stage(self, stage_name, func, args, kwargs):
+        # A new record is started every time a simulation begins with create_sources. A stage called on its own outside
+        # of a simulation (no open record) gets its own record, finished when it returns
+        params_first = stage_name in ('create_sources', 'generate_photons_from_sources', 'generate_photons_from_sources_batch', 'draw_luminosities_and_radii', 'draw_luminosities_and_comoving_distances')
+        standalone = self.simulation_record is None and stage_name != 'create_sources'
+        if self.simulation_record is None or (stage_name == 'create_sources' and len(self.stage_stack) == 0):
+            self.start_simulation_record((args[0] if args else kwargs.get('input_params')) if params_first else None)
+        # Allocations are only traced while an instrumented stage runs; tracing started here is stopped by the outermost stage
+        started_tracing = not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+
+        # tracemalloc has a single peak counter, so the peaks of enclosing stages are carried on a stack
+        current_before, peak_so_far = tracemalloc.get_traced_memory()
+        if self.stage_stack:
+            self.stage_stack[-1]['peak'] = max(self.stage_stack[-1]['peak'], peak_so_far)
+        tracemalloc.reset_peak()
+        frame = {'peak': current_before}
+        self.stage_stack.append(frame)
+        depth = len(self.stage_stack) - 1
+
+        # Sources/photons come in as dictionaries, summaries of maps take arrays. Parameter vectors are not counted: stages
+        # drawing sources from the parameters start from the sources already drawn in the simulation
+        n_in = None
+        for arg in (args[1:] if params_first else args):
+            n_in = self.count_sources_or_photons(arg)
+            if n_in is not None:
+                break
+        if n_in is None and params_first:
+            n_in = int(sum(stage['n_out'] for stage in self.simulation_record['stages'] if stage['stage'] in ('draw_luminosities_and_radii', 'draw_luminosities_and_comoving_distances')))
+
+        start = time.perf_counter()
+        try:
+            output = func(self, *args, **kwargs)
+        finally:
+            wall_time = time.perf_counter() - start
+            current_after, peak = tracemalloc.get_traced_memory()
+            self.stage_stack.pop()
+            peak = max(frame['peak'], peak)
+            if self.stage_stack:
+                self.stage_stack[-1]['peak'] = max(self.stage_stack[-1]['peak'], peak)
+            tracemalloc.reset_peak()
+            if started_tracing:
+                tracemalloc.stop()
+
+        # The draw stages return (radii, luminosities, single-photon radii, ...): multi-photon plus single-photon sources.
+        # Counts maps are counted in photons, like the photon lists they are binned from
+        if stage_name in ('draw_luminosities_and_radii', 'draw_luminosities_and_comoving_distances'):
+            n_out = int(np.size(output[1]) + np.size(output[2]))
+        elif stage_name == 'get_roi_map_summary':
+            n_out = int(round(float(output.sum())))
+        else:
+            n_out = self.count_sources_or_photons(output)
+        self.simulation_record['stages'].append({'stage': stage_name,
+                                                 'depth': depth,
+                                                 'wall_time_s': wall_time,
+                                                 'n_in': n_in,
+                                                 'n_out': n_out,
+                                                 'allocated_bytes': int(peak - current_before),
+                                                 'retained_bytes': int(current_after - current_before)})
+        if len(self.stage_stack) == 0 and (standalone or stage_name == self.instrument_final_stage):
+            self.finish_simulation_record()
+        return output
 
     ##########################################################################
     '''
@@ -121,6 +303,11 @@ class aegis():
         # Finds np.searchsorted(a[i,:], b[i])) in a vectorized way by
         # scaling/offsetting both inputs and then using searchsorted
 
+        if self.backend == 'torch':
+            return torch.searchsorted(torch.as_tensor(np.ascontiguousarray(a)), torch.as_tensor(b, dtype = torch.as_tensor(a).dtype)[:,None]).squeeze(1).numpy()
+        if self.backend == 'numba':
+            return aegis_kernels.searchsorted_rows(np.ascontiguousarray(a, dtype = np.float64), np.ascontiguousarray(b, dtype = np.float64))
+
         # Get scaling offset and then scale inputs
         s = np.r_[0,(np.maximum(a.max(1)-a.min(1)+1,b)+1).cumsum()[:-1]]
         a_scaled = (a+s[:,None]).ravel()
@@ -134,19 +321,94 @@ class aegis():
         # by parameter ranges
         output_samples = np.zeros((N_samples, self.N_parameters))
         for ii in range(0,self.N_parameters):
-            output_samples[:,ii] = np.random.uniform(low = self.param_min[ii],\
-                                                     high = self.param_max[ii],\
-                                                     size = N_samples)
+            output_samples[:,ii] = self.param_min[ii] + (self.param_max[ii] - self.param_min[ii])*self.random_uniform(N_samples)
         return output_samples
     
     def draw_from_pdf(self, cc, Pc, Ndraws):
         # draw random counts from P(c)
+        if self.backend == 'torch':
+            cdf = torch.cumsum(torch.as_tensor(Pc, dtype = torch.float64), 0)
+            return torch.searchsorted(cdf, torch.rand(int(Ndraws), dtype = torch.float64)).numpy()
         cdf = np.cumsum(Pc)
         rands = np.random.rand(Ndraws)
         # Draw Ndraws times from Pc
         d_vec = np.searchsorted(cdf, rands)
         return d_vec
     
+    def seed(self, seed):
+        # Seeds the numpy and torch random number generators from one seed, so runs with either backend are reproducible
+        np.random.seed(seed)
+        torch.manual_seed(seed)
+
+    def random_uniform(self, size):
+        # Uniform [0, 1) draws from the random number generator of the backend
+        if self.backend == 'torch':
+            return torch.rand(int(size), dtype = torch.float64).numpy()
+        return np.random.rand(size)
+
+    def draw_poisson(self, means):
+        # Poisson draws from the random number generator of the backend, as integers
+        if self.backend == 'torch':
+            draws = torch.poisson(torch.as_tensor(np.asarray(means, dtype = np.float64))).numpy().astype('int')
+        else:
+            draws = np.asarray(np.random.poisson(means)).astype('int')
+        return draws if draws.ndim > 0 else int(draws)
+
+    def draw_binomial(self, counts, probs):
+        # Binomial draws from the random number generator of the backend, as integers
+        if self.backend == 'torch':
+            counts, probs = np.broadcast_arrays(np.asarray(counts, dtype = np.float64), np.asarray(probs, dtype = np.float64))
+            return torch.binomial(torch.as_tensor(counts), torch.as_tensor(probs)).numpy().astype(np.int64)
+        return np.random.binomial(counts, probs).astype(np.int64)
+
+    def draw_energies_from_spectra(self, energy_vals, spectra, source_photon_counts):
+        '''
+        Draws source_photon_counts[k] photon energies from spectra[k] (tabulated at energy_vals) for every source k
+        with at least one photon, returning them in source order
+        '''
+        if self.backend == 'torch':
+            # One CDF per source, offset by 2 per source so a single searchsorted finds every photon's energy
+            # without expanding the spectra to one row per photon
+            counts = torch.as_tensor(source_photon_counts[np.nonzero(source_photon_counts)])
+            weights = torch.as_tensor(spectra, dtype = torch.float64)[:,:-1]*torch.as_tensor(np.diff(energy_vals))[None,:]
+            CDFs = torch.cumsum(weights, 1)/torch.sum(weights, 1)[:,None]
+            offsets = 2*torch.arange(CDFs.shape[0], dtype = torch.float64)
+            photon_sources = torch.repeat_interleave(torch.arange(CDFs.shape[0]), counts)
+            rands = torch.rand(photon_sources.numel(), dtype = torch.float64)
+            indices = torch.searchsorted((CDFs + offsets[:,None]).flatten(), rands + offsets[photon_sources]) - photon_sources*CDFs.shape[1]
+            return energy_vals[indices.numpy()]
+        if self.backend == 'numba':
+            # Same CDFs and random numbers as the numpy path, searched per source instead of per photon row
+            counts = source_photon_counts[np.nonzero(source_photon_counts)].astype(np.int64)
+            dE = np.diff(energy_vals)
+            spectra = spectra/np.sum(spectra[:,:-1]*dE, axis = 1)[:,None]
+            CDFs = np.ascontiguousarray(np.cumsum(spectra[:,:-1]*dE, axis = 1), dtype = np.float64)
+            rands = np.random.rand(np.sum(source_photon_counts))
+            return energy_vals[aegis_kernels.searchsorted_grouped(CDFs, counts, rands)]
+
+        #convert to spectra for each photon
+        spectra = np.repeat(spectra, source_photon_counts[np.nonzero(source_photon_counts)], axis = 0)
+        #normalize the spectra
+        energy_m = np.tile(energy_vals, (np.sum(source_photon_counts), 1))
+        norms = np.sum(spectra[:,:-1]*(energy_m[:,1:]-energy_m[:,:-1]), axis = 1)
+        spectra = spectra/(np.tile(norms, (np.size(energy_vals), 1)).T)
+        #get the cumulative distribution functions for each spectra
+        CDFs = np.cumsum(spectra[:,:-1]*(energy_m[:,1:]-energy_m[:,:-1]), axis = 1)
+        #draw photon energies
+        rands = np.random.rand(np.sum(source_photon_counts))
+        return energy_vals[self.searchsorted2d(CDFs, rands)]
+    
+    def draw_grouped_from_pdfs(self, weights, groups):
+        '''
+        Draws one index from the row weights[groups[k]] of the (N_groups x N) unnormalized weights for every k, as
+        draw_from_pdf does per row. The CDFs are offset by 2 per row so one searchsorted finds every draw
+        '''
+        CDFs = np.cumsum(weights, axis = 1)
+        CDFs /= np.where(CDFs[:,-1] > 0, CDFs[:,-1], 1)[:,None]
+        offsets = 2*np.arange(CDFs.shape[0])
+        indices = np.searchsorted((CDFs + offsets[:,None]).ravel(), self.random_uniform(groups.size) + offsets[groups]) - groups*CDFs.shape[1]
+        return np.minimum(indices, CDFs.shape[1] - 1)
+
     #Takes a 2D array. pdf[x,y] should equal pdf(x,y). Returns two 1D arrays of x and y indices.
     #pdf*dx*dy must be passed to this func as pdf for normalization. If x or y are not linspaced, the pdf dimensions should be (n-1,m-1),
     #and the last indices of x and y will not be drawn
@@ -159,10 +421,10 @@ class aegis():
             flipped = True
         x_pdf = np.sum(pdf, axis = 1)/np.sum(pdf)
         x_cdf = np.cumsum(x_pdf)
-        x_rands = np.random.rand(Ndraws)
+        x_rands = self.random_uniform(Ndraws)
         x_indices = np.searchsorted(x_cdf, x_rands)
         y_cdfs = np.cumsum(pdf, axis = 1)/np.tile(np.sum(pdf, axis = 1), (np.size(pdf[0,:]),1)).T
-        y_rands = np.random.rand(Ndraws)
+        y_rands = self.random_uniform(Ndraws)
         y_indices = np.zeros(np.size(x_indices), dtype = 'int')
         for i in range(np.size(pdf[:,0])):
             source_positions = np.where(x_indices == i)
@@ -198,7 +460,7 @@ class aegis():
             total_flux = np.sum(E_flux)
             # draw total photon count for each pixel
             mean_photon_count_per_pix = exposure*Sangle*total_flux
-            photon_counts_per_pix = np.random.poisson(lam = mean_photon_count_per_pix, size = npix)
+            photon_counts_per_pix = self.draw_poisson(np.full(npix, mean_photon_count_per_pix))
         else:
             Pc = self.PDF_spec[source_index][0](params, self.Cbins, self.args)
             photon_counts_per_pix = self.draw_from_pdf(self.Cbins, Pc, npix)
@@ -227,6 +489,7 @@ class aegis():
     '''
     ##########################################################################
 
+    @instrumented_stage('create_sources')
     def create_sources(self, input_params, grains = 1000, epsilon = 0):
         '''
         This function creates a list of sources, where each source has a radial distance, mass, and luminosity
@@ -252,10 +515,10 @@ class aegis():
                 # Draw radii and luminosities from RL abundance
                 if self.source_class_list[si].startswith('extragalactic'):
                     ZL = self.abun_lum_spec[si][0]
-                    radii, luminosities, single_p_radii, redshifts, single_p_redshifts = self.draw_luminosities_and_comoving_distances(input_params, ZL, grains=grains, epsilon=epsilon)
+                    radii, luminosities, single_p_radii, redshifts, single_p_redshifts = self.draw_luminosities_and_comoving_distances(input_params, ZL, grains=grains, epsilon=epsilon, roi_restricted=True, flux_truncated=True)
                 else:
                     RL = self.abun_lum_spec[si][0]
-                    radii, luminosities, single_p_radii = self.draw_luminosities_and_radii(input_params, RL, grains=grains, epsilon=epsilon)
+                    radii, luminosities, single_p_radii = self.draw_luminosities_and_radii(input_params, RL, grains=grains, epsilon=epsilon, roi_restricted=True, flux_truncated=True)
                     # Redshifts are not supported by this source class
                     redshifts = np.zeros(np.size(luminosities))
                     single_p_redshifts = np.zeros(np.size(single_p_radii))
@@ -263,13 +526,9 @@ class aegis():
                 num_single_p_sources = np.size(single_p_radii)
                 
 
-                # Draw angles for every source [theta, phi]
-                angles = np.ones([num_sources, 2])
-                angles[:,0] = np.arccos(1 - 2*np.random.rand(num_sources))
-                angles[:,1] = np.random.uniform(low = 0., high = 2*np.pi, size = num_sources)
-                single_p_angles = np.ones([num_single_p_sources, 2])
-                single_p_angles[:,0] = np.arccos(1 - 2*np.random.rand(num_single_p_sources))
-                single_p_angles[:,1] = np.random.uniform(low = 0., high = 2*np.pi, size = num_single_p_sources)
+                # Draw angles for every source [theta, phi], only in directions that can fall inside angular_cut_gen
+                angles = self.draw_directions_in_roi(radii)
+                single_p_angles = self.draw_directions_in_roi(single_p_radii)
             
             elif self.source_class_list[si] == 'independent_spherical_multi_spectra' or self.source_class_list[si] == 'independent_spherical_single_spectrum':
                 
@@ -354,7 +613,7 @@ class aegis():
 
             # Account for overdrawing single-photon sources
             prob_factors = ((self.GC_to_earth - single_p_radii)/single_p_distances)**2
-            bad_source_indices = np.where(np.random.rand(num_single_p_sources) > prob_factors)
+            bad_source_indices = np.where(self.random_uniform(num_single_p_sources) > prob_factors)
             single_p_radii = np.delete(single_p_radii, bad_source_indices)
             single_p_earth_angles = np.delete(single_p_earth_angles, bad_source_indices, axis = 0)
             single_p_distances = np.delete(single_p_distances, bad_source_indices)
@@ -423,6 +682,7 @@ class aegis():
         
         return source_info
 
+    @instrumented_stage('generate_photons_from_sources')
     def generate_photons_from_sources(self, input_params, source_info, grains = 1000):
         '''
         Function returns list of photon energies and sky positions
@@ -433,7 +693,7 @@ class aegis():
             mean_photon_counts /= (1+source_info['redshifts'])
 
         # Poisson draw from mean photon counts to get realization of photon counts
-        photon_counts = np.random.poisson(mean_photon_counts).astype('int')
+        photon_counts = self.draw_poisson(mean_photon_counts)
         
         # Add single photon sources to the photon counts
         photon_counts = np.concatenate((photon_counts, np.ones(source_info['single_p_distances'].size).astype('int')))
@@ -474,17 +734,7 @@ class aegis():
                     spectra = self.abun_lum_spec[si][1](energy_vals, num_spectra = np.count_nonzero(source_photon_counts), params = input_params)
                 else:
                     spectra = self.abun_lum_spec[si][2](energy_vals, num_spectra = np.count_nonzero(source_photon_counts), params = input_params)
-                #convert to spectra for each photon
-                spectra = np.repeat(spectra, source_photon_counts[np.nonzero(source_photon_counts)], axis = 0)
-                #normalize the spectra
-                energy_m = np.tile(energy_vals, (np.sum(source_photon_counts), 1))
-                norms = np.sum(spectra[:,:-1]*(energy_m[:,1:]-energy_m[:,:-1]), axis = 1)
-                spectra = spectra/(np.tile(norms, (np.size(energy_vals), 1)).T)
-                #get the cumulative distribution functions for each spectra
-                CDFs = np.cumsum(spectra[:,:-1]*(energy_m[:,1:]-energy_m[:,:-1]), axis = 1)
-                #draw photon energies
-                rands = np.random.rand(np.sum(source_photon_counts))
-                energies[np.where(photon_types == si)] = energy_vals[self.searchsorted2d(CDFs, rands)]
+                energies[np.where(photon_types == si)] = self.draw_energies_from_spectra(energy_vals, spectra, source_photon_counts)
 
             if self.source_class_list[si] == 'isotropic_faint_single_spectrum' or self.source_class_list[si] == 'independent_spherical_single_spectrum' or self.source_class_list[si] == 'independent_cylindrical_single_spectrum' or self.source_class_list[si] == 'extragalactic_isotropic_faint_single_spectrum':
                 if np.count_nonzero(photon_counts) == 0:
@@ -512,30 +762,31 @@ class aegis():
             if self.source_class_list[si] == 'isotropic_diffuse':
                 energy_vals = np.geomspace(self.Emin_gen, self.Emax_gen, grains)
                 spectrum = self.abun_lum_spec[si][0](energy_vals, input_params)
-                solid_angle = 2*np.pi*(1-np.cos(self.angular_cut_gen))
+                solid_angle = self.get_allowed_region_sampler()['solid_angle']
                 exposure_correction = units.kpc.to('cm')**2
 
                 spectrum_geometric_mean = np.sqrt(spectrum[1:]*spectrum[:-1])
                 mean_photons = solid_angle*np.sum(spectrum_geometric_mean*(energy_vals[1:] - energy_vals[:-1]))*self.exposure*exposure_correction
                 
-                num_photons = np.random.poisson(mean_photons)
+                num_photons = self.draw_poisson(mean_photons)
                 if num_photons == 0:
                     Es = np.array([])
                 else:
                     Es = energy_vals[self.draw_from_pdf(
                         energy_vals, spectrum_geometric_mean*(energy_vals[1:] - energy_vals[:-1])/np.sum(spectrum_geometric_mean*(energy_vals[1:] - energy_vals[:-1])), num_photons
                         )]
-                As = self.draw_random_angles(num_photons)
-
-                As = np.atleast_2d(As)          # guarantees shape (N,2), with N = 0,1,…
-
-                keep_i = np.where(np.abs(np.pi/2 - As[:,0]) >= self.lat_cut_gen)[0]
-                energies = np.concatenate((energies, Es[keep_i]))
-                angles = np.concatenate((angles, As[keep_i]))
+                As = self.draw_angles_in_allowed_region(num_photons)
+                energies = np.concatenate((energies, Es))
+                angles = np.concatenate((angles, As))
                 
             if self.source_class_list[si] == 'healpix_map':
-                map_vals, map_E, map_i, N_side = self.abun_lum_spec[si][0](input_params)
-                As, Es = self.draw_angles_and_energies_from_partial_map(map_vals, map_E, map_i, N_side)
+                # The map function returns (map_vals, map_E, map_i, N_side) and optionally a fifth element, a hashable map_key
+                # promising that maps with the same key only differ by an overall factor, so their sampling table can be reused.
+                # Without one, the key is derived from the function and the map itself (get_map_key)
+                map_output = self.abun_lum_spec[si][0](input_params)
+                map_vals, map_E, map_i, N_side = map_output[:4]
+                map_key = map_output[4] if len(map_output) > 4 else self.get_map_key(self.abun_lum_spec[si][0], map_vals, map_E, map_i, N_side)
+                As, Es = self.draw_angles_and_energies_from_partial_map(map_vals, map_E, map_i, N_side, map_key = map_key)
                 angles = np.concatenate((angles, As))
                 energies = np.concatenate((energies, Es))
 
@@ -546,9 +797,91 @@ class aegis():
         
         return photon_info
 
+    @instrumented_stage('generate_photons_from_sources_batch')
+    def generate_photons_from_sources_batch(self, params_batch, source_infos, grains = 1000):
+        '''
+        generate_photons_from_sources for every row of params_batch with its source_info from create_sources, returning the
+        list of photon lists. The draws are vectorized over the rows: one Poisson draw for the photon counts of every
+        source, one grouped search (draw_grouped_from_pdfs) over the per-row spectra for the energies of every
+        single-spectrum and isotropic_diffuse class, one call for the isotropic directions, and one draw from the shared
+        sampling table for a healpix_map class whose rows all give the same map_key. Only the user callables are
+        evaluated per row. Multi-spectra classes, and maps whose rows differ in map_key, are drawn row by row
+        '''
+        N_rows = len(source_infos)
+        energy_vals = np.geomspace(self.Emin_gen, self.Emax_gen, grains)
+        dE = energy_vals[1:] - energy_vals[:-1]
+        self.N_source_classes = len(self.abun_lum_spec)
+
+        # Point sources: multi-photon sources of all rows, then single-photon sources of all rows
+        def stacked(field, single_p):
+            prefix = 'single_p_' if single_p else ''
+            return np.concatenate([info[prefix + field] for info in source_infos])
+        source_rows = np.concatenate([np.repeat(np.arange(N_rows), [info['luminosities'].size for info in source_infos]),
+                                      np.repeat(np.arange(N_rows), [info['single_p_distances'].size for info in source_infos])])
+        mean_photon_counts = self.exposure*stacked('luminosities', False)/(4.*np.pi*stacked('distances', False)**2.)
+        if self.cosmology:
+            mean_photon_counts /= (1 + stacked('redshifts', False))
+        photon_counts = np.concatenate((self.draw_poisson(mean_photon_counts), np.ones(source_rows.size - mean_photon_counts.size, dtype = int)))
+        source_types = np.concatenate((stacked('types', False), stacked('types', True)))
+        photon_rows = np.repeat(source_rows, photon_counts)
+        photon_types = np.repeat(source_types, photon_counts)
+        angles = np.repeat(np.concatenate((stacked('angles', False).reshape((-1, 2)), stacked('angles', True).reshape((-1, 2)))), photon_counts, axis = 0)
+        energies = np.zeros(photon_rows.size)
+        for si in range(self.N_source_classes):
+            source_class = self.source_class_list[si]
+            in_class = photon_types == si
+            if not np.any(in_class):
+                continue
+            spectrum_func = self.abun_lum_spec[si][1] if 'isotropic' in source_class else self.abun_lum_spec[si][2]
+            if source_class.endswith('single_spectrum'):
+                spectra = np.array([spectrum_func(energy_vals, params = params) for params in params_batch])
+                energies[in_class] = energy_vals[self.draw_grouped_from_pdfs(spectra[:,:-1]*dE[None,:], photon_rows[in_class])]
+            elif source_class.endswith('multi_spectra'):
+                for row in np.unique(photon_rows[in_class]):
+                    source_photon_counts = photon_counts[(source_rows == row) & (source_types == si)]
+                    spectra = spectrum_func(energy_vals, num_spectra = np.count_nonzero(source_photon_counts), params = params_batch[row])
+                    energies[in_class & (photon_rows == row)] = self.draw_energies_from_spectra(energy_vals, spectra, source_photon_counts)
+        if self.cosmology:
+            energies /= (1 + np.repeat(np.concatenate((stacked('redshifts', False), stacked('redshifts', True))), photon_counts))
+        angles, energies, photon_rows = [angles], [energies], [photon_rows]
+
+        # Isotropic diffuse and healpix map sources
+        for si in range(self.N_source_classes):
+            if self.source_class_list[si] == 'isotropic_diffuse':
+                spectra = np.array([self.abun_lum_spec[si][0](energy_vals, params) for params in params_batch])
+                weights = np.sqrt(spectra[:,1:]*spectra[:,:-1])*dE[None,:]
+                mean_photons = self.get_allowed_region_sampler()['solid_angle']*np.sum(weights, axis = 1)*self.exposure*units.kpc.to('cm')**2
+                rows = np.repeat(np.arange(N_rows), self.draw_poisson(mean_photons))
+                energies.append(energy_vals[self.draw_grouped_from_pdfs(weights, rows)])
+                angles.append(self.draw_angles_in_allowed_region(rows.size))
+                photon_rows.append(rows)
+
+            if self.source_class_list[si] == 'healpix_map':
+                map_outputs = [self.abun_lum_spec[si][0](params) for params in params_batch]
+                map_keys = [output[4] if len(output) > 4 else self.get_map_key(self.abun_lum_spec[si][0], *output[:4]) for output in map_outputs]
+                if all(map_key == map_keys[0] for map_key in map_keys):
+                    N_draws = self.draw_poisson(np.array([self.get_partial_map_mean_photons(*output[:4]) for output in map_outputs]))
+                    As, Es = self.draw_angles_and_energies_from_partial_map(*map_outputs[0][:4], N_draws = int(np.sum(N_draws)), map_key = map_keys[0])
+                    rows = np.repeat(np.arange(N_rows), N_draws)
+                else:
+                    draws = [self.draw_angles_and_energies_from_partial_map(*output[:4], map_key = map_key) for output, map_key in zip(map_outputs, map_keys)]
+                    As, Es = np.concatenate([draw[0] for draw in draws]), np.concatenate([draw[1] for draw in draws])
+                    rows = np.repeat(np.arange(N_rows), [draw[1].size for draw in draws])
+                angles.append(As)
+                energies.append(Es)
+                photon_rows.append(rows)
+
+        angles, energies, photon_rows = np.concatenate(angles), np.concatenate(energies), np.concatenate(photon_rows)
+        order = np.argsort(photon_rows, kind = 'stable')
+        splits = np.searchsorted(photon_rows[order], np.arange(1, N_rows))
+        return [{'angles': angles[row_order], 'energies': energies[row_order]} for row_order in np.split(order, splits)]
+
     #for extragalactic isotropic adundances where luminosity may depend on radius
     #epsilon is the propability of recieveing a single photon below which single-photon sources are generated
-    def draw_luminosities_and_comoving_distances(self, input_params, ZL, Z_array_func = np.geomspace, L_array_func = np.geomspace, grains = 1000, epsilon = 0):
+    @instrumented_stage('draw_luminosities_and_comoving_distances')
+    #roi_restricted = True only counts sources in directions that can fall inside angular_cut_gen (see get_roi_direction_intervals)
+    #flux_truncated = True does not draw multi-photon sources from cells that are above flux_cut wherever they are placed
+    def draw_luminosities_and_comoving_distances(self, input_params, ZL, Z_array_func = np.geomspace, L_array_func = np.geomspace, grains = 1000, epsilon = 0, roi_restricted = False, flux_truncated = False):
         if not self.cosmology:
             raise Exception('No cosmology defined')
         if not self.Zmax:
@@ -560,6 +893,8 @@ class aegis():
         cd = self.cosmology.comoving_distance(z).value * units.Mpc.to('kpc')
         dVdL = np.tile(4/3*np.pi * (cd[1:]**3-cd[:-1]**3), (grains-1,1)).T * np.tile((lums[1:]-lums[:-1]), (grains-1,1))
         ZL_integral = ZL_PDF *dVdL
+        if roi_restricted:
+            ZL_integral *= self.get_roi_fraction(cd[:-1])[:,None]
 
         # binomially draw low luminosity sources to save computation time
         Dconserv = np.abs(self.GC_to_earth - np.tile(cd[:-1],(grains-1,1)).T) #the closest possible distance from earth to a source generated at raduis cd
@@ -568,13 +903,15 @@ class aegis():
         Ci = np.where(C < epsilon)
         C = np.where(C < epsilon, C, 0)
         p = C*np.exp(-C) #probability that exactly 1 photon is recieved from such a source
-        num_single_p_sources_at_radii = np.random.poisson(np.sum(ZL_integral*p, axis = 1))
+        num_single_p_sources_at_radii = self.draw_poisson(np.sum(ZL_integral*p, axis = 1))
         single_p_radii = np.repeat(cd[:-1], num_single_p_sources_at_radii)
         single_p_redshifts = np.repeat(z[:-1], num_single_p_sources_at_radii)
 
         # draw remaining sources from distribution
         ZL_integral[Ci] = 0
-        N_draws = np.random.poisson(np.round(np.sum(ZL_integral)).astype(int))
+        if flux_truncated:
+            ZL_integral[self.get_flux_cut_cells(cd[:-1], lums[:-1], z[:-1])] = 0
+        N_draws = self.draw_poisson(np.round(np.sum(ZL_integral)).astype(int))
         if np.all(ZL_integral == 0): # all elements of ZL_integral are zero
             z_indices, lum_indices = np.array([], dtype=int), np.array([], dtype=int)
         else:
@@ -584,12 +921,17 @@ class aegis():
 
     #for isotropic adundances where luminosity may depend on radius
     #epsilon is the propability of recieveing a single photon below which single-photon sources are generated
-    def draw_luminosities_and_radii(self, input_params, RL, R_array_func = np.geomspace, L_array_func = np.geomspace, grains = 1000, epsilon = 0):
+    @instrumented_stage('draw_luminosities_and_radii')
+    #roi_restricted = True only counts sources in directions that can fall inside angular_cut_gen (see get_roi_direction_intervals)
+    #flux_truncated = True does not draw multi-photon sources from cells that are above flux_cut wherever they are placed
+    def draw_luminosities_and_radii(self, input_params, RL, R_array_func = np.geomspace, L_array_func = np.geomspace, grains = 1000, epsilon = 0, roi_restricted = False, flux_truncated = False):
         r = R_array_func(0 + 1, self.Rmax + 1, grains) - 1
         lums = L_array_func(self.Lmin + 1, self.Lmax + 1, grains) - 1
         RL_PDF = RL(np.tile(r[:-1],(grains-1,1)).T, np.tile(lums[:-1],(grains-1,1)), input_params)
         dVdL = np.tile(4/3*np.pi * (r[1:]**3-r[:-1]**3), (grains-1,1)).T * np.tile((lums[1:]-lums[:-1]), (grains-1,1))
         RL_integral = RL_PDF * dVdL
+        if roi_restricted:
+            RL_integral *= self.get_roi_fraction(r[:-1])[:,None]
         
         # binomially draw low luminosity sources to save computation time
         Dconserv = np.abs(self.GC_to_earth - np.tile(r[:-1],(grains-1,1)).T) #the closest possible distance from earth to a source generated at raduis r
@@ -598,16 +940,112 @@ class aegis():
         Ci = np.where(C < epsilon)
         C = np.where(C < epsilon, C, 0)
         p = C*np.exp(-C) #probability that exactly 1 photon is recieved from such a source
-        num_single_p_sources_at_radii = np.random.poisson(np.sum(RL_integral*p, axis = 1))
+        num_single_p_sources_at_radii = self.draw_poisson(np.sum(RL_integral*p, axis = 1))
         single_p_radii = np.repeat(r[:-1], num_single_p_sources_at_radii)
         
         # draw remaining sources from distribution
         RL_integral[Ci] = 0
-        N_draws = np.random.poisson(np.round(np.sum(RL_integral)).astype(int))
+        if flux_truncated:
+            RL_integral[self.get_flux_cut_cells(r[:-1], lums[:-1])] = 0
+        N_draws = self.draw_poisson(np.round(np.sum(RL_integral)).astype(int))
         r_indices, lum_indices = self.draw_from_2D_pdf(RL_integral, N_draws)
         
         return r[r_indices], lums[lum_indices], single_p_radii
     
+    def get_flux_cut_cells(self, radii, lums, redshifts = 0):
+        '''
+        Boolean (radius x luminosity) grid of the cells whose sources exceed flux_cut even at the largest possible
+        distance from Earth, R0 + r. create_sources would remove every multi-photon source drawn from these cells, so
+        they can be skipped; sources in the other cells still go through the exact flux cut in create_sources
+        '''
+        if not np.isfinite(self.flux_cut):
+            return np.zeros((np.size(radii), np.size(lums)), dtype = bool)
+        min_flux_per_lum = 1/(4*np.pi*(1 + redshifts)*((self.GC_to_earth + radii)*units.kpc.to('cm'))**2)
+        return np.asarray(lums)[None,:]*np.asarray(min_flux_per_lum)[:,None]*np.ones((np.size(radii), 1)) > self.flux_cut
+
+    def get_roi_direction_intervals(self, radii):
+        '''
+        For sources at galactocentric radius r, the directions u (from the Galactic center) that can appear within
+        angular_cut_gen of the Galactic center from Earth, as intervals of c = u.e_x, where e_x points away from Earth.
+        Accepted directions are [-1, c_low] and [c_high, 1], with the boundary roots
+        c = (-R0 sin^2(cut) -+ cos(cut) sqrt(r^2 - R0^2 sin^2(cut)))/r:
+        r < R0 sin(cut): every direction, R0 sin(cut) <= r <= R0: [-1, c-] and [c+, 1], r > R0: [c+, 1].
+        For cuts of 90 degrees or more only r > R0 is restricted, to [c+, 1]. The |b| < lat_cut_gen strip is excluded
+        inside these intervals by get_roi_direction_cells. Returns (c_low, c_high)
+        '''
+        radii = np.asarray(radii, dtype = float)
+        c_low = np.ones(radii.shape)
+        c_high = np.ones(radii.shape)
+        if self.angular_cut_gen >= np.pi:
+            return c_low, c_high
+        R0 = self.GC_to_earth
+        sin_cut, cos_cut = np.sin(self.angular_cut_gen), np.cos(self.angular_cut_gen)
+        restricted = radii >= R0*sin_cut if self.angular_cut_gen < np.pi/2 else radii > R0
+        r = radii[restricted]
+        root = cos_cut*np.sqrt(np.maximum(r**2 - (R0*sin_cut)**2, 0))
+        c_low[restricted] = np.where(r <= R0, np.clip((-R0*sin_cut**2 - root)/r, -1, 1), -1)
+        c_high[restricted] = np.clip((-R0*sin_cut**2 + root)/r, -1, 1)
+        return c_low, c_high
+
+    def get_strip_psi_limit(self, radii, c):
+        # Smallest psi in [0, pi/2] with which a source at r u, u = (c, s cos(psi), s sin(psi)) and s = sqrt(1 - c^2), lies
+        # outside the |b| < lat_cut_gen strip: |sin(psi)| >= k = sin(lat_cut_gen)|R0 e_x + r u|/(r s). pi/2 when k >= 1
+        rs = radii*np.sqrt(np.maximum(1 - c**2, 0))
+        distances = np.sqrt(np.maximum(self.GC_to_earth**2 + 2*self.GC_to_earth*radii*c + radii**2, 0))
+        k = np.divide(np.sin(self.lat_cut_gen)*distances, rs, out = np.full(np.shape(rs), np.inf), where = rs > 0)
+        return np.arcsin(np.minimum(k, 1))
+
+    def get_roi_direction_cells(self, radii, N_cells = 512):
+        '''
+        Splits the accepted c intervals of get_roi_direction_intervals (walking [-1, c_low], then [c_high, 1]) into N_cells
+        equal cells per radius and returns (c_low, c_high, fractions), fractions being the share of the azimuths psi
+        around e_x at each cell centre that lie outside the |b| < lat_cut_gen strip, 1 - 2 get_strip_psi_limit/pi
+        '''
+        radii = np.asarray(radii, dtype = float)
+        c_low, c_high = self.get_roi_direction_intervals(radii)
+        length_low = c_low + 1
+        u = (np.arange(N_cells) + 0.5)/N_cells*(length_low + 1 - c_high)[:,None]
+        c = np.where(u < length_low[:,None], u - 1, c_high[:,None] + (u - length_low[:,None]))
+        return c_low, c_high, 1 - 2*self.get_strip_psi_limit(radii[:,None], c)/np.pi
+
+    def get_roi_fraction(self, radii):
+        # Fraction of isotropic directions at each galactocentric radius that can fall inside angular_cut_gen and outside lat_cut_gen
+        if not self.lat_cut_gen:
+            c_low, c_high = self.get_roi_direction_intervals(radii)
+            return ((c_low + 1) + (1 - c_high))/2
+        c_low, c_high, fractions = self.get_roi_direction_cells(np.atleast_1d(radii))
+        return np.reshape(((c_low + 1) + (1 - c_high))*np.mean(fractions, axis = 1)/2, np.shape(radii))
+
+    def draw_directions_in_roi(self, radii):
+        '''
+        Isotropic galactocentric directions [theta, phi] restricted to the accepted intervals of get_roi_direction_intervals.
+        With a latitude cut, the cell of c is drawn from the strip-free fractions of get_roi_direction_cells (one table per
+        distinct radius, the radii being grid values) and psi is drawn only from the azimuths outside the strip
+        '''
+        radii = np.asarray(radii, dtype = float)
+        c_low, c_high = self.get_roi_direction_intervals(radii)
+        length_low = c_low + 1
+        length = length_low + 1 - c_high
+        if not self.lat_cut_gen:
+            u = self.random_uniform(np.size(radii))*length
+        else:
+            unique_radii, groups = np.unique(radii, return_inverse = True)
+            fractions = self.get_roi_direction_cells(unique_radii)[2]
+            cells = self.draw_grouped_from_pdfs(fractions, groups.ravel())
+            u = (cells + self.random_uniform(np.size(radii)))/fractions.shape[1]*length
+        c = np.where(u < length_low, u - 1, c_high + (u - length_low))
+        c = np.clip(c, -1, 1)
+        if not self.lat_cut_gen:
+            psi = 2*np.pi*self.random_uniform(np.size(radii))
+        else:
+            psi_limit = self.get_strip_psi_limit(radii, c)
+            psi = psi_limit + (np.pi - 2*psi_limit)*self.random_uniform(np.size(radii)) + np.pi*(self.random_uniform(np.size(radii)) < 0.5)
+        s = np.sqrt(1 - c**2)
+        angles = np.ones([np.size(radii), 2])
+        angles[:,0] = np.arccos(s*np.sin(psi))
+        angles[:,1] = np.arctan2(s*np.cos(psi), c) % (2*np.pi)
+        return angles
+
     #for independently distributed R*Theta*Phi abundances
     def draw_spherical_positions_independent(self, input_params, R, Theta, Phi, grains = 1000):
         r = np.exp(np.linspace(np.log(0.001), np.log(self.Rmax), grains))
@@ -616,7 +1054,7 @@ class aegis():
         r_integral = R(r[:-1], input_params) * r[:-1]**2 * (r[1:]-r[:-1])
         theta_integral = Theta(theta[:-1], input_params) * np.sin((theta[:-1])) * (theta[1:]-theta[:-1])
         phi_integral = Phi(phi[:-1], input_params) * (phi[1:]-phi[:-1])
-        N_draws = np.random.poisson(np.round(np.sum(r_integral)*np.sum(theta_integral)*np.sum(phi_integral)).astype('int'))
+        N_draws = self.draw_poisson(np.round(np.sum(r_integral)*np.sum(theta_integral)*np.sum(phi_integral)).astype('int'))
         r_i = self.draw_from_pdf(r, r_integral/np.sum(r_integral), N_draws)
         theta_i = self.draw_from_pdf(theta, theta_integral/np.sum(theta_integral), N_draws)
         phi_i = self.draw_from_pdf(phi, phi_integral/np.sum(phi_integral), N_draws)
@@ -632,7 +1070,7 @@ class aegis():
         r_integral = R(r[:-1], input_params) * r[:-1] * (r[1:]-r[:-1])
         z_integral = Z(z[:-1], input_params) * (z[1:]-z[:-1])
         phi_integral = Phi(phi[:-1], input_params) * (phi[1:]-phi[:-1])
-        N_draws = np.random.poisson(np.round(np.sum(r_integral)*np.sum(z_integral)*np.sum(phi_integral)).astype('int'))
+        N_draws = self.draw_poisson(np.round(np.sum(r_integral)*np.sum(z_integral)*np.sum(phi_integral)).astype('int'))
         r_i = self.draw_from_pdf(r, r_integral/np.sum(r_integral), N_draws)
         z_i = self.draw_from_pdf(z, z_integral/np.sum(z_integral), N_draws)
         phi_i = self.draw_from_pdf(phi, phi_integral/np.sum(phi_integral), N_draws)
@@ -655,33 +1093,176 @@ class aegis():
         dE = map_E[1:] - map_E[:-1]
         integrand = new_map_all[:-1,:]*self.exposure*(units.kpc.to('cm')**2)*(4*np.pi/N_pix)*(np.tile(dE, (keep_i.size,1)).T)
         if N_draws == 0:
-            N_draws = int(round(np.random.poisson(np.sum(integrand))))
+            N_draws = int(round(self.draw_poisson(np.sum(integrand))))
         energy_i, pixel_i = self.draw_from_2D_pdf(integrand, N_draws)
         angles = hp.pix2ang(N_side, keep_i[pixel_i])
         return np.array(angles).T, map_E[energy_i]
     
+    def get_map_key(self, map_func, map_vals, map_E, map_i, N_side):
+        '''
+        Sampling table key of a healpix_map source whose map function gives no map_key: the function, its pixels and
+        energies, and a hash of the map normalized to unit sum (in float32, so a fixed template times a parameter gets the
+        same key). When the normalized map of a function changes, the sampling tables of its previous key are dropped
+        '''
+        base = (map_func, N_side, map_i.tobytes(), np.asarray(map_E).tobytes())
+        total = np.sum(map_vals)
+        shape = np.ascontiguousarray(map_vals/total if total != 0 else map_vals, dtype = np.float32)
+        map_key = base + (hashlib.blake2b(shape.tobytes(), digest_size = 16).hexdigest(),)
+        previous_key = self.map_keys.get(base)
+        if previous_key is not None and previous_key != map_key:
+            for sampler_key in [k for k in self.map_samplers if k[0] == previous_key]:
+                del self.map_samplers[sampler_key]
+        self.map_keys[base] = map_key
+        return map_key
+
+    def get_partial_map_mean_photons(self, map_vals, map_E, map_i, N_side):
+        # Expected number of photons of a partial map outside the generation latitude cut
+        photons_per_flux = self.exposure*(units.kpc.to('cm')**2)*(4*np.pi/hp.nside2npix(N_side))
+        return photons_per_flux*np.einsum('ij,i,j->', map_vals[:-1,:], map_E[1:] - map_E[:-1], self.get_lat_cut_keep(N_side, map_i))
+
     #for partial non-isotropic healpix maps
-    def draw_angles_and_energies_from_partial_map(self, map_vals, map_E, map_i, N_side, N_draws = 0):
-        full_map_N_pix = hp.nside2npix(N_side)
-        N_pix = map_i.size
-        
-        #For lat cut
-        masked_i = hp.query_strip(nside = N_side, theta1 = np.pi/2-self.lat_cut_gen, theta2 = np.pi/2+self.lat_cut_gen)
-        map_vals[:, np.where(np.isin(map_i, masked_i))[0]] *= 0
-        
+    def draw_angles_and_energies_from_partial_map(self, map_vals, map_E, map_i, N_side, N_draws = 0, map_key = None):
+        '''
+        Draws photons from a partial map without modifying map_vals. If map_key is given, map_vals is taken to be
+        proportional to the map last seen with the same key (e.g. a fixed template scaled by a parameter), so the normalized
+        sampling table is built once and each call only draws the Poisson total and the photon cells.
+        Small maps are sampled from a flat (energy x pixel) table, large maps with the hierarchical sampler of
+        draw_pixels_from_pyramid (see map_sampler in __init__)
+        '''
+        keep = self.get_lat_cut_keep(N_side, map_i)
         dE = map_E[1:] - map_E[:-1]
-        integrand = map_vals[:-1,:]*self.exposure*(units.kpc.to('cm')**2)*(4*np.pi/full_map_N_pix)*(np.tile(dE, (N_pix,1)).T)
         if N_draws == 0:
-            N_draws = int(round(np.random.poisson(np.sum(integrand))))
-        energy_i, pixel_i = self.draw_from_2D_pdf(integrand, N_draws)
+            N_draws = int(round(self.draw_poisson(self.get_partial_map_mean_photons(map_vals, map_E, map_i, N_side))))
+
+        hierarchical = self.map_sampler == 'hierarchical' or (self.map_sampler == 'auto' and dE.size*map_i.size > self.map_sampler_threshold)
+        sampler_key = None if map_key is None else (map_key, N_side, self.lat_cut_gen, hierarchical)
+        if sampler_key in self.map_samplers:
+            sampler = self.map_samplers[sampler_key]
+        elif hierarchical:
+            sampler = self.build_map_pyramid(np.einsum('ij,i->j', map_vals[:-1,:], dE)*keep, hp.ring2nest(N_side, map_i), N_side)
+        else:
+            sampler = np.cumsum((map_vals[:-1,:]*dE[:,None]*keep[None,:]).ravel())
+            sampler /= sampler[-1]
+            sampler.setflags(write = False)
+        if sampler_key is not None:
+            self.map_samplers[sampler_key] = sampler
+
+        if hierarchical:
+            # Pixels from their marginal, then each photon's energy from the spectrum of its pixel. The photons are
+            # grouped by pixel and searched in the CDF of their group, so the spectra are only built once per distinct
+            # drawn pixel instead of once per photon
+            pixel_i = self.draw_pixels_from_pyramid(sampler, N_draws)
+            rands = self.random_uniform(N_draws)
+            order = np.argsort(pixel_i, kind = 'stable')
+            sorted_pixel_i = pixel_i[order]
+            group_starts = np.nonzero(np.r_[True, sorted_pixel_i[1:] != sorted_pixel_i[:-1]])[0]
+            counts = np.diff(np.r_[group_starts, N_draws])
+            energy_cdfs = np.cumsum(map_vals[:-1, sorted_pixel_i[group_starts]].T*dE[None,:], axis = 1)
+            energy_cdfs /= np.where(energy_cdfs[:,-1] > 0, energy_cdfs[:,-1], 1)[:,None]
+            energy_i = np.empty(N_draws, dtype = np.int64)
+            if self.backend == 'numba':
+                energy_i[order] = aegis_kernels.searchsorted_grouped(np.ascontiguousarray(energy_cdfs), counts, rands[order])
+            else:
+                photon_groups = np.repeat(np.arange(counts.size), counts)
+                offsets = 2*np.arange(counts.size)
+                energy_i[order] = np.searchsorted((energy_cdfs + offsets[:,None]).ravel(), rands[order] + offsets[photon_groups], side = 'right') - photon_groups*dE.size
+            energy_i = np.minimum(energy_i, dE.size - 1)
+        else:
+            cell_i = np.minimum(np.searchsorted(sampler, self.random_uniform(N_draws), side = 'right'), sampler.size - 1)
+            energy_i, pixel_i = np.divmod(cell_i, map_i.size)
         angles = hp.pix2ang(N_side, map_i[pixel_i])
         return np.array(angles).T, map_E[energy_i]
 
+    def build_map_pyramid(self, pixel_weights, nest_i, N_side):
+        '''
+        Sums of pixel_weights over the NEST hierarchy of the map pixels, from the map resolution down to N_side = 1.
+        The children of a node are contiguous in NEST order, so each level only stores node weights and the index of
+        each node's first child. Memory is about 4/3 of one weight per pixel, independent of the number of energy bins
+        '''
+        order = np.argsort(nest_i)
+        ids = nest_i[order]
+        weights = [pixel_weights[order]]
+        first_children = []
+        for _ in range(int(np.log2(N_side))):
+            parents = ids >> 2
+            first = np.concatenate(([0], np.nonzero(np.diff(parents))[0] + 1))
+            weights.append(np.add.reduceat(weights[-1], first))
+            first_children.append(np.concatenate((first, [ids.size])))
+            ids = parents[first]
+        for level_weights in weights:
+            level_weights.setflags(write = False)
+        return {'order': order, 'weights': weights, 'first_children': first_children}
+
+    def draw_pixels_from_pyramid(self, pyramid, N_draws):
+        # Draws a coarsest-level node, then descends one level at a time choosing among at most 4 children; returns map pixel indices
+        # Nodes are chosen as the first with cumulative weight strictly above x, with x kept in [0, total) against
+        # rounding, so zero-weight nodes are never drawn
+        top = pyramid['weights'][-1]
+        top_cdf = np.cumsum(top)
+        x = np.minimum(self.random_uniform(N_draws)*top_cdf[-1], np.nextafter(top_cdf[-1], 0))
+        node = np.searchsorted(top_cdf, x, side = 'right')
+        x = x - (top_cdf[node] - top[node])
+        for level in range(len(pyramid['first_children']) - 1, -1, -1):
+            level_weights = pyramid['weights'][level]
+            start = pyramid['first_children'][level][node]
+            N_children = pyramid['first_children'][level][node + 1] - start
+            children = start[:,None] + np.arange(4)[None,:]
+            child_weights = np.where(np.arange(4)[None,:] < N_children[:,None], level_weights[np.minimum(children, level_weights.size - 1)], 0)
+            child_cdfs = np.cumsum(child_weights, axis = 1)
+            x = np.clip(x, 0, np.nextafter(child_cdfs[:,-1], 0))
+            k = np.sum(child_cdfs <= x[:,None], axis = 1)
+            x = x - (child_cdfs[np.arange(N_draws), k] - child_weights[np.arange(N_draws), k])
+            node = start + k
+        return pyramid['order'][node]
+
+    def get_lat_cut_keep(self, N_side, map_i):
+        # Boolean mask of the map pixels outside the generation latitude cut, cached per (N_side, pixel set, lat_cut_gen)
+        key = (N_side, map_i.tobytes(), self.lat_cut_gen)
+        if key not in self.lat_cut_masks:
+            masked_i = hp.query_strip(nside = N_side, theta1 = np.pi/2-self.lat_cut_gen, theta2 = np.pi/2+self.lat_cut_gen)
+            keep = ~np.isin(map_i, masked_i)
+            keep.setflags(write = False)
+            self.lat_cut_masks[key] = keep
+        return self.lat_cut_masks[key]
+
+    def get_allowed_region_sampler(self):
+        '''
+        Exact solid angle of the generation region (the angular_cut_gen cap around the Galactic center minus the
+        |b| < lat_cut_gen strip) and the inverse CDF of s = sin(b) inside it, cached per (angular_cut_gen, lat_cut_gen).
+        At latitude b the cap spans |l| <= l_max(b) = arccos(cos(angular_cut_gen)/cos(b)), and dOmega = ds dl,
+        so s has density proportional to l_max and l is uniform in [-l_max, l_max]
+        '''
+        key = (self.angular_cut_gen, self.lat_cut_gen)
+        if key not in self.allowed_region_samplers:
+            cos_cut = np.cos(self.angular_cut_gen)
+            l_max = lambda b: np.arccos(np.clip(cos_cut/np.maximum(np.cos(b), 1e-300), -1, 1))
+            b_max = min(self.angular_cut_gen, np.pi/2)
+            if self.lat_cut_gen >= b_max:
+                solid_angle = 0.
+            else:
+                solid_angle = 4*integrate.quad(lambda b: l_max(b)*np.cos(b), self.lat_cut_gen, b_max, limit = 200)[0]
+            s_grid = np.linspace(np.sin(min(self.lat_cut_gen, b_max)), np.sin(b_max), 4097)
+            density = l_max(np.arcsin(s_grid))
+            cdf = np.concatenate(([0], np.cumsum(0.5*(density[1:] + density[:-1])*np.diff(s_grid))))
+            self.allowed_region_samplers[key] = {'solid_angle': solid_angle, 's_grid': s_grid, 'cdf': cdf/cdf[-1] if cdf[-1] > 0 else cdf}
+        return self.allowed_region_samplers[key]
+
+    def draw_angles_in_allowed_region(self, num_angles):
+        # Draws (theta, phi) uniformly on the sphere inside the generation region only, so no angles are rejected afterwards
+        sampler = self.get_allowed_region_sampler()
+        if num_angles == 0 or sampler['solid_angle'] == 0:
+            return np.zeros((0, 2))
+        s = np.interp(self.random_uniform(num_angles), sampler['cdf'], sampler['s_grid'])
+        b = np.arcsin(s)*np.where(self.random_uniform(num_angles) < 0.5, -1, 1)
+        l_max = np.arccos(np.clip(np.cos(self.angular_cut_gen)/np.cos(b), -1, 1))
+        l = l_max*(2*self.random_uniform(num_angles) - 1)
+        return np.array([np.pi/2 - b, l]).T
+
     def draw_random_angles(self, num_angles):
         #Randomly draws angles within self.angular_cut_gen region. Note: angles inside self.lat_cut_gen are still returned
         angles = np.zeros((2, num_angles))
-        angles[0,:] = np.arccos(1 - (1-np.cos(self.angular_cut_gen))*np.random.rand(num_angles))
-        angles[1,:] = 2*np.pi*np.random.rand(num_angles)
+        angles[0,:] = np.arccos(1 - (1-np.cos(self.angular_cut_gen))*self.random_uniform(num_angles))
+        angles[1,:] = 2*np.pi*self.random_uniform(num_angles)
         rotmat = np.array([[0,0,1],[0,1,0],[-1,0,0]])
         return (hp.rotator.rotateDirection(rotmat, angles)).T
         
@@ -775,27 +1356,50 @@ class aegis():
                                                              'mask_galactic_center_latitude':None, #in radians
                                                              'N_energy_bins':10,
                                                               'histogram_properties':{'Nbins':10, 'Cmax_hist': 10, 'Cmin_hist': 0, 'energy_bins_to_use':'all'}
-                                                            }):
+                                                            }, as_tensor = None):
+        #as_tensor = None returns torch tensors with the torch backend and numpy arrays otherwise
+        if as_tensor is None:
+            as_tensor = self.backend == 'torch'
 
         if (summary_properties['summary_type'] == 'energy_dependent_histogram'):
-            summary = self.get_energy_dependent_histogram(photon_info, summary_properties)
+            summary = self.get_energy_dependent_histogram(photon_info, summary_properties, as_tensor = as_tensor)
         if (summary_properties['summary_type'] == 'energy_dependent_map'):
             summary = self.get_energy_dependent_map(photon_info, summary_properties)
+            if as_tensor:
+                summary = self.summary_to_tensor(summary)
         
         return summary
+
+    def summary_to_tensor(self, summary):
+        '''
+        Converts a summary to a contiguous float32 torch tensor that can be passed directly to sbi
+        The tensor shares memory with the numpy buffer whenever the summary is already contiguous float32
+        '''
+        if isinstance(summary, torch.Tensor):
+            return summary.to(torch.float32).contiguous()
+        return torch.from_numpy(np.ascontiguousarray(summary, dtype = np.float32))
     
-    def get_energy_dependent_histogram(self, photon_info, summary_properties):
+    @instrumented_stage('get_energy_dependent_histogram')
+    def get_energy_dependent_histogram(self, photon_info, summary_properties, as_tensor = None):
         # Calculate the energy-dependent histogram given
+        if as_tensor is None:
+            as_tensor = self.backend == 'torch'
         
         if 'valid' in photon_info:
             if not photon_info['valid']:
-                return np.zeros((1, summary_properties['N_energy_bins'] * summary_properties['histogram_properties']['Nbins'])) * np.nan
+                energy_dependent_histogram = np.zeros((1, summary_properties['N_energy_bins'] * summary_properties['histogram_properties']['Nbins'])) * np.nan
+                if as_tensor:
+                    return self.summary_to_tensor(energy_dependent_histogram)
+                return energy_dependent_histogram
 
         emap = self.get_energy_dependent_map(photon_info, summary_properties)
-        energy_dependent_histogram = self.get_energy_dependent_histogram_from_map(emap, summary_properties)
+        energy_dependent_histogram = self.get_energy_dependent_histogram_from_map(emap, summary_properties, dtype = np.float32 if as_tensor else np.float64)
+        if as_tensor:
+            return self.summary_to_tensor(energy_dependent_histogram)
         
         return energy_dependent_histogram
     
+    @instrumented_stage('get_energy_dependent_map')
     def get_energy_dependent_map(self, photon_info, summary_properties):
         '''
         Given unbinned photon data, return maps with dimension npix x N_energy
@@ -849,7 +1453,7 @@ class aegis():
         
         return energy_dependent_map 
 
-    def get_energy_dependent_histogram_from_map(self, input_map, summary_properties):
+    def get_energy_dependent_histogram_from_map(self, input_map, summary_properties, dtype = np.float64):
         '''
         Takes in binned data (i.e a map with dimension N_pix x N_energy) and return a summary statistic
         '''
@@ -862,7 +1466,7 @@ class aegis():
         Cmin_hist, Cmax_hist = summary_properties['histogram_properties']['Cmin_hist'], summary_properties['histogram_properties']['Cmax_hist']
         #Cmax_hist can be array or scalar
 
-        output_summary = np.zeros((N_batch, N_bins*N_E))
+        output_summary = np.zeros((N_batch, N_bins*N_E), dtype = dtype)
         for bi in range(0,N_batch):
             summary_bi = np.zeros((N_bins, N_E))
             for ei in range(0,N_E):
@@ -883,6 +1487,7 @@ class aegis():
 
         return output_summary
     
+    @instrumented_stage('get_partial_map_summary')
     def get_partial_map_summary(self, photon_info, N_side, N_Ebins, Ebinspace = 'linear'):
         #returns a 2d array of (pix X energy) for a limited region of sky within an self.angular_cut_mask
         N_pix = 12*N_side**2
@@ -897,23 +1502,76 @@ class aegis():
         
         return partial_map
     
-    def get_roi_map_summary(self, photon_info, N_side, N_Ebins, Ebinspace = 'linear', roi_pix_i = np.array([])):
+    def get_mask_energy_bins(self, N_Ebins, Ebinspace = 'linear'):
+        # Energy bin edges of the ROI map summaries between Emin_mask and Emax_mask
+        if Ebinspace == 'linear':
+            return np.linspace(self.Emin_mask, self.Emax_mask, N_Ebins + 1)
+        elif Ebinspace == 'log':
+            return np.geomspace(self.Emin_mask + 0.1, self.Emax_mask + 0.1, N_Ebins + 1) - 0.1
+        elif Ebinspace == 'single':
+            return np.array([self.Emin_mask, self.Emax_mask])
+        raise Exception("Ebinspace must be 'linear', 'log' or 'single'")
+
+    @instrumented_stage('get_roi_map_summary')
+    def get_roi_map_summary(self, photon_info, N_side, N_Ebins, Ebinspace = 'linear', roi_pix_i = np.array([]), as_tensor = None):
         #returns a 2d array of (pix X energy) for a limited region of sky within an angular cut
+        #if photon_info is a list of photon_info dictionaries, a 3d array of (batch X pix X energy) is returned
+        #if as_tensor, the output is a contiguous float32 torch tensor sharing memory with the numpy buffer (default: torch backend only)
+        if as_tensor is None:
+            as_tensor = self.backend == 'torch'
         N_pix = 12*N_side**2
-        pix_bins = np.linspace(0, N_pix, N_pix + 1, dtype = 'int')
         if roi_pix_i.size == 0:
             roi_pix_i = self.get_roi_pix_indices(N_side)
-        if Ebinspace == 'linear':
-            Ebins = np.linspace(self.Emin_mask, self.Emax_mask, N_Ebins + 1)
-        elif Ebinspace == 'log':
-            Ebins = np.geomspace(self.Emin_mask + 0.1, self.Emax_mask + 0.1, N_Ebins + 1) - 0.1
-        elif Ebinspace == 'single':
-            Ebins = np.array([self.Emin_mask, self.Emax_mask])
-        partial_map = np.histogram2d(hp.ang2pix(N_side, photon_info['angles'][:,0], photon_info['angles'][:,1]), photon_info['energies'], bins = [pix_bins, Ebins])
+        Ebins = self.get_mask_energy_bins(N_Ebins, Ebinspace)
+        N_Ebins = Ebins.size - 1
+
+        batched = isinstance(photon_info, (list, tuple))
+        photon_info_list = photon_info if batched else [photon_info]
+        roi_map = np.zeros((len(photon_info_list), roi_pix_i.size, N_Ebins), dtype = np.float32 if as_tensor else np.float64)
+        for bi, info in enumerate(photon_info_list):
+            roi_map[bi] = self.bin_photons_in_pixels_and_energies(info, N_side, Ebins)[roi_pix_i, :]
+
+        if not batched:
+            roi_map = roi_map[0]
+        if as_tensor:
+            return self.summary_to_tensor(roi_map)
         
-        return partial_map[0][roi_pix_i, :]
+        return roi_map
+
+    def bin_photons_in_pixels_and_energies(self, photon_info, N_side, Ebins):
+        '''
+        Returns the (N_pix, N_Ebins) counts map of the photons. Equivalent to np.histogram2d over pixel and energy bins
+        (energy bins are closed on the upper edge of the last bin), but done with a single bincount
+        '''
+        N_pix = 12*N_side**2
+        N_Ebins = Ebins.size - 1
+        energies = photon_info['energies']
+        if energies.size == 0:
+            return np.zeros((N_pix, N_Ebins))
+        pixels = hp.ang2pix(N_side, photon_info['angles'][:,0], photon_info['angles'][:,1])
+        if self.backend == 'torch':
+            energies, pixels, Ebins_t = torch.as_tensor(energies), torch.as_tensor(pixels), torch.as_tensor(Ebins, dtype = torch.float64)
+            E_i = torch.searchsorted(Ebins_t, energies.to(torch.float64), right = True) - 1
+            E_i[energies == Ebins_t[-1]] = N_Ebins - 1
+            good = (E_i >= 0) & (E_i < N_Ebins)
+            counts = torch.bincount(pixels[good]*N_Ebins + E_i[good], minlength = N_pix*N_Ebins)
+            return counts.reshape((N_pix, N_Ebins)).numpy()
+        if self.backend == 'numba':
+            return aegis_kernels.bin_pixels_and_energies(pixels.astype(np.int64), np.asarray(energies, dtype = np.float64), np.asarray(Ebins, dtype = np.float64), N_pix)
+        E_i = np.searchsorted(Ebins, energies, side = 'right') - 1
+        E_i[energies == Ebins[-1]] = N_Ebins - 1
+        good = np.where(np.logical_and(E_i >= 0, E_i < N_Ebins))[0]
+        counts = np.bincount(pixels[good]*N_Ebins + E_i[good], minlength = N_pix*N_Ebins)
+        
+        return counts.reshape((N_pix, N_Ebins))
     
-    def get_counts_histogram_from_roi_map(self, roi_map, mincount, maxcount, N_countbins, countbinspace = 'linear'):
+    @instrumented_stage('get_counts_histogram_from_roi_map')
+    def get_counts_histogram_from_roi_map(self, roi_map, mincount, maxcount, N_countbins, countbinspace = 'linear', as_tensor = None):
+        #returns a 2d array of (count bin X energy), or (batch X count bin X energy) if roi_map has a leading batch dimension
+        if as_tensor is None:
+            as_tensor = self.backend == 'torch'
+        if isinstance(roi_map, torch.Tensor):
+            roi_map = roi_map.numpy()
         if countbinspace == 'linear':
             countbins = np.linspace(mincount, maxcount, N_countbins + 1)
         elif countbinspace == 'log':
@@ -956,9 +1614,43 @@ class aegis():
                 return final
 
             countbins = create_log_int_array(maxcount, N_countbins + 1)
-        hist = np.zeros((N_countbins, roi_map.shape[1]))
-        for Ei in np.arange(roi_map.shape[1]):
-            hist[:,Ei] = np.histogram(roi_map[:,Ei], bins = countbins)[0]
+
+        # Histogram every energy column (and batch) at once: values on the last edge go in the last bin, as in np.histogram
+        batched = roi_map.ndim == 3
+        if self.backend == 'torch':
+            roi_maps = torch.as_tensor(roi_map if batched else roi_map[None,:,:], dtype = torch.float64)
+            countbins_t = torch.as_tensor(countbins, dtype = torch.float64)
+            N_batch, N_E = roi_maps.shape[0], roi_maps.shape[2]
+            count_i = torch.searchsorted(countbins_t, roi_maps.contiguous(), right = True) - 1
+            count_i[roi_maps == countbins_t[-1]] = N_countbins - 1
+            good = (count_i >= 0) & (count_i < N_countbins)
+            batch_i = torch.arange(N_batch)[:,None,None].expand(roi_maps.shape)
+            E_i = torch.arange(N_E)[None,None,:].expand(roi_maps.shape)
+            flat_i = (batch_i[good]*N_countbins + count_i[good])*N_E + E_i[good]
+            hist = torch.bincount(flat_i, minlength = N_batch*N_countbins*N_E).reshape((N_batch, N_countbins, N_E)).numpy()
+            hist = hist.astype(np.float32 if as_tensor else np.float64)
+            if not batched:
+                hist = hist[0]
+            if as_tensor:
+                return self.summary_to_tensor(hist)
+            return hist
+        roi_maps = roi_map if batched else roi_map[None,:,:]
+        if self.backend == 'numba':
+            hist = aegis_kernels.histogram_columns(np.ascontiguousarray(roi_maps, dtype = np.float64), np.asarray(countbins, dtype = np.float64))
+        else:
+            N_batch, N_E = roi_maps.shape[0], roi_maps.shape[2]
+            count_i = np.searchsorted(countbins, roi_maps, side = 'right') - 1
+            count_i[roi_maps == countbins[-1]] = N_countbins - 1
+            good = np.logical_and(count_i >= 0, count_i < N_countbins)
+            batch_i, E_i = np.broadcast_to(np.arange(N_batch)[:,None,None], roi_maps.shape), np.broadcast_to(np.arange(N_E)[None,None,:], roi_maps.shape)
+            flat_i = (batch_i[good]*N_countbins + count_i[good])*N_E + E_i[good]
+            hist = np.bincount(flat_i, minlength = N_batch*N_countbins*N_E).reshape((N_batch, N_countbins, N_E))
+        hist = hist.astype(np.float32 if as_tensor else np.float64)
+
+        if not batched:
+            hist = hist[0]
+        if as_tensor:
+            return self.summary_to_tensor(hist)
             
         return hist
     
@@ -1013,6 +1705,66 @@ class aegis():
     ##########################################################################
     
 
+    def get_psf_fit_params(self, obs_info):
+        # PSF scaling parameters and King profile parameters (normal incidence, per fit energy bin) of the event type, read once per FITS file
+        key = ('psf', obs_info['psf_fits_path'], obs_info['event_type'])
+        if key not in self.irf_params:
+            with fits.open(obs_info['psf_fits_path']) as hdul:
+                scale = hdul['PSF_SCALING_PARAMS_' + obs_info['event_type']].data[0][0]
+                fit = hdul['RPSF_' + obs_info['event_type']].data[0]
+                self.irf_params[key] = {'C': np.array(scale[:-1]), 'beta': -scale[2],
+                                        'NTAIL': np.array(fit[5][7]), 'SCORE': np.array(fit[6][7]), 'STAIL': np.array(fit[7][7]),
+                                        'GCORE': np.array(fit[8][7]), 'GTAIL': np.array(fit[9][7])}
+        return self.irf_params[key]
+
+    def get_psf_x_pdf(self, psf_params, index):
+        '''
+        Returns x_vals and the normalized probabilities of the scaled PSF deviation x = x_vals[:-1] in fit energy bin index,
+        from the sum of the core and tail King profiles
+        '''
+        NTAIL = psf_params['NTAIL'][index]
+        SCORE = psf_params['SCORE'][index]
+        STAIL = psf_params['STAIL'][index]
+        GCORE = psf_params['GCORE'][index]
+        GTAIL = psf_params['GTAIL'][index]
+        FCORE = 1/(1 + NTAIL*STAIL**2/SCORE**2)
+        x_vals = 10**np.linspace(-1, 1.5, 1000) #!!!Change lower bound to -3 before software release!!!
+        kingCORE = (1/(2*np.pi*SCORE**2))*(1-(1/GCORE))*(1+(1/(2*GCORE))*(x_vals**2/SCORE**2))**(-GCORE)
+        kingTAIL = (1/(2*np.pi*STAIL**2))*(1-(1/GTAIL))*(1+(1/(2*GTAIL))*(x_vals**2/STAIL**2))**(-GTAIL)
+        PSF = FCORE*kingCORE + (1-FCORE)*kingTAIL
+        PDFx = 2*np.pi*x_vals[:-1]*PSF[:-1]*(x_vals[1:]-x_vals[:-1])
+        return x_vals, PDFx/np.sum(PDFx)
+
+    def get_edisp_fit_params(self, obs_info):
+        # Energy dispersion scaling parameters and fit parameters (normal incidence, per fit energy bin) of the event type, read once per FITS file
+        key = ('edisp', obs_info['edisp_fits_path'], obs_info['event_type'])
+        if key not in self.irf_params:
+            with fits.open(obs_info['edisp_fits_path']) as hdul:
+                fit = hdul['ENERGY DISPERSION_' + obs_info['event_type']].data[0]
+                self.irf_params[key] = {'C': np.array(hdul['EDISP_SCALING_PARAMS_' + obs_info['event_type']].data[0][0])}
+                for name, column in (('F', 4), ('S1', 5), ('K1', 6), ('BIAS1', 7), ('BIAS2', 8), ('S2', 9), ('K2', 10), ('PINDEX1', 11), ('PINDEX2', 12)):
+                    self.irf_params[key][name] = np.array(fit[column][7])
+        return self.irf_params[key]
+
+    def get_edisp_x_pdf(self, edisp_params, index):
+        '''
+        Returns x_vals and the normalized probabilities of the scaled energy deviation x = x_vals in fit energy bin index
+        '''
+        F, S1, K1, BIAS1, BIAS2, S2, K2, PINDEX1, PINDEX2 = [edisp_params[name][index] for name in ('F', 'S1', 'K1', 'BIAS1', 'BIAS2', 'S2', 'K2', 'PINDEX1', 'PINDEX2')]
+        x_vals = np.linspace(-15, 15, 1000)
+        x_low1, x_high1 = np.where(x_vals < BIAS1), np.where(x_vals >= BIAS1)
+        x_low2, x_high2 = np.where(x_vals < BIAS2), np.where(x_vals >= BIAS2)
+        g1, g2 = np.ones(1000), np.ones(1000)
+        prefac1 = PINDEX1/(S1*sp.special.gamma(1/PINDEX1))*K1/(1+K1**2)
+        prefac2 = PINDEX2/(S2*sp.special.gamma(1/PINDEX2))*K2/(1+K2**2)
+        g1[x_low1] = prefac1*np.exp(-(1/(K1*S1)*np.abs(x_vals[x_low1]-BIAS1))**PINDEX1)
+        g2[x_low2] = prefac2*np.exp(-(1/(K2*S2)*np.abs(x_vals[x_low2]-BIAS2))**PINDEX2)
+        g1[x_high1] = prefac1*np.exp(-(K1/S1*np.abs(x_vals[x_high1]-BIAS1))**PINDEX1)
+        g2[x_high2] = prefac2*np.exp(-(K2/S2*np.abs(x_vals[x_high2]-BIAS2))**PINDEX2)
+        D = F*g1 + (1-F)*g2
+        return x_vals, D/np.sum(D)
+
+    @instrumented_stage('apply_PSF')
     def apply_PSF(self, photon_info, obs_info, single_energy_psf = False, single_energy_value = None):
         '''
         Applies energy dependent Fermi PSF assuming normal incidence
@@ -1033,38 +1785,39 @@ class aegis():
             else:
                 photon_energies[:] = mean_energy
         
-        hdul = fits.open(psf_fits_path)
-        scale_hdu = 'PSF_SCALING_PARAMS_' + event_type
-        fit_hdu = 'RPSF_' + event_type
-        C = hdul[scale_hdu].data[0][0][:-1]
-        beta = -hdul[scale_hdu].data[0][0][2]
+        psf_params = self.get_psf_fit_params(obs_info)
+        C, beta = psf_params['C'], psf_params['beta']
         fit_ebins = np.linspace(0.75, 6.5, 24)
         distances = np.zeros(num_photons)
+        if self.backend == 'numba':
+            #fit bin of every photon in one pass; the drawn deviations are scaled to distances after the loop
+            fit_bin = aegis_kernels.fit_bins(np.log10(photon_energies), fit_ebins, True)
+            xs = np.zeros(num_photons)
         
         #loop over energy bins in which params are defined
         for index in range(23):
-            if index == 0:
+            if self.backend == 'numba':
+                ebin_i = np.nonzero(fit_bin == index)
+            elif index == 0:
                 ebin_i = np.where(np.log10(photon_energies)<fit_ebins[index+1])
             elif index == 22:
                 ebin_i = np.where(np.log10(photon_energies)>=fit_ebins[index])
             else:
                 ebin_i = np.where(np.logical_and(np.log10(photon_energies)>=fit_ebins[index], np.log10(photon_energies)<fit_ebins[index+1]))
-            NTAIL = hdul[fit_hdu].data[0][5][7][index]
-            SCORE = hdul[fit_hdu].data[0][6][7][index]
-            STAIL = hdul[fit_hdu].data[0][7][7][index]
-            GCORE = hdul[fit_hdu].data[0][8][7][index]
-            GTAIL = hdul[fit_hdu].data[0][9][7][index]
-            FCORE = 1/(1 + NTAIL*STAIL**2/SCORE**2)
-            x_vals = 10**np.linspace(-1, 1.5, 1000) #!!!Change lower bound to -3 before software release!!!
-            kingCORE = (1/(2*np.pi*SCORE**2))*(1-(1/GCORE))*(1+(1/(2*GCORE))*(x_vals**2/SCORE**2))**(-GCORE)
-            kingTAIL = (1/(2*np.pi*STAIL**2))*(1-(1/GTAIL))*(1+(1/(2*GTAIL))*(x_vals**2/STAIL**2))**(-GTAIL)
-            PSF = FCORE*kingCORE + (1-FCORE)*kingTAIL
-            PDFx = 2*np.pi*x_vals[:-1]*PSF[:-1]*(x_vals[1:]-x_vals[:-1])
-            x = x_vals[self.draw_from_pdf(x_vals[:-1], PDFx/np.sum(PDFx), np.size(ebin_i))]
+            x_vals, PDFx = self.get_psf_x_pdf(psf_params, index)
+            x = x_vals[self.draw_from_pdf(x_vals[:-1], PDFx, np.size(ebin_i))]
+            if self.backend == 'numba':
+                xs[ebin_i] = x
+                continue
             S_P = np.sqrt((C[0]*(photon_energies[ebin_i]/100)**(-beta))**2 + C[1]**2)
             distances[ebin_i] = 2*np.sin(x*S_P/2)
-        hdul.close()
-        rotations = 2*np.pi*np.random.random(num_photons)
+        if self.backend == 'numba':
+            distances = aegis_kernels.psf_distances(xs, photon_energies.astype(np.float64), C[0], C[1], beta)
+        if self.backend in ('torch', 'numba'):
+            obs_photon_info = copy.deepcopy(photon_info)
+            obs_photon_info['angles'] = self.displace_directions(photon_info['angles'], distances)
+            return obs_photon_info
+        rotations = 2*np.pi*self.random_uniform(num_photons)
         #create orthonormal basis for each photon direction
         parallel = hp.ang2vec(photon_info['angles'][:,0], photon_info['angles'][:,1])
         perp1angles = photon_info['angles']
@@ -1097,6 +1850,29 @@ class aegis():
          
         return obs_photon_info
     
+    def displace_directions(self, angles, distances):
+        '''
+        Moves every direction (theta, phi) by the chord length distances (as drawn in apply_PSF, 2 sin(x/2)) towards a
+        uniformly random position angle, with torch tensor ops (or the fused kernel for the numba backend). Same construction
+        as the numpy path of apply_PSF: new = cos(d) n + sin(d) (cos(rot) e_theta + sin(rot) e_phi)
+        '''
+        if self.backend == 'numba':
+            rotations = 2*np.pi*np.random.random(np.size(distances))
+            return aegis_kernels.displace_directions(np.ascontiguousarray(angles, dtype = np.float64), np.asarray(distances, dtype = np.float64), rotations)
+        angles = torch.as_tensor(angles, dtype = torch.float64)
+        d = torch.as_tensor(distances, dtype = torch.float64)
+        rotations = 2*np.pi*torch.rand(d.numel(), dtype = torch.float64)
+        sin_t, cos_t = torch.sin(angles[:,0]), torch.cos(angles[:,0])
+        sin_p, cos_p = torch.sin(angles[:,1]), torch.cos(angles[:,1])
+        cos_d, sin_d = torch.cos(d), torch.sin(d)
+        a, b = sin_d*torch.cos(rotations), sin_d*torch.sin(rotations)
+        x = cos_d*sin_t*cos_p + a*cos_t*cos_p - b*sin_p
+        y = cos_d*sin_t*sin_p + a*cos_t*sin_p + b*cos_p
+        z = cos_d*cos_t - a*sin_t
+        new_angles = torch.stack((torch.arccos(torch.clamp(z/torch.sqrt(x**2 + y**2 + z**2), -1, 1)), torch.remainder(torch.atan2(y, x), 2*np.pi)), 1)
+        return new_angles.numpy()
+
+    @instrumented_stage('apply_energy_dispersion')
     def apply_energy_dispersion(self, photon_info, obs_info, single_energy_ed = False, single_energy_value = None):
         '''
         Applies Fermi energy dispersion assuming normal incidence
@@ -1117,52 +1893,55 @@ class aegis():
             else:
                 photon_energies[:] = mean_energy
         
-        hdul = fits.open(edisp_fits_path)
-        scale_hdu = 'EDISP_SCALING_PARAMS_' + event_type
-        fit_hdu = 'ENERGY DISPERSION_' + event_type
-        C = hdul[scale_hdu].data[0][0]
+        edisp_params = self.get_edisp_fit_params(obs_info)
+        C = edisp_params['C']
         fit_ebins = np.linspace(0.75, 6.5, 24)
         differences = np.zeros(num_photons)
+        if self.backend == 'numba':
+            #fit bin of every photon in one pass (-1 below 10^0.75 MeV, where no dispersion is applied); offsets are computed after the loop
+            fit_bin = aegis_kernels.fit_bins(np.log10(photon_energies), fit_ebins, False)
+            xs = np.zeros(num_photons)
+        elif self.backend == 'torch':
+            log10_energies = torch.log10(torch.as_tensor(photon_energies, dtype = torch.float64))
+            fit_bin = torch.bucketize(log10_energies, torch.as_tensor(fit_ebins[1:-1]), right = True)
+            fit_bin[log10_energies < fit_ebins[0]] = -1
+            fit_bin = fit_bin.numpy()
+            xs = np.zeros(num_photons)
         #loop over energy bins in which params are defined
         for index in range(23):
-            if index == 0:
-                ebin_i = np.where(np.log10(photon_energies)<fit_ebins[index+1])
-            if index == 22:
-                ebin_i = np.where(np.log10(photon_energies)>=fit_ebins[index])
+            if self.backend in ('numba', 'torch'):
+                ebin_i = np.nonzero(fit_bin == index)
             else:
-                ebin_i = np.where(np.logical_and(np.log10(photon_energies)>=fit_ebins[index], np.log10(photon_energies)<fit_ebins[index+1]))
-            F = hdul[fit_hdu].data[0][4][7][index]
-            S1 = hdul[fit_hdu].data[0][5][7][index]
-            K1 = hdul[fit_hdu].data[0][6][7][index]
-            BIAS1 = hdul[fit_hdu].data[0][7][7][index]
-            BIAS2 = hdul[fit_hdu].data[0][8][7][index]
-            S2 = hdul[fit_hdu].data[0][9][7][index]
-            K2 = hdul[fit_hdu].data[0][10][7][index]
-            PINDEX1 = hdul[fit_hdu].data[0][11][7][index]
-            PINDEX2 = hdul[fit_hdu].data[0][12][7][index]
-            x_vals = np.linspace(-15, 15, 1000)
-            x_low1, x_high1 = np.where(x_vals < BIAS1), np.where(x_vals >= BIAS1)
-            x_low2, x_high2 = np.where(x_vals < BIAS2), np.where(x_vals >= BIAS2)
-            g1, g2 = np.ones(1000), np.ones(1000)
-            prefac1 = PINDEX1/(S1*sp.special.gamma(1/PINDEX1))*K1/(1+K1**2)
-            prefac2 = PINDEX2/(S2*sp.special.gamma(1/PINDEX2))*K2/(1+K2**2)
-            g1[x_low1] = prefac1*np.exp(-(1/(K1*S1)*np.abs(x_vals[x_low1]-BIAS1))**PINDEX1)
-            g2[x_low2] = prefac2*np.exp(-(1/(K2*S2)*np.abs(x_vals[x_low2]-BIAS2))**PINDEX2)
-            g1[x_high1] = prefac1*np.exp(-(K1/S1*np.abs(x_vals[x_high1]-BIAS1))**PINDEX1)
-            g2[x_high2] = prefac2*np.exp(-(K2/S2*np.abs(x_vals[x_high2]-BIAS2))**PINDEX2)
-            D = F*g1 + (1-F)*g2
-            x = x_vals[self.draw_from_pdf(x_vals[:-1], D/np.sum(D), np.size(ebin_i))]
+                if index == 0:
+                    ebin_i = np.where(np.log10(photon_energies)<fit_ebins[index+1])
+                if index == 22:
+                    ebin_i = np.where(np.log10(photon_energies)>=fit_ebins[index])
+                else:
+                    ebin_i = np.where(np.logical_and(np.log10(photon_energies)>=fit_ebins[index], np.log10(photon_energies)<fit_ebins[index+1]))
+            x_vals, D = self.get_edisp_x_pdf(edisp_params, index)
+            x = x_vals[self.draw_from_pdf(x_vals[:-1], D, np.size(ebin_i))]
+            if self.backend in ('numba', 'torch'):
+                xs[ebin_i] = x
+                continue
             E = photon_energies[ebin_i]
             theta = 0
             S_D = C[0]*np.log10(E)**2 + C[1]*np.cos(theta)**2 + C[2]*np.log10(E) + C[3]*np.cos(theta) + C[4]*np.log10(E)*np.cos(theta) + C[5]
             differences[ebin_i] = x*E*S_D
-        hdul.close()
+        if self.backend == 'numba':
+            dispersed = fit_bin >= 0
+            differences[dispersed] = aegis_kernels.edisp_offsets(xs[dispersed], photon_energies[dispersed].astype(np.float64), np.asarray(C, dtype = np.float64))
+        elif self.backend == 'torch':
+            dispersed = torch.as_tensor(fit_bin >= 0)
+            E, log10E = torch.as_tensor(photon_energies, dtype = torch.float64)[dispersed], log10_energies[dispersed]
+            S_D = C[0]*log10E**2 + C[1] + C[2]*log10E + C[3] + C[4]*log10E + C[5]
+            differences[dispersed.numpy()] = (torch.as_tensor(xs)[dispersed]*E*S_D).numpy()
         
         obs_photon_info = copy.deepcopy(photon_info)
         obs_photon_info['energies'] += differences
          
         return obs_photon_info
     
+    @instrumented_stage('apply_exposure')
     def apply_exposure(self, photon_info, obs_info):
         """Modify the generate photons to simulate a direction-dependent exposure.
 
@@ -1210,7 +1989,7 @@ class aegis():
         probabilities = 1 - exposures / self.exposure
 
         # Determine indices of removed photons randomly
-        remove_photon_indices = (probabilities > np.random.random_sample(len(probabilities)))
+        remove_photon_indices = (probabilities > self.random_uniform(len(probabilities)))
 
         # take these photons out of the photon dict
         for key, values in photon_info.items():
@@ -1222,6 +2001,7 @@ class aegis():
 
         return photon_info
     
+    @instrumented_stage('apply_mask')
     def apply_mask(self, photon_info, obs_info):
         '''
         Removes photons outside of self.angular_cut_mask, inside self.lat_cut_mask, and outside (self.Emin_mask, self.Emax_mask)
@@ -1238,16 +2018,28 @@ class aegis():
             else: # num_photons > 1
                 coords  = photon_info['angles'].T # shape (2, N)  when N > 1
 
-            keep_i = np.where(np.logical_and(hp.rotator.angdist(np.array([np.pi/2, 0]), coords) <= self.angular_cut_mask, np.abs(np.pi/2 - photon_info['angles'][:,0]) >= self.lat_cut_mask))[0]
+            if self.backend == 'torch':
+                # The Galactic center is the x axis, so the angular distance is arccos(sin(theta) cos(phi))
+                angles = torch.as_tensor(photon_info['angles'])
+                keep = (torch.arccos(torch.clamp(torch.sin(angles[:,0])*torch.cos(angles[:,1]), -1, 1)) <= self.angular_cut_mask) & (torch.abs(np.pi/2 - angles[:,0]) >= self.lat_cut_mask)
+                keep_i = torch.nonzero(keep).squeeze(1).numpy()
+            elif self.backend == 'numba':
+                keep = aegis_kernels.roi_mask(np.ascontiguousarray(photon_info['angles'], dtype = np.float64), np.asarray(photon_info['energies'], dtype = np.float64), self.angular_cut_mask, self.lat_cut_mask, self.Emin_mask, self.Emax_mask)
+                keep_i = np.nonzero(keep)[0]
+            else:
+                keep_i = np.where(np.logical_and(hp.rotator.angdist(np.array([np.pi/2, 0]), coords) <= self.angular_cut_mask, np.abs(np.pi/2 - photon_info['angles'][:,0]) >= self.lat_cut_mask))[0]
 
         keep_i = keep_i[np.where(np.logical_and(photon_info['energies'][keep_i] >= self.Emin_mask, photon_info['energies'][keep_i] <= self.Emax_mask))]
         
         obs_photon_info = copy.deepcopy(photon_info)
         obs_photon_info['angles'] = photon_info['angles'][keep_i,:]
         obs_photon_info['energies'] = photon_info['energies'][keep_i]
+        if 'batch_index' in photon_info:
+            obs_photon_info['batch_index'] = photon_info['batch_index'][keep_i]
         
         return obs_photon_info
     
+    @instrumented_stage('mock_observe')
     def mock_observe(self, photon_info, obs_info):
         #photon_info contains all information about individual photons
         #obs_info is a dictionary containing info about the observation process
@@ -1264,6 +2056,627 @@ class aegis():
         
         return obs_photon_info
 
+    def mock_observe_binned(self, photon_info, obs_info, N_side, N_Ebins, Ebinspace = 'linear', roi_pix_i = np.array([]), N_psf_Ebins = 10, psf_containment = 0.99, edisp_method = 'photon', grains = 1000, as_tensor = None):
+        '''
+        Binned alternative to get_roi_map_summary(mock_observe(photon_info, obs_info), ...). Instead of moving every photon
+        with apply_PSF, the photons are counted per (true pixel, PSF energy bin, energy bin) and each count is redistributed
+        over the ROI pixels with one multinomial draw from the cached sparse PSF kernel of its energy bin (get_psf_kernel,
+        truncated at psf_containment, N_psf_Ebins log bins over the generation range). The cost of the PSF then depends on
+        the number of occupied pixels rather than on the number of photons.
+        With edisp_method = 'matrix' the energy dispersion is also binned: the true energies are snapped to the fixed grid
+        of get_true_energy_grid (the generation energy grid for grains, which holds the energies of generated photons
+        exactly) and each count is spread over the energy bins with one multinomial draw from the cached response of its
+        grid energy (get_edisp_matrix). Map and redshifted energies move by at most half a grid step.
+        The kernels (get_psf_kernel with mask = True) only count photons landing inside the mask, for photons spread over
+        their pixel. Photons closer to the mask boundary (get_mask_boundary_distance) than the containment radius of their
+        PSF energy bin plus a pixel diameter go through mock_observe one by one instead, since for them it matters where
+        exactly they sit; so the pixels crossing the mask boundary get their counts from the per-photon path, and in the
+        other pixels only the positions of the photons inside their pixel are approximated.
+        Returns the (N_roi_pix x N_Ebins) map of get_roi_map_summary
+        '''
+        if as_tensor is None:
+            as_tensor = self.backend == 'torch'
+        if edisp_method not in ('photon', 'matrix'):
+            raise Exception("edisp_method must be 'photon' or 'matrix'")
+        if roi_pix_i.size == 0:
+            roi_pix_i = self.get_roi_pix_indices(N_side)
+        if np.any(np.isnan(photon_info['energies'])) or not obs_info['psf_fits_path'].endswith(obs_info['event_type'][:-1] + '.fits'):
+            return self.get_roi_map_summary(self.mock_observe(photon_info, obs_info), N_side, N_Ebins, Ebinspace = Ebinspace, roi_pix_i = roi_pix_i, as_tensor = as_tensor)
+        N_pix = hp.nside2npix(N_side)
+        Ebins = self.get_mask_energy_bins(N_Ebins, Ebinspace)
+        N_Ebins = Ebins.size - 1
+        psf_Ebins = np.geomspace(self.Emin_gen, self.Emax_gen, N_psf_Ebins + 1)
+
+        #photons that can reach a pixel crossing the mask boundary (within the PSF containment radius plus a pixel diameter)
+        #are observed one by one: whether they pass the mask depends on where exactly they sit, which the kernels (built for
+        #photons spread over their pixel) do not know
+        true_angles = photon_info['angles'].reshape((-1, 2))
+        psf_radii = np.array([np.interp(psf_containment, *self.get_psf_displacement_cdf(obs_info, energy)[::-1]) for energy in psf_Ebins[:-1]])
+        psf_radii += 2*hp.max_pixrad(N_side)
+        near_boundary = self.get_mask_boundary_distance(true_angles) < psf_radii[np.searchsorted(psf_Ebins[1:-1], photon_info['energies'], side = 'right')]
+        near_photon_info = {'angles': true_angles[near_boundary], 'energies': photon_info['energies'][near_boundary]}
+
+        obs_photon_info = {'angles': true_angles[~near_boundary], 'energies': photon_info['energies'][~near_boundary]}
+        obs_photon_info = self.apply_exposure(obs_photon_info, obs_info)
+        true_energies, angles = np.copy(obs_photon_info['energies']), obs_photon_info['angles'].reshape((-1, 2))
+        pix = hp.ang2pix(N_side, angles[:,0], angles[:,1])
+
+        #count the photons per (PSF energy bin, energy bin, pixel)
+        if edisp_method == 'matrix':
+            edisp_obs_info = obs_info
+            if not obs_info['edisp_fits_path'].endswith(obs_info['event_type'][:-1] + '.fits'):
+                print('!!!!WARNING!!!!\n event_type not found in given edisp_fits file\n Energy Dispersion not applied\n!!!!WARNING!!!!')
+                edisp_obs_info = None
+            #the true energies are snapped to the fixed true energy grid, whose rows are the exact responses of its energies
+            E_grid, true_Ebins = self.get_true_energy_grid(grains)
+            N_true_Ebins = E_grid.size
+            matrix = self.get_edisp_matrix(edisp_obs_info, true_Ebins, Ebins, E_grid = E_grid)
+            true_i = np.searchsorted(true_Ebins, true_energies, side = 'right') - 1
+            on_grid = (true_i >= 0) & (true_i < N_true_Ebins)
+            psf_i = np.searchsorted(psf_Ebins[1:-1], true_energies[on_grid], side = 'right')
+            true_groups, true_counts = np.unique((psf_i*N_true_Ebins + true_i[on_grid])*N_pix + pix[on_grid], return_counts = True)
+            reco_counts = self.draw_multinomial_rows(true_counts, matrix[(true_groups//N_pix) % N_true_Ebins])
+            g, E_i = np.nonzero(reco_counts)
+            counts = reco_counts[g, E_i]
+            group_pix, group_E_i, group_psf_i = true_groups[g] % N_pix, E_i, true_groups[g]//(N_pix*N_true_Ebins)
+        else:
+            energies = self.apply_energy_dispersion(obs_photon_info, obs_info)['energies']
+            E_i = np.searchsorted(Ebins, energies, side = 'right') - 1
+            E_i[energies == Ebins[-1]] = N_Ebins - 1
+            good = (E_i >= 0) & (E_i < N_Ebins) & (energies >= self.Emin_mask) & (energies <= self.Emax_mask)
+            psf_i = np.searchsorted(psf_Ebins[1:-1], true_energies[good], side = 'right')
+            groups, counts = np.unique((psf_i*N_Ebins + E_i[good])*N_pix + pix[good], return_counts = True)
+            group_pix, group_E_i, group_psf_i = groups % N_pix, (groups//N_pix) % N_Ebins, groups//(N_pix*N_Ebins)
+
+        roi_row = -np.ones(N_pix, dtype = int)
+        roi_row[roi_pix_i] = np.arange(roi_pix_i.size)
+        roi_map = np.zeros((roi_pix_i.size, N_Ebins), dtype = np.float32 if as_tensor else np.float64)
+        for psf_bin in np.unique(group_psf_i):
+            in_bin = np.nonzero(group_psf_i == psf_bin)[0]
+            kernel = self.get_psf_kernel(obs_info, N_side, np.sqrt(psf_Ebins[psf_bin]*psf_Ebins[psf_bin + 1]), roi_pix_i, containment = psf_containment, mask = True)
+            rows, g, n = self.draw_psf_transitions(kernel, group_pix[in_bin], counts[in_bin])
+            np.add.at(roi_map, (rows, group_E_i[in_bin[g]]), n)
+        if np.any(near_boundary):
+            roi_map += self.get_roi_map_summary(self.mock_observe(near_photon_info, obs_info), N_side, N_Ebins, Ebinspace = Ebinspace, roi_pix_i = roi_pix_i, as_tensor = False)
+
+        if as_tensor:
+            return self.summary_to_tensor(roi_map)
+        return roi_map
+
+    def mock_observe_batch(self, photon_infos, obs_info):
+        '''
+        mock_observe of a list of photon lists in one pass: the observation steps act on every photon independently, so the
+        photon lists are concatenated (tagged with their row in 'batch_index'), observed together and split again.
+        Photon lists with NaN energies are passed to mock_observe on their own
+        '''
+        rows = [i for i, info in enumerate(photon_infos) if not np.any(np.isnan(info['energies']))]
+        obs_photon_infos = [None if i in rows else self.mock_observe(info, obs_info) for i, info in enumerate(photon_infos)]
+        if len(rows) == 0:
+            return obs_photon_infos
+        batch_info = {'angles': np.concatenate([photon_infos[i]['angles'].reshape((-1, 2)) for i in rows]),
+                      'energies': np.concatenate([photon_infos[i]['energies'] for i in rows]),
+                      'batch_index': np.repeat(np.arange(len(rows)), [np.size(photon_infos[i]['energies']) for i in rows])}
+        obs_batch_info = self.mock_observe(batch_info, obs_info)
+        order = np.argsort(obs_batch_info['batch_index'], kind = 'stable')
+        splits = np.searchsorted(obs_batch_info['batch_index'][order], np.arange(1, len(rows)))
+        for i, row_order in zip(rows, np.split(order, splits)):
+            obs_photon_infos[i] = {'angles': obs_batch_info['angles'][row_order], 'energies': obs_batch_info['energies'][row_order]}
+        return obs_photon_infos
+
+    def simulate_batch(self, params_batch, obs_info, N_side, N_Ebins, mincount, maxcount, N_countbins, Ebinspace = 'linear', countbinspace = 'linear', grains = 1000, epsilon = 0, as_tensor = None):
+        '''
+        Runs create_sources -> generate_photons_from_sources -> mock_observe for every row of params_batch (numpy or torch,
+        N_batch x N_params) and bins all observed photon lists together into (N_batch x count bin x energy) histograms of
+        the ROI map. Populations differ in size, so sources are drawn per row; the photons are generated for all rows at
+        once (generate_photons_from_sources_batch), and the observation (mock_observe_batch) and the summaries run in one
+        pass over all rows.
+        With the torch backend the result is one float32 tensor for training
+        '''
+        if isinstance(params_batch, torch.Tensor):
+            params_batch = params_batch.detach().cpu().numpy()
+        roi_pix_i = self.get_roi_pix_indices(N_side)
+        source_infos = [self.create_sources(params, grains = grains, epsilon = epsilon) for params in params_batch]
+        photon_infos = self.generate_photons_from_sources_batch(params_batch, source_infos, grains = grains)
+        obs_photon_infos = self.mock_observe_batch(photon_infos, obs_info)
+        roi_maps = self.get_roi_map_summary(obs_photon_infos, N_side, N_Ebins, Ebinspace = Ebinspace, roi_pix_i = roi_pix_i, as_tensor = False)
+        return self.get_counts_histogram_from_roi_map(roi_maps, mincount, maxcount, N_countbins, countbinspace = countbinspace, as_tensor = as_tensor)
+
+    ##########################################################################
+    '''
+    Expected counts
+    '''
+    ##########################################################################
+
+    def get_region_coverage(self, N_side, angular_cut, lat_cut, sub_order = 3, edge_sub_order = 6):
+        '''
+        Fraction of the area of every pixel within angular_cut of the Galactic center and outside the |b| < lat_cut strip,
+        from the centers of its 4**sub_order NEST sub-pixels; the pixels found partly covered are recomputed from
+        4**edge_sub_order sub-pixels, as the PSF kernels spread their photons (get_psf_kernel).
+        Cached per (N_side, angular_cut, lat_cut, sub_order, edge_sub_order)
+        '''
+        key = (N_side, angular_cut, lat_cut, sub_order, edge_sub_order)
+        if key not in self.region_coverages:
+            coverage = np.zeros(hp.nside2npix(N_side))
+            pix_i = hp.query_disc(N_side, hp.ang2vec(np.pi/2, 0), min(angular_cut + hp.nside2resol(N_side), np.pi), inclusive = True)
+            for order in (sub_order, edge_sub_order):
+                sub_i = hp.ring2nest(N_side, pix_i)[:,None]*4**order + np.arange(4**order)[None,:]
+                theta, phi = hp.pix2ang(N_side*2**order, sub_i.ravel(), nest = True)
+                inside = (np.arccos(np.clip(np.sin(theta)*np.cos(phi), -1, 1)) <= angular_cut) & (np.abs(np.pi/2 - theta) >= lat_cut)
+                coverage[pix_i] = np.mean(inside.reshape(sub_i.shape), axis = 1)
+                pix_i = pix_i[(coverage[pix_i] > 0) & (coverage[pix_i] < 1)]
+            coverage.setflags(write = False)
+            self.region_coverages[key] = coverage
+        return self.region_coverages[key]
+
+    def get_mask_boundary_distance(self, angles):
+        '''
+        Angular distance of every direction (theta, phi) to the boundary of the mask: the angular_cut_mask circle around the
+        Galactic center or the edges of the |b| < lat_cut_mask strip, whichever is closer
+        '''
+        distance = np.full(angles.shape[0], np.inf)
+        if self.angular_cut_mask < np.pi:
+            distance = np.abs(np.arccos(np.clip(np.sin(angles[:,0])*np.cos(angles[:,1]), -1, 1)) - self.angular_cut_mask)
+        if self.lat_cut_mask > 0:
+            distance = np.minimum(distance, np.abs(np.abs(np.pi/2 - angles[:,0]) - self.lat_cut_mask))
+        return distance
+
+    def get_mean_source_spectrum(self, input_params, si, energy_vals, N_spectra = 1000):
+        '''
+        Probabilities of the photon energies energy_vals[:-1] of a point source of class si, as drawn in
+        generate_photons_from_sources. For multi-spectra classes they are averaged over N_spectra random spectra
+        '''
+        dE = energy_vals[1:] - energy_vals[:-1]
+        if self.source_class_list[si].endswith('multi_spectra'):
+            spectra = self.abun_lum_spec[si][1](energy_vals, num_spectra = N_spectra, params = input_params)
+            weights = spectra[:,:-1]*dE[None,:]
+            return np.mean(weights/np.sum(weights, axis = 1)[:,None], axis = 0)
+        spectrum = self.abun_lum_spec[si][1](energy_vals, params = input_params)
+        return spectrum[:-1]*dE/np.sum(spectrum[:-1]*dE)
+
+    def get_point_source_expected_maps(self, input_params, si, N_side, grains = 1000, N_los = 200, N_redshift_shells = 16):
+        '''
+        Expected photon counts per pixel from the point sources of class si (RL or ZL abundance), integrating the abundance
+        times the luminosity along the line of sight of every pixel center, weighted by the pixel area inside the generation region:
+        dN/dOmega = exposure/(4 pi) int ds int dL L n(r(s), L)/(1 + z), for the L below the flux cut at distance s.
+        The luminosity integral uses the (radius x luminosity) grid of draw_luminosities_and_radii (or
+        draw_luminosities_and_comoving_distances), interpolated in radius. The line of sight nodes are spaced
+        geometrically away from the point of closest approach to the Galactic center, where abundances peak.
+        Returns (redshifts, maps) with maps of shape (N_shells x N_pix): one shell at z = 0 for galactic classes,
+        N_redshift_shells shells in log(1 + z) for extragalactic classes
+        '''
+        extragalactic = self.source_class_list[si].startswith('extragalactic')
+        lums = np.geomspace(self.Lmin + 1, self.Lmax + 1, grains) - 1
+        if extragalactic:
+            z = np.geomspace(self.Zmin + 1, self.Zmax + 1, grains) - 1
+            r = self.cosmology.comoving_distance(z).value*units.Mpc.to('kpc')
+            shell_edges = np.geomspace(self.Zmin + 1, self.Zmax + 1, N_redshift_shells + 1) - 1
+        else:
+            z = np.zeros(grains)
+            r = np.geomspace(0 + 1, self.Rmax + 1, grains) - 1
+            shell_edges = np.array([0, 0])
+        #cumulative luminosity integral cum_L[i,j] = sum over L_j' < L_j of n(r_i, L_j') L_j' dL_j'
+        grid_mesh, L_mesh = np.meshgrid(z if extragalactic else r, lums[:-1], indexing = 'ij')
+        density = self.abun_lum_spec[si][0](grid_mesh, L_mesh, input_params)
+        cum_L = np.concatenate((np.zeros((grains, 1)), np.cumsum(density*L_mesh*(lums[1:] - lums[:-1])[None,:], axis = 1)), axis = 1)
+
+        N_pix = hp.nside2npix(N_side)
+        N_shells = shell_edges.size - 1
+        maps = np.zeros((N_shells, N_pix))
+        shell_weights = np.zeros(N_shells)
+        shell_redshifts = np.zeros(N_shells)
+        pixel_area = hp.nside2pixarea(N_side)
+        nodes = np.concatenate(([0], np.geomspace(1e-6, 1, N_los - 1)))
+        gen_coverage = self.get_region_coverage(N_side, self.angular_cut_gen, self.lat_cut_gen)
+        gen_pix_i = np.nonzero(gen_coverage)[0]
+        for chunk in np.array_split(gen_pix_i, max(1, gen_pix_i.size//4096)):
+            theta, phi = hp.pix2ang(N_side, chunk)
+            cos_psi = np.sin(theta)*np.cos(phi)
+            s_mid = self.GC_to_earth*cos_psi
+            half = np.sqrt(np.maximum(r[-1]**2 - self.GC_to_earth**2*(1 - cos_psi**2), 0))
+            s_low, s_high = np.maximum(s_mid - half, 0), s_mid + half
+            s_turn = np.clip(s_mid, s_low, s_high)
+            counts = np.zeros((N_shells, chunk.size))
+            #the segments before and after the closest approach, each with nodes clustered at s_turn
+            for s_start, s_end in ((s_turn, s_low), (s_turn, s_high)):
+                s = s_start[:,None] + (s_end - s_start)[:,None]*nodes[None,:]
+                radii = np.sqrt(np.maximum(s**2 + self.GC_to_earth**2 - 2*s*s_mid[:,None], 0))
+                r_i = np.clip(np.searchsorted(r, radii, side = 'right') - 1, 0, grains - 2)
+                frac = np.clip((radii - r[r_i])/(r[r_i + 1] - r[r_i]), 0, 1)
+                redshifts = np.interp(radii, r, z)
+                L_cut = self.flux_cut*4*np.pi*(1 + redshifts)*(s*units.kpc.to('cm'))**2
+                L_i = np.searchsorted(lums[:-1], L_cut, side = 'right')
+                integrand = ((1 - frac)*cum_L[r_i, L_i] + frac*cum_L[r_i + 1, L_i])*((radii >= r[0]) & (radii <= r[-1]))
+                integrand *= self.exposure/(4*np.pi*(1 + redshifts))*(pixel_area*gen_coverage[chunk])[:,None]
+                #trapezoid weights along each line of sight
+                ds = np.abs(np.diff(s, axis = 1))
+                node_weights = np.zeros(s.shape)
+                node_weights[:,1:] += ds/2
+                node_weights[:,:-1] += ds/2
+                contributions = node_weights*integrand
+                shell_i = np.clip(np.searchsorted(shell_edges, redshifts, side = 'right') - 1, 0, N_shells - 1)
+                for shell in range(N_shells):
+                    in_shell = shell_i == shell
+                    counts[shell] += np.sum(np.where(in_shell, contributions, 0), axis = 1)
+                    shell_weights[shell] += np.sum(contributions[in_shell])
+                    shell_redshifts[shell] += np.sum((contributions*redshifts)[in_shell])
+            maps[:, chunk] = counts
+        #each shell is observed at the mean redshift of its expected photons
+        shell_redshifts = np.where(shell_weights > 0, shell_redshifts/np.maximum(shell_weights, 1e-300), (shell_edges[1:] + shell_edges[:-1])/2)
+        return shell_redshifts, maps
+
+    def get_psf_displacement_cdf(self, obs_info, energy):
+        '''
+        Angular displacements delta = 2 sin(x S_P/2) applied by apply_PSF to photons of the given energy and their
+        cumulative probabilities, with the probability of each drawn x spread uniformly up to the next grid value
+        '''
+        psf_params = self.get_psf_fit_params(obs_info)
+        fit_ebins = np.linspace(0.75, 6.5, 24)
+        x_vals, PDFx = self.get_psf_x_pdf(psf_params, int(np.searchsorted(fit_ebins[1:-1], np.log10(energy), side = 'right')))
+        C, beta = psf_params['C'], psf_params['beta']
+        S_P = np.sqrt((C[0]*(energy/100)**(-beta))**2 + C[1]**2)
+        delta = np.minimum(np.maximum.accumulate(2*np.sin(np.minimum(x_vals*S_P, np.pi)/2)), np.pi)
+        return delta, np.concatenate(([0], np.cumsum(PDFx)))
+
+    def get_psf_kernel(self, obs_info, N_side, energy, roi_pix_i, containment = 0.99, mask = False, sub_order = 6, start_N_side = None):
+        '''
+        Sparse (roi_pix_i.size x N_pix, CSC) matrix of the probabilities that apply_PSF moves a photon of the given energy from
+        a pixel into each ROI pixel, for photons spread uniformly over the part of their pixel inside the generation region.
+        With start_N_side the columns are instead the pixels of that resolution, with the photons at their centers as
+        healpix_map photons are (the matrix is then roi_pix_i.size x 12*start_N_side**2). Every column is a stratified
+        sample of 4**sub_order photons (4**sub_order*(N_side/start_N_side)**2 for start_N_side, at least one): the
+        start points (the centers of the NEST sub-pixels of order sub_order, or the pixel center) share them equally,
+        and each photon is displaced by its own stratum of the PSF displacement CDF towards its own stratum of position
+        angles, with the strata shuffled by a fixed-seed generator so kernels are reproducible and do not touch the
+        simulation random numbers. Photons near the edge of their pixel thus spill into the neighbors even when the PSF is
+        smaller than a pixel. Only pixels within the containment radius of the ROI are sources. With mask = True only
+        the photons landing inside the mask (angular_cut_mask, lat_cut_mask) count: the columns are then the probabilities
+        of being observed in each ROI pixel and sum to less than one.
+        Cached per (FITS file, event type, N_side, energy, ROI, containment, mask, generation region, sub_order, start_N_side)
+        '''
+        key = (obs_info['psf_fits_path'], obs_info['event_type'], N_side, float(energy), roi_pix_i.tobytes(), containment,
+               (self.angular_cut_mask, self.lat_cut_mask) if mask else None, (self.angular_cut_gen, self.lat_cut_gen, sub_order, start_N_side))
+        if key not in self.psf_kernels:
+            delta, cdf = self.get_psf_displacement_cdf(obs_info, energy)
+            N_pix = hp.nside2npix(N_side)
+            N_samples = 4**sub_order
+            rng = np.random.default_rng(0)
+            roi_row = -np.ones(N_pix, dtype = int)
+            roi_row[roi_pix_i] = np.arange(roi_pix_i.size)
+            #pixels from which photons can reach the ROI
+            reach = min(self.angular_cut_mask + np.interp(containment, cdf, delta) + hp.nside2resol(N_side), np.pi)
+            if start_N_side is None:
+                source_pix_i = hp.query_disc(N_side, hp.ang2vec(np.pi/2, 0), reach, inclusive = True)
+                N_cols, N_points = N_pix, N_samples
+            else:
+                #the sources are the start pixels, each with a photon sample at its center (as many photons per pixel area)
+                source_pix_i = hp.query_disc(start_N_side, hp.ang2vec(np.pi/2, 0), reach, inclusive = True)
+                N_cols, N_points = hp.nside2npix(start_N_side), max(1, N_samples*N_side**2//start_N_side**2)
+            rows, cols, vals = [np.zeros(0, dtype = int)], [np.zeros(0, dtype = int)], [np.zeros(0)]
+            for chunk in np.array_split(source_pix_i, max(1, source_pix_i.size*N_points//2**20)):
+                if start_N_side is None:
+                    theta, phi = hp.pix2ang(N_side*2**sub_order, hp.ring2nest(N_side, chunk)[:,None]*N_samples + np.arange(N_samples)[None,:], nest = True)
+                    weights = (np.arccos(np.clip(np.sin(theta)*np.cos(phi), -1, 1)) <= self.angular_cut_gen) & (np.abs(np.pi/2 - theta) >= self.lat_cut_gen)
+                    weights = np.where(np.any(weights, axis = 1)[:,None], weights, True)
+                else:
+                    theta, phi = hp.pix2ang(start_N_side, chunk)
+                    theta, phi = np.repeat(theta[:,None], N_points, axis = 1), np.repeat(phi[:,None], N_points, axis = 1)
+                    weights = np.ones(theta.shape)
+                weights = weights/np.maximum(np.sum(weights, axis = 1), 1)[:,None]
+                d = np.interp(rng.permuted((np.arange(N_points)[None,:] + rng.random(theta.shape))/N_points, axis = 1), cdf, delta)
+                rotations = 2*np.pi*rng.permuted((np.arange(N_points)[None,:] + rng.random(theta.shape))/N_points, axis = 1)
+                #landing points cos(d) n + sin(d) (cos(rot) e_theta + sin(rot) e_phi), as in apply_PSF
+                a, b = np.sin(d)*np.cos(rotations), np.sin(d)*np.sin(rotations)
+                x = np.cos(d)*np.sin(theta)*np.cos(phi) + a*np.cos(theta)*np.cos(phi) - b*np.sin(phi)
+                y = np.cos(d)*np.sin(theta)*np.sin(phi) + a*np.cos(theta)*np.sin(phi) + b*np.cos(phi)
+                z = np.cos(d)*np.cos(theta) - a*np.sin(theta)
+                target = hp.vec2pix(N_side, x, y, z)
+                keep = (roi_row[target] >= 0) & (weights > 0)
+                if mask:
+                    norm = np.sqrt(x**2 + y**2 + z**2)
+                    keep &= (x/norm >= np.cos(self.angular_cut_mask)) & (np.abs(z/norm) >= np.sin(self.lat_cut_mask))
+                entries, entry_i = np.unique(np.broadcast_to(chunk[:,None], target.shape)[keep]*N_pix + target[keep], return_inverse = True)
+                rows.append(roi_row[entries % N_pix])
+                cols.append(entries//N_pix)
+                vals.append(np.bincount(entry_i, weights = weights[keep]))
+            self.psf_kernels[key] = sp.sparse.csc_matrix((np.concatenate(vals), (np.concatenate(rows), np.concatenate(cols))), shape = (roi_pix_i.size, N_cols))
+        return self.psf_kernels[key]
+
+    def draw_psf_transitions(self, kernel, source_pix, counts):
+        '''
+        Redistributes counts[g] photons from each pixel source_pix[g] over the ROI pixels with one multinomial draw per
+        pixel, using the columns of a PSF kernel from get_psf_kernel. The multinomials are drawn as sequential binomials,
+        vectorized over pixels; photons that leave the ROI are dropped.
+        Returns (ROI rows, group indices g, counts) of the nonzero transitions
+        '''
+        starts = kernel.indptr[source_pix]
+        lengths = kernel.indptr[source_pix + 1] - starts
+        remaining_n = np.array(counts, dtype = np.int64)
+        remaining_p = np.ones(remaining_n.size)
+        rows, groups, draws = [np.zeros(0, dtype = int)], [np.zeros(0, dtype = int)], [np.zeros(0, dtype = np.int64)]
+        for k in range(np.max(lengths, initial = 0)):
+            active = np.nonzero((k < lengths) & (remaining_n > 0))[0]
+            if active.size == 0:
+                break
+            entry = starts[active] + k
+            p = kernel.data[entry]
+            draw = self.draw_binomial(remaining_n[active], np.clip(p/np.maximum(remaining_p[active], 1e-300), 0, 1))
+            remaining_n[active] -= draw
+            remaining_p[active] -= p
+            moved = draw > 0
+            rows.append(kernel.indices[entry[moved]])
+            groups.append(active[moved])
+            draws.append(draw[moved])
+        return np.concatenate(rows), np.concatenate(groups), np.concatenate(draws)
+
+    def draw_multinomial_rows(self, counts, probs):
+        '''
+        One multinomial draw of counts[i] photons over the categories of probs[i,:] for every row i, as sequential binomials
+        vectorized over rows. Rows of probs may sum to less than one; the remaining photons are dropped
+        '''
+        remaining_n = np.array(counts, dtype = np.int64)
+        remaining_p = np.ones(remaining_n.size)
+        draws = np.zeros(probs.shape, dtype = np.int64)
+        for k in range(probs.shape[1]):
+            draws[:,k] = self.draw_binomial(remaining_n, np.clip(probs[:,k]/np.maximum(remaining_p, 1e-300), 0, 1))
+            remaining_n -= draws[:,k]
+            remaining_p -= probs[:,k]
+        return draws
+
+    def get_psf_beam_window(self, obs_info, energy, lmax):
+        '''
+        Beam window function b_l = <P_l(cos delta)>, l = 0..lmax, of the King-profile PSF that apply_PSF applies to photons
+        of the given energy, averaged over its discrete displacements delta. Cached per (FITS file, event type, energy, lmax)
+        '''
+        key = (obs_info['psf_fits_path'], obs_info['event_type'], float(energy), lmax)
+        if key not in self.psf_beam_windows:
+            delta, cdf = self.get_psf_displacement_cdf(obs_info, energy)
+            cos_delta, probs = np.cos(delta[:-1]), np.diff(cdf)
+            #Legendre recursion (l + 1) P_l+1 = (2l + 1) x P_l - l P_l-1
+            beam = np.zeros(lmax + 1)
+            P_prev, P_l = np.ones_like(cos_delta), cos_delta
+            beam[0] = np.sum(probs)
+            for l in range(1, lmax + 1):
+                beam[l] = np.sum(probs*P_l)
+                P_prev, P_l = P_l, ((2*l + 1)*cos_delta*P_l - l*P_prev)/(l + 1)
+            beam /= beam[0]
+            beam.setflags(write = False)
+            self.psf_beam_windows[key] = beam
+        return self.psf_beam_windows[key]
+
+    def smooth_maps_with_psf(self, maps, obs_info, energies, lmax = None):
+        '''
+        Convolves every column of the full-sky (N_pix x N_maps) RING ordered maps with the PSF at the corresponding
+        energy in energies, in spherical-harmonic space (map2alm, beam window from get_psf_beam_window, alm2map).
+        Counts are conserved and the cost depends on N_side and lmax (default 3 N_side - 1), not on the number of photons
+        '''
+        maps = np.array(maps, dtype = np.float64)
+        N_side = hp.npix2nside(maps.shape[0])
+        if lmax is None:
+            lmax = 3*N_side - 1
+        energies = np.broadcast_to(energies, (maps.shape[1],))
+        smoothed = np.zeros_like(maps)
+        for map_i in np.nonzero(np.any(maps != 0, axis = 0))[0]:
+            alm = hp.map2alm(maps[:,map_i], lmax = lmax)
+            smoothed[:,map_i] = hp.alm2map(hp.almxfl(alm, self.get_psf_beam_window(obs_info, energies[map_i], lmax)), N_side, lmax = lmax)
+        return smoothed
+
+    def get_edisp_response(self, obs_info, E_true, Ebins, cache = True):
+        '''
+        (E_true.size x N_Ebins) probabilities that a photon of true energy E_true[j] ends up in energy bin k of Ebins and
+        inside (Emin_mask, Emax_mask) after apply_energy_dispersion. Exact for its discrete x draws; photons below
+        10^0.75 MeV keep their energy. With obs_info = None the true energies are binned without dispersion.
+        Cached per (FITS file, event type, E_true, Ebins) unless cache = False (for true energies that change every call)
+        '''
+        key = (None if obs_info is None else (obs_info['edisp_fits_path'], obs_info['event_type']), E_true.tobytes(), Ebins.tobytes())
+        if key not in self.edisp_responses or not cache:
+            N_Ebins = Ebins.size - 1
+            if obs_info is None:
+                fit_bin = -np.ones(E_true.size, dtype = int)
+            else:
+                edisp_params = self.get_edisp_fit_params(obs_info)
+                C = edisp_params['C']
+                fit_bin = aegis_kernels.fit_bins(np.log10(E_true), np.linspace(0.75, 6.5, 24), False)
+            response = np.zeros((E_true.size, N_Ebins))
+            for index in np.unique(fit_bin):
+                rows = np.nonzero(fit_bin == index)[0]
+                E = E_true[rows]
+                if index < 0:
+                    reco, probs = E[:,None], np.ones((1, 1))
+                else:
+                    x_vals, D = self.get_edisp_x_pdf(edisp_params, index)
+                    S_D = C[0]*np.log10(E)**2 + C[1] + C[2]*np.log10(E) + C[3] + C[4]*np.log10(E) + C[5]
+                    reco = E[:,None] + x_vals[None,:]*E[:,None]*S_D[:,None]
+                    probs = D[None,:]
+                E_i = np.searchsorted(Ebins, reco, side = 'right') - 1
+                E_i[reco == Ebins[-1]] = N_Ebins - 1
+                inside = (E_i >= 0) & (E_i < N_Ebins) & (reco >= self.Emin_mask) & (reco <= self.Emax_mask)
+                row_i = np.broadcast_to(np.arange(rows.size)[:,None], reco.shape)
+                response[rows] = np.bincount((row_i*N_Ebins + E_i)[inside], weights = np.broadcast_to(probs, reco.shape)[inside], minlength = rows.size*N_Ebins).reshape((rows.size, N_Ebins))
+            response.setflags(write = False)
+            if not cache:
+                return response
+            self.edisp_responses[key] = response
+        return self.edisp_responses[key]
+
+    def get_true_energy_grid(self, grains = 1000):
+        '''
+        Fixed log grid of true energies with the spacing of the generation energy grid of generate_photons_from_sources
+        (grains energies over the generation range, all of which it contains), extended down to half of Emin_mask for
+        redshifted photons. Returns the grid energies and the bin edges halfway between them in log energy
+        '''
+        log_step = np.log(self.Emax_gen/self.Emin_gen)/(grains - 1)
+        N_grid = int(np.ceil(np.log(self.Emax_gen/min(self.Emin_gen, self.Emin_mask/2))/log_step - 1e-9)) + 1
+        log_grid = np.log(self.Emax_gen) - log_step*np.arange(N_grid)[::-1]
+        return np.exp(log_grid), np.exp(np.append(log_grid - log_step/2, log_grid[-1] + log_step/2))
+
+    def get_edisp_matrix(self, obs_info, true_Ebins, Ebins, N_fine = 20, spectral_index = 2, E_grid = None):
+        '''
+        (N_true_Ebins x N_Ebins) energy dispersion response matrix: the probability that a photon in true energy bin
+        [true_Ebins[t], true_Ebins[t+1]) is observed in energy bin k of Ebins and inside (Emin_mask, Emax_mask). Rows average
+        get_edisp_response over N_fine log-spaced energies per true bin, weighted by a power law E^-spectral_index.
+        The simulated photons only take discrete true energies (the lower edges of the generation energy grid, or the
+        energies of a healpix map); given those as E_grid (sorted), rows average over the grid energies inside each bin
+        instead, weighted by E^-spectral_index times the grid spacing, which matches the simulation much more closely (a bin
+        holding a single map energy is exact). Rows of bins without grid energies are zero.
+        Depends only on the FITS file, event type, bin edges and grid, and is cached. With obs_info = None there is no dispersion
+        '''
+        key = (None if obs_info is None else (obs_info['edisp_fits_path'], obs_info['event_type']), true_Ebins.tobytes(), Ebins.tobytes(), N_fine, spectral_index, None if E_grid is None else E_grid.tobytes())
+        if key not in self.edisp_matrices:
+            if E_grid is None:
+                fine_edges = np.geomspace(true_Ebins[:-1], true_Ebins[1:], N_fine + 1, axis = 1)
+                E_fine = np.sqrt(fine_edges[:,1:]*fine_edges[:,:-1])
+                weights = E_fine**(-spectral_index)*(fine_edges[:,1:] - fine_edges[:,:-1])
+                weights /= np.sum(weights, axis = 1)[:,None]
+                response = self.get_edisp_response(obs_info, E_fine.ravel(), Ebins).reshape(E_fine.shape + (Ebins.size - 1,))
+                matrix = np.sum(weights[:,:,None]*response, axis = 1)
+            else:
+                grid_i = np.searchsorted(true_Ebins[1:-1], E_grid, side = 'right')
+                weights = E_grid**(-spectral_index)*(np.gradient(E_grid) if E_grid.size > 1 else np.ones(1))
+                response = self.get_edisp_response(obs_info, E_grid, Ebins, cache = False)
+                matrix = np.zeros((true_Ebins.size - 1, Ebins.size - 1))
+                np.add.at(matrix, grid_i, weights[:,None]*response)
+                matrix /= np.maximum(np.bincount(grid_i, weights = weights, minlength = true_Ebins.size - 1), np.finfo(float).tiny)[:,None]
+            matrix.setflags(write = False)
+            self.edisp_matrices[key] = matrix
+        return self.edisp_matrices[key]
+
+    def disperse_binned_counts(self, counts, obs_info, true_Ebins, Ebins, expected = False, grains = 1000):
+        '''
+        Applies the energy dispersion to binned counts (... x N_true_Ebins) in the true energy bins true_Ebins and returns
+        (... x N_Ebins) counts in the energy bins Ebins, with the response matrix of get_edisp_matrix on the true energy
+        grid the photons take (get_true_energy_grid for grains, so true bins narrower than its step get zero rows): a
+        matrix product for expected counts, or one multinomial draw per (row, true energy bin) for integer counts
+        '''
+        matrix = self.get_edisp_matrix(obs_info, true_Ebins, Ebins, E_grid = self.get_true_energy_grid(grains)[0])
+        counts = np.asarray(counts)
+        if expected:
+            return counts @ matrix
+        flat_counts = counts.reshape((-1, counts.shape[-1]))
+        dispersed = np.zeros((flat_counts.shape[0], matrix.shape[1]), dtype = np.int64)
+        for t in np.nonzero(np.any(flat_counts > 0, axis = 0))[0]:
+            dispersed += self.draw_multinomial_rows(flat_counts[:,t], np.broadcast_to(matrix[t], dispersed.shape))
+        return dispersed.reshape(counts.shape[:-1] + (matrix.shape[1],))
+
+    def expected_map(self, input_params, obs_info, N_side, N_Ebins, Ebinspace = 'linear', roi_pix_i = np.array([]), grains = 1000, psf = True, energy_dispersion = True, N_psf_Ebins = 10, psf_containment = 0.99, psf_method = 'pixel', lmax = None, edisp_method = 'exact', N_true_Ebins = 40, N_los = 200, N_spectra = 1000, as_tensor = None):
+        '''
+        Expected (mean) counts map E[counts(pixel, energy)] of create_sources -> generate_photons_from_sources ->
+        mock_observe -> get_roi_map_summary, computed without drawing sources or photons, in the (N_roi_pix x N_Ebins)
+        layout of get_roi_map_summary. Each source class is integrated into expected counts per (true energy, pixel):
+        RL and ZL point sources along the line of sight of every pixel (get_point_source_expected_maps), isotropic
+        diffuse sources over the generation region and healpix_map sources pixel by pixel. The PSF is applied as a sparse
+        pixel kernel per PSF energy bin (N_psf_Ebins log bins over the generation range, see get_psf_kernel), or with
+        psf_method = 'harmonic' by smoothing the full-sky true counts maps in spherical-harmonic space up to lmax
+        (smooth_maps_with_psf), which is faster for large PSFs or N_side. The energy dispersion is a (true energy x energy bin)
+        response matrix, exact per true energy (get_edisp_response) or, with edisp_method = 'matrix', the cached response
+        of N_true_Ebins log true energy bins over the generation range, averaged over the true energies of each term
+        (get_edisp_matrix with E_grid). healpix_map terms are then exact while their map energies are coarser than the
+        true bins; the continuous spectra are off by their spectral shape within a bin (about 0.1% for 40 bins).
+        Sources and diffuse photons are spread uniformly over the parts of the pixels inside the generation region;
+        healpix_map photons sit at their map pixel centers. The pixel kernels (get_psf_kernel with mask = True, per map
+        N_side for healpix_map terms) follow those photons and count only the ones landing inside the mask, so the pixels
+        crossing the mask boundary are exact up to the kernel sampling. The harmonic smoothing does not see the mask: it
+        keeps the photons moved into a pixel with the mask coverage of that pixel and those left in their pixel with their
+        inside fraction, which biases pixels crossing the boundary. Approximations: the single-photon
+        source approximation (epsilon) is not modeled, and multi-spectra classes use the mean of N_spectra random spectra.
+        independent_* source classes are not supported
+        '''
+        if as_tensor is None:
+            as_tensor = self.backend == 'torch'
+        if isinstance(input_params, torch.Tensor):
+            input_params = input_params.detach().cpu().numpy()
+        N_pix = hp.nside2npix(N_side)
+        if roi_pix_i.size == 0:
+            roi_pix_i = self.get_roi_pix_indices(N_side)
+        Ebins = self.get_mask_energy_bins(N_Ebins, Ebinspace)
+        N_Ebins = Ebins.size - 1
+        if psf and not obs_info['psf_fits_path'].endswith(obs_info['event_type'][:-1] + '.fits'):
+            print('!!!!WARNING!!!!\n event_type not found in given psf_fits file\n PSF not applied\n!!!!WARNING!!!!')
+            psf = False
+        if energy_dispersion and not obs_info['edisp_fits_path'].endswith(obs_info['event_type'][:-1] + '.fits'):
+            print('!!!!WARNING!!!!\n event_type not found in given edisp_fits file\n Energy Dispersion not applied\n!!!!WARNING!!!!')
+            energy_dispersion = False
+        if psf_method not in ('pixel', 'harmonic'):
+            raise Exception("psf_method must be 'pixel' or 'harmonic'")
+        if edisp_method not in ('exact', 'matrix'):
+            raise Exception("edisp_method must be 'exact' or 'matrix'")
+        true_Ebins = np.geomspace(self.Emin_gen, self.Emax_gen, N_true_Ebins + 1)
+
+        #expected true counts as terms (true energies, counts, pixels, pixel weights, inside fractions, map N_side): counts[:,None]*pixel_weights[None,:]
+        #in the given pixels, or an (energy x pixel) counts array when pixel_weights is None. The inside fractions are the parts
+        #of those counts that lie inside the mask. healpix_map terms are given in their map pixels (map N_side), the others in the pixels
+        energy_vals = np.geomspace(self.Emin_gen, self.Emax_gen, grains)
+        photons_per_flux = self.exposure*units.kpc.to('cm')**2
+        gen_coverage = self.get_region_coverage(N_side, self.angular_cut_gen, self.lat_cut_gen)
+        gen_pix_i = np.nonzero(gen_coverage)[0]
+        overlap = self.get_region_coverage(N_side, min(self.angular_cut_gen, self.angular_cut_mask), max(self.lat_cut_gen, self.lat_cut_mask))
+        uniform_inside = overlap[gen_pix_i]/gen_coverage[gen_pix_i]
+        terms = []
+        for si in range(len(self.abun_lum_spec)):
+            source_class = self.source_class_list[si]
+            if source_class in ('isotropic_faint_multi_spectra', 'isotropic_faint_single_spectrum', 'extragalactic_isotropic_faint_multi_spectra', 'extragalactic_isotropic_faint_single_spectrum'):
+                spectrum = self.get_mean_source_spectrum(input_params, si, energy_vals, N_spectra = N_spectra)
+                redshifts, maps = self.get_point_source_expected_maps(input_params, si, N_side, grains = grains, N_los = N_los)
+                for z, shell_map in zip(redshifts, maps):
+                    terms.append((energy_vals[:-1]/(1 + z), spectrum, gen_pix_i, shell_map[gen_pix_i], uniform_inside, None))
+            elif source_class == 'isotropic_diffuse':
+                spectrum = self.abun_lum_spec[si][0](energy_vals, input_params)
+                spectrum_geometric_mean = np.sqrt(spectrum[1:]*spectrum[:-1])
+                terms.append((energy_vals[:-1], photons_per_flux*spectrum_geometric_mean*(energy_vals[1:] - energy_vals[:-1]), gen_pix_i, hp.nside2pixarea(N_side)*gen_coverage[gen_pix_i], uniform_inside, None))
+            elif source_class == 'healpix_map':
+                map_vals, map_E, map_i, map_N_side = self.abun_lum_spec[si][0](input_params)[:4]
+                dE = map_E[1:] - map_E[:-1]
+                counts = photons_per_flux*(4*np.pi/hp.nside2npix(map_N_side))*map_vals[:-1,:]*dE[:,None]*self.get_lat_cut_keep(map_N_side, map_i)[None,:]
+                #map photons sit at their map pixel centers, which are either inside or outside the mask
+                map_theta, map_phi = hp.pix2ang(map_N_side, map_i)
+                map_inside = (np.arccos(np.clip(np.sin(map_theta)*np.cos(map_phi), -1, 1)) <= self.angular_cut_mask) & (np.abs(np.pi/2 - map_theta) >= self.lat_cut_mask)
+                terms.append((np.asarray(map_E[:-1], dtype = np.float64), counts, np.asarray(map_i), None, map_inside.astype(np.float64), map_N_side))
+            else:
+                raise Exception('expected_map does not support source class ' + source_class)
+
+        #bin the true counts in energy (with dispersion) per PSF energy bin, then move them to the ROI pixels with the masked PSF
+        #kernels: one for the photons spread over the pixels, one per map for the photons at the map pixel centers
+        psf_Ebins = np.geomspace(self.Emin_gen, self.Emax_gen, N_psf_Ebins + 1)
+        mask_coverage = self.get_region_coverage(N_side, self.angular_cut_mask, self.lat_cut_mask)[roi_pix_i][:,None]
+        expected = np.zeros((roi_pix_i.size, N_Ebins))
+        for psf_bin in range(N_psf_Ebins if psf else 1):
+            true_map = np.zeros((N_pix, N_Ebins))
+            true_map_inside = np.zeros((N_pix, N_Ebins))
+            psf_energy = np.sqrt(psf_Ebins[psf_bin]*psf_Ebins[psf_bin + 1])
+            for E_true, counts, pix, pixel_weights, inside, map_N_side in terms:
+                if energy_dispersion and edisp_method == 'matrix':
+                    response = self.get_edisp_matrix(obs_info, true_Ebins, Ebins, E_grid = E_true)[np.searchsorted(true_Ebins[1:-1], E_true, side = 'right')]
+                else:
+                    response = self.get_edisp_response(obs_info if energy_dispersion else None, E_true, Ebins)
+                in_bin = np.searchsorted(psf_Ebins[1:-1], E_true, side = 'right') == psf_bin if psf else np.ones(E_true.size, dtype = bool)
+                if not np.any(in_bin):
+                    continue
+                if pixel_weights is None:
+                    binned = counts[in_bin].T @ response[in_bin]
+                    if psf and psf_method == 'pixel':
+                        map_kernel = self.get_psf_kernel(obs_info, N_side, psf_energy, roi_pix_i, containment = psf_containment, mask = True, start_N_side = map_N_side)
+                        expected += map_kernel[:,pix] @ binned
+                        continue
+                    center_pix = hp.ang2pix(N_side, *hp.pix2ang(map_N_side, pix))
+                    np.add.at(true_map, center_pix, binned)
+                    np.add.at(true_map_inside, center_pix, inside[:,None]*binned)
+                else:
+                    binned = pixel_weights[:,None]*(counts[in_bin] @ response[in_bin])[None,:]
+                    true_map[pix] += binned
+                    true_map_inside[pix] += inside[:,None]*binned
+            if psf and psf_method == 'harmonic':
+                delta, cdf = self.get_psf_displacement_cdf(obs_info, psf_energy)
+                stay = np.interp(np.sqrt(hp.nside2pixarea(N_side)/np.pi), delta, cdf)
+                smoothed = self.smooth_maps_with_psf(true_map, obs_info, psf_energy, lmax = lmax)
+                expected += mask_coverage*smoothed[roi_pix_i] + stay*(true_map_inside[roi_pix_i] - mask_coverage*true_map[roi_pix_i])
+            elif psf:
+                expected += self.get_psf_kernel(obs_info, N_side, psf_energy, roi_pix_i, containment = psf_containment, mask = True) @ true_map
+            else:
+                expected += true_map_inside[roi_pix_i]
+
+        if as_tensor:
+            return self.summary_to_tensor(expected)
+        return expected
+
     ##########################################################################
     '''
     New code for Fermi analysis
@@ -0,0 +1,254 @@
+import numpy as np
+
+'''
+Fused per-photon kernels used by aegis(backend = 'numba').
+When numba is installed every kernel is compiled (parallelized over photons or histogram columns with prange) and runs
+without the temporary arrays of the equivalent NumPy expressions; otherwise the NumPy implementation with the same
+signature and results is used. Kernels take their random numbers as inputs, so the numba backend consumes the numpy
+random stream exactly like the numpy backend.
+'''
+
+try:
+    import numba
+    from numba import prange
+    HAVE_NUMBA = True
+except ImportError:
+    HAVE_NUMBA = False
+    prange = range
+
+def compile_kernel(parallel = True):
+    # Compiles the loop implementation with numba if available, otherwise returns the NumPy fallback
+    def decorator(loop_func):
+        def select(numpy_func):
+            if HAVE_NUMBA:
+                return numba.njit(parallel = parallel, cache = True)(loop_func)
+            return numpy_func
+        return select
+    return decorator
+
+def search_left(row, value):
+    # Index of the first element of the sorted row that is >= value (np.searchsorted with side = 'left')
+    lo, hi = 0, row.size
+    while lo < hi:
+        mid = (lo + hi)//2
+        if row[mid] < value:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+def search_right(row, value):
+    # Index of the first element of the sorted row that is > value (np.searchsorted with side = 'right')
+    lo, hi = 0, row.size
+    while lo < hi:
+        mid = (lo + hi)//2
+        if row[mid] <= value:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+if HAVE_NUMBA:
+    search_left = numba.njit(cache = True)(search_left)
+    search_right = numba.njit(cache = True)(search_right)
+
+##########################################################################
+'''
+Energy draws
+'''
+##########################################################################
+
+def _searchsorted_rows_loop(a, b):
+    out = np.empty(b.size, dtype = np.int64)
+    for i in prange(b.size):
+        out[i] = search_left(a[i], b[i])
+    return out
+
+@compile_kernel()(_searchsorted_rows_loop)
+def searchsorted_rows(a, b):
+    '''
+    np.searchsorted(a[i,:], b[i]) for every row i of the 2D array a
+    '''
+    s = np.r_[0,(np.maximum(a.max(1)-a.min(1)+1,b)+1).cumsum()[:-1]]
+    return np.searchsorted((a+s[:,None]).ravel(), b+s)-np.arange(len(s))*a.shape[1]
+
+def _searchsorted_grouped_loop(cdfs, counts, rands):
+    offsets = np.zeros(counts.size + 1, dtype = np.int64)
+    for s in range(counts.size):
+        offsets[s + 1] = offsets[s] + counts[s]
+    out = np.empty(rands.size, dtype = np.int64)
+    for s in prange(counts.size):
+        for j in range(offsets[s], offsets[s + 1]):
+            out[j] = search_left(cdfs[s], rands[j])
+    return out
+
+@compile_kernel()(_searchsorted_grouped_loop)
+def searchsorted_grouped(cdfs, counts, rands):
+    '''
+    Searches the photons' random numbers in the CDF of their source: the first counts[0] values of rands in cdfs[0],
+    the next counts[1] in cdfs[1] and so on, without expanding the CDFs to one row per photon
+    '''
+    photon_sources = np.repeat(np.arange(cdfs.shape[0]), counts)
+    offsets = 2*np.arange(cdfs.shape[0])*(1 + np.max(np.abs(cdfs)))
+    return np.searchsorted((cdfs + offsets[:,None]).ravel(), rands + offsets[photon_sources]) - photon_sources*cdfs.shape[1]
+
+##########################################################################
+'''
+Instrument response
+'''
+##########################################################################
+
+def _fit_bins_loop(log10_energies, edges, clamp_low):
+    out = np.empty(log10_energies.size, dtype = np.int64)
+    inner = edges[1:-1]
+    for i in prange(log10_energies.size):
+        if not clamp_low and log10_energies[i] < edges[0]:
+            out[i] = -1
+        else:
+            out[i] = search_right(inner, log10_energies[i])
+    return out
+
+@compile_kernel()(_fit_bins_loop)
+def fit_bins(log10_energies, edges, clamp_low):
+    '''
+    Index of the instrument response fit bin of every photon. Energies above the last edge go in the last bin; below
+    the first edge they go in the first bin if clamp_low, and get -1 (no response applied) otherwise
+    '''
+    out = np.searchsorted(edges[1:-1], log10_energies, side = 'right')
+    if not clamp_low:
+        out[log10_energies < edges[0]] = -1
+    return out
+
+def _psf_distances_loop(x, energies, C0, C1, beta):
+    out = np.empty(x.size)
+    for i in prange(x.size):
+        S_P = np.sqrt((C0*(energies[i]/100)**(-beta))**2 + C1**2)
+        out[i] = 2*np.sin(x[i]*S_P/2)
+    return out
+
+@compile_kernel()(_psf_distances_loop)
+def psf_distances(x, energies, C0, C1, beta):
+    '''
+    Angular displacements of the PSF from the scaled deviations x: 2 sin(x S_P/2) with S_P = sqrt((C0 (E/100)^-beta)^2 + C1^2)
+    '''
+    S_P = np.sqrt((C0*(energies/100)**(-beta))**2 + C1**2)
+    return 2*np.sin(x*S_P/2)
+
+def _displace_directions_loop(angles, distances, rotations):
+    out = np.empty((distances.size, 2))
+    for i in prange(distances.size):
+        sin_t, cos_t = np.sin(angles[i,0]), np.cos(angles[i,0])
+        sin_p, cos_p = np.sin(angles[i,1]), np.cos(angles[i,1])
+        cos_d, sin_d = np.cos(distances[i]), np.sin(distances[i])
+        a, b = sin_d*np.cos(rotations[i]), sin_d*np.sin(rotations[i])
+        x = cos_d*sin_t*cos_p + a*cos_t*cos_p - b*sin_p
+        y = cos_d*sin_t*sin_p + a*cos_t*sin_p + b*cos_p
+        z = cos_d*cos_t - a*sin_t
+        out[i,0] = np.arccos(min(max(z/np.sqrt(x*x + y*y + z*z), -1.), 1.))
+        phi = np.arctan2(y, x)
+        out[i,1] = phi + 2*np.pi if phi < 0 else phi
+    return out
+
+@compile_kernel()(_displace_directions_loop)
+def displace_directions(angles, distances, rotations):
+    '''
+    Moves every direction (theta, phi) by distances towards the position angle rotations:
+    new = cos(d) n + sin(d) (cos(rot) e_theta + sin(rot) e_phi)
+    '''
+    sin_t, cos_t = np.sin(angles[:,0]), np.cos(angles[:,0])
+    sin_p, cos_p = np.sin(angles[:,1]), np.cos(angles[:,1])
+    cos_d, sin_d = np.cos(distances), np.sin(distances)
+    a, b = sin_d*np.cos(rotations), sin_d*np.sin(rotations)
+    x = cos_d*sin_t*cos_p + a*cos_t*cos_p - b*sin_p
+    y = cos_d*sin_t*sin_p + a*cos_t*sin_p + b*cos_p
+    z = cos_d*cos_t - a*sin_t
+    return np.array([np.arccos(np.clip(z/np.sqrt(x**2 + y**2 + z**2), -1, 1)), np.arctan2(y, x) % (2*np.pi)]).T
+
+def _edisp_offsets_loop(x, energies, C):
+    out = np.empty(x.size)
+    for i in prange(x.size):
+        log10E = np.log10(energies[i])
+        S_D = C[0]*log10E**2 + C[1] + C[2]*log10E + C[3] + C[4]*log10E + C[5]
+        out[i] = x[i]*energies[i]*S_D
+    return out
+
+@compile_kernel()(_edisp_offsets_loop)
+def edisp_offsets(x, energies, C):
+    '''
+    Energy dispersion offsets x E S_D at normal incidence, with S_D the Fermi energy dispersion scaling function
+    '''
+    log10E = np.log10(energies)
+    return x*energies*(C[0]*log10E**2 + C[1] + C[2]*log10E + C[3] + C[4]*log10E + C[5])
+
+##########################################################################
+'''
+Masks and histograms
+'''
+##########################################################################
+
+def _roi_mask_loop(angles, energies, angular_cut, lat_cut, Emin, Emax):
+    out = np.empty(energies.size, dtype = np.bool_)
+    for i in prange(energies.size):
+        distance = np.arccos(min(max(np.sin(angles[i,0])*np.cos(angles[i,1]), -1.), 1.))
+        out[i] = distance <= angular_cut and abs(np.pi/2 - angles[i,0]) >= lat_cut and energies[i] >= Emin and energies[i] <= Emax
+    return out
+
+@compile_kernel()(_roi_mask_loop)
+def roi_mask(angles, energies, angular_cut, lat_cut, Emin, Emax):
+    '''
+    Photons within angular_cut of the Galactic center (the x axis), outside the |b| < lat_cut strip and in [Emin, Emax]
+    '''
+    distance = np.arccos(np.clip(np.sin(angles[:,0])*np.cos(angles[:,1]), -1, 1))
+    return (distance <= angular_cut) & (np.abs(np.pi/2 - angles[:,0]) >= lat_cut) & (energies >= Emin) & (energies <= Emax)
+
+def _bin_pixels_and_energies_loop(pixels, energies, Ebins, N_pix):
+    N_Ebins = Ebins.size - 1
+    counts = np.zeros((N_pix, N_Ebins), dtype = np.int64)
+    for i in range(energies.size):
+        E_i = search_right(Ebins, energies[i]) - 1
+        if energies[i] == Ebins[-1]:
+            E_i = N_Ebins - 1
+        if E_i >= 0 and E_i < N_Ebins:
+            counts[pixels[i], E_i] += 1
+    return counts
+
+@compile_kernel(parallel = False)(_bin_pixels_and_energies_loop)
+def bin_pixels_and_energies(pixels, energies, Ebins, N_pix):
+    '''
+    (N_pix, N_Ebins) counts of photons per pixel and energy bin, with the last energy bin closed on its upper edge
+    '''
+    N_Ebins = Ebins.size - 1
+    E_i = np.searchsorted(Ebins, energies, side = 'right') - 1
+    E_i[energies == Ebins[-1]] = N_Ebins - 1
+    good = np.where(np.logical_and(E_i >= 0, E_i < N_Ebins))[0]
+    return np.bincount(pixels[good]*N_Ebins + E_i[good], minlength = N_pix*N_Ebins).reshape((N_pix, N_Ebins))
+
+def _histogram_columns_loop(maps, countbins):
+    N_batch, N_pix, N_E = maps.shape
+    N_bins = countbins.size - 1
+    hist = np.zeros((N_batch, N_bins, N_E), dtype = np.int64)
+    for column in prange(N_batch*N_E):
+        b, e = column//N_E, column % N_E
+        for p in range(N_pix):
+            value = maps[b,p,e]
+            i = search_right(countbins, value) - 1
+            if value == countbins[-1]:
+                i = N_bins - 1
+            if i >= 0 and i < N_bins:
+                hist[b,i,e] += 1
+    return hist
+
+@compile_kernel()(_histogram_columns_loop)
+def histogram_columns(maps, countbins):
+    '''
+    (N_batch, N_bins, N_E) histograms of the pixel values of every (batch, energy) column of maps (N_batch, N_pix, N_E),
+    with values on the last edge in the last bin as in np.histogram
+    '''
+    N_batch, N_pix, N_E = maps.shape
+    N_bins = countbins.size - 1
+    count_i = np.searchsorted(countbins, maps, side = 'right') - 1
+    count_i[maps == countbins[-1]] = N_bins - 1
+    good = np.logical_and(count_i >= 0, count_i < N_bins)
+    batch_i, E_i = np.broadcast_to(np.arange(N_batch)[:,None,None], maps.shape), np.broadcast_to(np.arange(N_E)[None,None,:], maps.shape)
+    flat_i = (batch_i[good]*N_bins + count_i[good])*N_E + E_i[good]
+    return np.bincount(flat_i, minlength = N_batch*N_bins*N_E).reshape((N_batch, N_bins, N_E))
@@ -0,0 +1,278 @@
+'''
+Microbenchmarks for the hot stages of the AEGIS simulator
+
+Every scenario builds an aegis instance for one source class and times each stage of the forward model
+(source creation, photon generation, PSF, energy dispersion, masking and the ROI summaries).
+Scenarios vary one of grains, N_side, exposure, epsilon or source class at a time around a base configuration.
+Only the bundled FERMI_files and data/ directories are used, so the suite runs offline.
+
+Usage:
+    python benchmarks/bench_aegis.py --output bench.json
+    python benchmarks/bench_aegis.py --output new.json --compare old.json
+'''
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, os.path.join(REPO_DIR, 'sources'))
+
+import aegis
+from Fermi_Bubbles import Fermi_Bubbles
+
+OBS_INFO = {'psf_fits_path': os.path.join(REPO_DIR, 'FERMI_files/psf_P8R3_ULTRACLEANVETO_V2_PSF.fits'),
+            'edisp_fits_path': os.path.join(REPO_DIR, 'FERMI_files/edisp_P8R3_ULTRACLEANVETO_V2_PSF.fits'),
+            'event_type': 'PSF3',
+            'exposure_map': None}
+
+BASE_SCENARIO = {'source_class': 'isotropic_faint_single_spectrum',
+                 'grains': 1000,
+                 'N_side': 64,
+                 'exposure': 2000*10*0.2, #cm^2 yr
+                 'epsilon': 0,
+                 'N_Ebins': 10,
+                 'N_countbins': 10}
+
+SCENARIO_VARIATIONS = {'grains': [100, 1000, 3000],
+                       'N_side': [16, 64, 256],
+                       'exposure': [2000*10*0.2, 2000*10*2],
+                       'epsilon': [0, 0.001, 0.01],
+                       'source_class': ['isotropic_faint_single_spectrum', 'isotropic_faint_multi_spectra',
+                                        'independent_spherical_single_spectrum', 'extragalactic_isotropic_faint_single_spectrum',
+                                        'isotropic_diffuse', 'healpix_map']}
+
+'''
+Source models, following the examples in AEGIS Introduction.ipynb
+'''
+
+def RL(r, l, params):
+    A = params[0]
+    r_s = 3 #kpc
+    L_b = 1e34 #photons/s
+    return A * np.exp(-r/r_s) * np.exp(-l/L_b)
+
+def ZL(z, l, params):
+    A = params[0]*1e-67
+    z_s = 1e6
+    L_b = 1e50 #photons/s
+    return A * np.exp(-z/z_s) * np.exp(-l/L_b)
+
+def R_s(r, params):
+    return params[0] * np.exp(-r/1.)
+
+def Theta_s(theta, params):
+    return np.ones(np.shape(theta))
+
+def Phi_s(phi, params):
+    return np.ones(np.shape(phi))
+
+def L(l, params):
+    L_b = 1.56e37/2.35 #photons/s
+    return np.exp(-1000*l/L_b)
+
+def spec(energy, params):
+    return np.ones(np.size(energy))
+
+def power_law_spectra(energy, num_spectra = 1, params = None):
+    indices = np.random.uniform(1.8, 2.6, num_spectra)
+    return energy[None,:]**(-indices[:,None])
+
+def isotropic_spectrum(energy, params):
+    return params[0]*1e-8*(energy/1000.)**(-2.3)
+
+def get_model(scenario):
+    '''
+    Returns (abundance_luminosity_and_spectrum entry, input_params, extra aegis kwargs) for the scenario's source class
+    '''
+    source_class = scenario['source_class']
+    if source_class == 'isotropic_faint_single_spectrum':
+        return [RL, spec], [1e-31], {}
+    if source_class == 'isotropic_faint_multi_spectra':
+        return [RL, power_law_spectra], [1e-31], {}
+    if source_class == 'independent_spherical_single_spectrum':
+        return [(R_s, Theta_s, Phi_s), L, spec], [10000], {}
+    if source_class == 'extragalactic_isotropic_faint_single_spectrum':
+        return [ZL, spec], [1], {'cosmology': 'Planck18', 'z_range': [0, 14]}
+    if source_class == 'isotropic_diffuse':
+        return [isotropic_spectrum], [1.], {}
+    if source_class == 'healpix_map':
+        bubble_map = Fermi_Bubbles(REPO_DIR).get_partial_map_source(20*np.pi/180, 1000, 150000, 30, N_side = scenario['N_side'])
+        return [bubble_map], [1.], {}
+    raise Exception('No benchmark model for source class ' + source_class)
+
+def make_aegis(scenario):
+    als, input_params, kwargs = get_model(scenario)
+    energy_range = [2000, 100000] #MeV
+    energy_range_gen = [energy_range[0]*0.5, energy_range[1]*1.5]
+    luminosity_range = 10.0**np.array([30, 37])
+    if 'cosmology' in kwargs:
+        energy_range_gen = [energy_range_gen[0], energy_range[1]*1.5*kwargs['z_range'][1]]
+        luminosity_range = 10.0**np.array([50, 70])
+    angular_cut = 10*np.pi/180
+    lat_cut = 2*np.pi/180
+    my_AEGIS = aegis.aegis([als], [scenario['source_class']], [[], []], energy_range, luminosity_range, 8.5 + 20*2, scenario['exposure'],
+                           angular_cut = angular_cut, lat_cut = lat_cut, flux_cut = 1e-9, energy_range_gen = energy_range_gen,
+                           angular_cut_gen = 1.5*angular_cut, lat_cut_gen = 0.5*lat_cut, **kwargs)
+    return my_AEGIS, input_params
+
+'''
+Timing
+'''
+
+def count_items(obj):
+    # number of sources or photons held by a stage input/output: the draw stages return (radii, luminosities,
+    # single-photon radii, ...) and count multi-photon plus single-photon sources, counts maps count their photons
+    if isinstance(obj, dict):
+        if 'energies' in obj:
+            return int(np.size(obj['energies']))
+        if 'luminosities' in obj:
+            return int(np.size(obj['luminosities']) + np.size(obj['single_p_distances']))
+    if isinstance(obj, tuple):
+        return int(np.size(obj[1]) + np.size(obj[2]))
+    if isinstance(obj, np.ndarray):
+        return int(round(float(np.sum(obj))))
+    return None
+
+def run_pipeline(my_AEGIS, input_params, scenario, stage_callback):
+    '''
+    Runs the forward model once, calling stage_callback(name, func, *args) for every stage. The draw stage gets the
+    same arguments as the call inside create_sources, so its time and source count are those of the pipeline
+    '''
+    grains, epsilon, N_side = scenario['grains'], scenario['epsilon'], scenario['N_side']
+    source_class = scenario['source_class']
+    if source_class.startswith('isotropic_faint'):
+        stage_callback('draw_luminosities_and_radii', my_AEGIS.draw_luminosities_and_radii, input_params, my_AEGIS.abun_lum_spec[0][0], grains = grains, epsilon = epsilon, roi_restricted = True, flux_truncated = True)
+    elif source_class.startswith('extragalactic'):
+        stage_callback('draw_luminosities_and_comoving_distances', my_AEGIS.draw_luminosities_and_comoving_distances, input_params, my_AEGIS.abun_lum_spec[0][0], grains = grains, epsilon = epsilon, roi_restricted = True, flux_truncated = True)
+    source_info = stage_callback('create_sources', my_AEGIS.create_sources, input_params, grains = grains, epsilon = epsilon)
+    photon_info = stage_callback('generate_photons_from_sources', my_AEGIS.generate_photons_from_sources, input_params, source_info, grains = grains)
+    photon_info = stage_callback('apply_PSF', my_AEGIS.apply_PSF, photon_info, OBS_INFO)
+    photon_info = stage_callback('apply_energy_dispersion', my_AEGIS.apply_energy_dispersion, photon_info, OBS_INFO)
+    photon_info = stage_callback('apply_mask', my_AEGIS.apply_mask, photon_info, OBS_INFO)
+    roi_pix_i = my_AEGIS.get_roi_pix_indices(N_side)
+    roi_map = stage_callback('get_roi_map_summary', my_AEGIS.get_roi_map_summary, photon_info, N_side, scenario['N_Ebins'], roi_pix_i = roi_pix_i)
+    stage_callback('get_counts_histogram_from_roi_map', my_AEGIS.get_counts_histogram_from_roi_map, roi_map, 0, 60, scenario['N_countbins'])
+
+def run_scenario(scenario, repeat = 3, seed = 0):
+    '''
+    Times each stage over repeat runs, then measures peak traced memory per stage in one extra run
+    (tracemalloc slows numpy down, so memory is never measured in the timed runs)
+    '''
+    my_AEGIS, input_params = make_aegis(scenario)
+    results = {}
+    upstream = {'count': 0}
+
+    def timed(name, func, *args, **kwargs):
+        start = time.perf_counter()
+        out = func(*args, **kwargs)
+        elapsed = time.perf_counter() - start
+        stage = results.setdefault(name, {'times_s': [], 'n_in': None, 'n_out': None, 'peak_bytes': None})
+        stage['times_s'].append(elapsed)
+        # stages taking the parameters rather than sources or photons start from the count of the stage before them
+        n_in = count_items(args[0]) if args else None
+        stage['n_in'] = upstream['count'] if n_in is None else n_in
+        stage['n_out'] = count_items(out)
+        upstream['count'] = stage['n_out']
+        return out
+
+    def traced(name, func, *args, **kwargs):
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        out = func(*args, **kwargs)
+        results[name]['peak_bytes'] = int(tracemalloc.get_traced_memory()[1] - before)
+        return out
+
+    for ri in range(repeat):
+        np.random.seed(seed + ri)
+        upstream['count'] = 0
+        run_pipeline(my_AEGIS, input_params, scenario, timed)
+
+    np.random.seed(seed)
+    tracemalloc.start()
+    try:
+        run_pipeline(my_AEGIS, input_params, scenario, traced)
+    finally:
+        tracemalloc.stop()
+
+    for stage in results.values():
+        stage['min_s'] = float(np.min(stage['times_s']))
+        stage['median_s'] = float(np.median(stage['times_s']))
+    return results
+
+def get_scenarios(axes = None):
+    # base scenario plus one-at-a-time variations along each requested axis, without duplicates
+    scenarios = [dict(BASE_SCENARIO)]
+    for axis, values in SCENARIO_VARIATIONS.items():
+        if axes and axis not in axes:
+            continue
+        for value in values:
+            scenario = dict(BASE_SCENARIO)
+            scenario[axis] = value
+            if scenario not in scenarios:
+                scenarios.append(scenario)
+    return scenarios
+
+def scenario_name(scenario):
+    return ','.join(f'{key}={scenario[key]}' for key in SCENARIO_VARIATIONS)
+
+def get_metadata():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd = REPO_DIR, capture_output = True, text = True).stdout.strip()
+    except OSError:
+        commit = ''
+    return {'commit': commit,
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'machine': platform.machine(),
+            'processor': platform.processor()}
+
+def compare(new, old):
+    # prints the ratio of median stage times (new/old) for every scenario and stage present in both runs
+    print(f"{'scenario':<90} {'stage':<42} {'old [s]':>10} {'new [s]':>10} {'ratio':>7}")
+    for name, stages in new['scenarios'].items():
+        if name not in old['scenarios']:
+            continue
+        for stage, res in stages['stages'].items():
+            if stage not in old['scenarios'][name]['stages']:
+                continue
+            t_old = old['scenarios'][name]['stages'][stage]['median_s']
+            t_new = res['median_s']
+            ratio = t_new/t_old if t_old > 0 else np.inf
+            print(f'{name:<90} {stage:<42} {t_old:>10.4f} {t_new:>10.4f} {ratio:>7.2f}')
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Benchmark the stages of the AEGIS forward model')
+    parser.add_argument('--output', default = 'aegis_benchmarks.json', help = 'JSON file the results are written to')
+    parser.add_argument('--compare', default = None, help = 'previous JSON results to compare against')
+    parser.add_argument('--repeat', type = int, default = 3, help = 'number of timed runs per scenario')
+    parser.add_argument('--axes', nargs = '*', default = None, choices = list(SCENARIO_VARIATIONS), help = 'only vary these scenario parameters')
+    parser.add_argument('--seed', type = int, default = 0)
+    args = parser.parse_args()
+
+    output = {'metadata': get_metadata(), 'scenarios': {}}
+    for scenario in get_scenarios(args.axes):
+        name = scenario_name(scenario)
+        print('running', name)
+        output['scenarios'][name] = {'scenario': scenario, 'stages': run_scenario(scenario, repeat = args.repeat, seed = args.seed)}
+        for stage, res in output['scenarios'][name]['stages'].items():
+            print(f"    {stage:<42} {res['median_s']:.4f} s  peak {res['peak_bytes']/2**20:.1f} MiB  in {res['n_in']}  out {res['n_out']}")
+
+    with open(args.output, 'w') as f:
+        json.dump(output, f, indent = 1)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(output, json.load(f))
+
+if __name__ == '__main__':
+    main()
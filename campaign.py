@@ -0,0 +1,287 @@
+import numpy as np
+import json
+import os
+import socket
+import sys
+import time
+import traceback
+
+from simulation_store import SimulationStore
+
+'''
+File-based sharded work queue for simulation campaigns spread over several processes or nodes.
+The parameter draws are split into shards. Workers claim shards by atomically creating lock files on the shared
+filesystem, simulate each shard into its own SimulationStore (which records per-simulation seeds and resumes partially
+written shards), and mark shards as done or failed. No scheduler service is needed, only a directory every worker can see.
+
+A campaign is created once:
+    Campaign.create('campaign_dir', theta, shard_size = 500)
+and every worker (on any node) then runs:
+    Campaign('campaign_dir').run_worker(aegis_simulator(my_AEGIS, obs_info, ...))
+'''
+
+class Campaign:
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, 'campaign.json')) as f:
+            self.info = json.load(f)
+        self.n_shards = self.info['n_shards']
+        self.shard_size = self.info['shard_size']
+        self.theta = np.load(os.path.join(directory, 'theta.npy'), mmap_mode = 'r')
+        self.worker_id = f'{socket.gethostname()}:{os.getpid()}'
+
+    @classmethod
+    def create(cls, directory, theta, shard_size = 1000, master_seed = 0):
+        # Writes the parameter draws and shard layout. theta can be a numpy array or torch tensor of shape (N, N_params)
+        if os.path.exists(os.path.join(directory, 'campaign.json')):
+            raise Exception('A campaign already exists in ' + directory)
+        if hasattr(theta, 'numpy'):
+            theta = theta.numpy()
+        theta = np.asarray(theta, dtype = 'float32')
+        for sub in ('locks', 'shards', 'done', 'failed'):
+            os.makedirs(os.path.join(directory, sub), exist_ok = True)
+        np.save(os.path.join(directory, 'theta.npy'), theta)
+        info = {'n_simulations': int(len(theta)),
+                'shard_size': int(shard_size),
+                'n_shards': int(np.ceil(len(theta)/shard_size)),
+                'master_seed': int(master_seed),
+                'created': time.time()}
+        write_json_atomic(os.path.join(directory, 'campaign.json'), info)
+        return cls(directory)
+
+    '''
+    Paths and shard state
+    '''
+
+    def lock_path(self, shard_i):
+        return os.path.join(self.directory, 'locks', f'shard_{shard_i:05d}.lock')
+
+    def done_path(self, shard_i):
+        return os.path.join(self.directory, 'done', f'shard_{shard_i:05d}.json')
+
+    def failed_path(self, shard_i):
+        return os.path.join(self.directory, 'failed', f'shard_{shard_i:05d}.json')
+
+    def store_path(self, shard_i):
+        return os.path.join(self.directory, 'shards', f'shard_{shard_i:05d}')
+
+    def shard_slice(self, shard_i):
+        return slice(shard_i*self.shard_size, min((shard_i + 1)*self.shard_size, self.info['n_simulations']))
+
+    def shard_seed(self, shard_i):
+        # Independent seed stream per shard, fixed by the campaign's master seed
+        return int(np.random.SeedSequence([self.info['master_seed'], shard_i]).generate_state(1)[0])
+
+    def get_attempts(self, shard_i):
+        if not os.path.exists(self.failed_path(shard_i)):
+            return 0
+        with open(self.failed_path(shard_i)) as f:
+            return json.load(f)['attempts']
+
+    def lock_is_stale(self, shard_i, stale_after):
+        # Locks are refreshed after every simulation, so an old lock belongs to a worker that died
+        try:
+            return time.time() - os.path.getmtime(self.lock_path(shard_i)) > stale_after
+        except FileNotFoundError:
+            return False
+
+    def try_claim(self, shard_i, stale_after):
+        '''
+        Atomically claims a shard by creating its lock file with O_EXCL. Stale locks are broken with an atomic rename,
+        so only one of several workers noticing the same stale lock can take the shard over
+        '''
+        lock = self.lock_path(shard_i)
+        if os.path.exists(lock) and self.lock_is_stale(shard_i, stale_after):
+            stale_lock = lock + f'.stale.{self.worker_id.replace(":", "_")}.{time.time():.0f}'
+            try:
+                os.rename(lock, stale_lock)
+                # Another worker may have replaced the stale lock between our check and the rename; hand a fresh lock back
+                if time.time() - os.path.getmtime(stale_lock) <= stale_after:
+                    try:
+                        os.link(stale_lock, lock)
+                    except FileExistsError:
+                        pass
+                    os.remove(stale_lock)
+                    return False
+            except FileNotFoundError:
+                pass
+        try:
+            fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'worker': self.worker_id, 'claimed': time.time()}, f)
+        return True
+
+    def owns_lock(self, shard_i):
+        try:
+            with open(self.lock_path(shard_i)) as f:
+                return json.load(f)['worker'] == self.worker_id
+        except (FileNotFoundError, ValueError):
+            return False
+
+    def release(self, shard_i):
+        # Only remove the lock if it is still ours; another worker may have taken over a lock it judged stale
+        if self.owns_lock(shard_i):
+            try:
+                os.remove(self.lock_path(shard_i))
+            except FileNotFoundError:
+                pass
+
+    '''
+    Workers
+    '''
+
+    def run_shard(self, shard_i, simulator, verbose = False):
+        store = SimulationStore(self.store_path(shard_i), chunk_size = self.shard_size)
+        lock = self.lock_path(shard_i)
+        def heartbeat_simulator(params):
+            x = simulator(params)
+            if not self.owns_lock(shard_i):
+                raise LockLost(f'lock on shard {shard_i} was taken over by another worker')
+            os.utime(lock)
+            return x
+        start = time.time()
+        n_before = len(store)
+        store.simulate(heartbeat_simulator, self.theta[self.shard_slice(shard_i)], master_seed = self.shard_seed(shard_i))
+        sim_times = store.load('time')
+        write_json_atomic(self.done_path(shard_i), {'worker': self.worker_id,
+                                                    'n_simulations': len(store),
+                                                    'n_simulated_here': len(store) - n_before,
+                                                    'start': start,
+                                                    'end': time.time(),
+                                                    'simulation_time_s': float(np.sum(sim_times)),
+                                                    'attempts': self.get_attempts(shard_i) + 1})
+        if verbose:
+            print(f'{self.worker_id} finished shard {shard_i} ({len(store) - n_before} simulations in {time.time() - start:.1f}s)')
+
+    def run_worker(self, simulator, max_attempts = 3, stale_after = 3600, verbose = True):
+        '''
+        Claims and simulates shards until none are left. A shard whose simulator raises is released and retried
+        (by this or any other worker) until it has failed max_attempts times. Partially simulated shards resume where they stopped.
+        stale_after is the number of seconds without progress after which another worker's lock is considered dead;
+        it must be longer than a single simulation. Returns the list of shards this worker finished
+        '''
+        finished = []
+        while True:
+            claimed = None
+            for shard_i in range(self.n_shards):
+                if os.path.exists(self.done_path(shard_i)) or self.get_attempts(shard_i) >= max_attempts:
+                    continue
+                if self.try_claim(shard_i, stale_after):
+                    if os.path.exists(self.done_path(shard_i)):
+                        # finished by another worker between the check above and the claim
+                        self.release(shard_i)
+                        continue
+                    claimed = shard_i
+                    break
+            if claimed is None:
+                break
+            try:
+                self.run_shard(claimed, simulator, verbose = verbose)
+                finished.append(claimed)
+            except LockLost:
+                # Another worker now owns the shard and resumes it from the store; this is not a failure of the shard
+                if verbose:
+                    print(f'!!!!WARNING!!!!\n {self.worker_id} lost the lock on shard {claimed}\n!!!!WARNING!!!!')
+            except Exception:
+                attempts = self.get_attempts(claimed) + 1
+                write_json_atomic(self.failed_path(claimed), {'attempts': attempts,
+                                                              'worker': self.worker_id,
+                                                              'time': time.time(),
+                                                              'traceback': traceback.format_exc()})
+                if verbose:
+                    print(f'!!!!WARNING!!!!\n {self.worker_id} failed shard {claimed} (attempt {attempts} of {max_attempts})\n{traceback.format_exc()}')
+            finally:
+                self.release(claimed)
+        if verbose:
+            self.print_status(max_attempts)
+        return finished
+
+    '''
+    Progress and results
+    '''
+
+    def status(self, max_attempts = 3):
+        # Aggregate progress, throughput (simulations per second of campaign wall time) and ETA
+        done, failed, running, pending = [], [], [], []
+        simulations_done = 0
+        records = []
+        for shard_i in range(self.n_shards):
+            if os.path.exists(self.done_path(shard_i)):
+                done.append(shard_i)
+                with open(self.done_path(shard_i)) as f:
+                    records.append(json.load(f))
+                simulations_done += records[-1]['n_simulations']
+                continue
+            if os.path.exists(os.path.join(self.store_path(shard_i), 'manifest.json')):
+                simulations_done += len(SimulationStore(self.store_path(shard_i)))
+            if self.get_attempts(shard_i) >= max_attempts:
+                failed.append(shard_i)
+            elif os.path.exists(self.lock_path(shard_i)):
+                running.append(shard_i)
+            else:
+                pending.append(shard_i)
+
+        remaining = self.info['n_simulations'] - simulations_done
+        throughput = np.nan
+        if records:
+            start = min(r['start'] for r in records)
+            elapsed = max(time.time() if running else max(r['end'] for r in records), start) - start
+            if elapsed > 0:
+                throughput = simulations_done/elapsed
+        eta = remaining/throughput if throughput > 0 else np.nan
+        return {'n_shards': self.n_shards,
+                'done': done,
+                'running': running,
+                'pending': pending,
+                'failed': failed,
+                'simulations_done': int(simulations_done),
+                'simulations_remaining': int(remaining),
+                'throughput_per_s': float(throughput),
+                'eta_s': float(eta),
+                'mean_simulation_time_s': float(np.sum([r['simulation_time_s'] for r in records])/max(np.sum([r['n_simulated_here'] for r in records]), 1))}
+
+    def print_status(self, max_attempts = 3):
+        s = self.status(max_attempts)
+        print(f"shards: {len(s['done'])} done, {len(s['running'])} running, {len(s['pending'])} pending, {len(s['failed'])} failed (of {s['n_shards']})")
+        print(f"simulations: {s['simulations_done']} done, {s['simulations_remaining']} remaining")
+        print(f"throughput: {s['throughput_per_s']:.3g} simulations/s, ETA: {s['eta_s']/3600:.3g} h")
+
+    def load_tensors(self, columns = ('theta', 'x')):
+        # Concatenates the finished shards in shard order
+        import torch
+        shards = [SimulationStore(self.store_path(shard_i)) for shard_i in range(self.n_shards) if os.path.exists(self.done_path(shard_i))]
+        return tuple(torch.from_numpy(np.concatenate([store.load(column) for store in shards])) for column in columns)
+
+class LockLost(Exception):
+    pass
+
+def aegis_simulator(my_AEGIS, obs_info, N_side, N_Ebins, mincount, maxcount, N_countbins, Ebinspace = 'linear', countbinspace = 'linear', grains = 1000, epsilon = 0):
+    '''
+    The standard AEGIS forward model as a simulator for campaigns and stores:
+    create_sources -> generate_photons_from_sources -> mock_observe -> get_roi_map_summary -> get_counts_histogram_from_roi_map
+    Returns the flattened (count bin x energy bin) histogram as float32
+    '''
+    roi_pix_i = my_AEGIS.get_roi_pix_indices(N_side)
+    def simulator(params):
+        if hasattr(params, 'numpy'):
+            params = params.numpy()
+        source_info = my_AEGIS.create_sources(params, grains = grains, epsilon = epsilon)
+        photon_info = my_AEGIS.generate_photons_from_sources(params, source_info, grains = grains)
+        obs_photon_info = my_AEGIS.mock_observe(photon_info, obs_info)
+        roi_map = my_AEGIS.get_roi_map_summary(obs_photon_info, N_side, N_Ebins, Ebinspace = Ebinspace, roi_pix_i = roi_pix_i)
+        summary = my_AEGIS.get_counts_histogram_from_roi_map(roi_map, mincount, maxcount, N_countbins, countbinspace = countbinspace)
+        return summary.flatten().astype('float32')
+    return simulator
+
+def write_json_atomic(path, obj):
+    tmp_path = f'{path}.{socket.gethostname()}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(obj, f, indent = 1)
+    os.replace(tmp_path, path)
+
+if __name__ == '__main__':
+    # python campaign.py <campaign directory> prints the progress of a campaign
+    Campaign(sys.argv[1]).print_status()
@@ -0,0 +1,209 @@
+import numpy as np
+import torch
+import json
+import os
+import time
+
+'''
+Append-only, memory-mapped on-disk store of simulated (theta, x) training sets.
+Each column (parameters, summaries, seeds and simulation times) is kept as a sequence of fixed-size .npy chunks
+that are written row by row through np.memmap. A small JSON manifest records how many rows are complete; it is
+committed once per batch of rows, so an interrupted run resumes from the last commit (rows after it are simulated again
+with the same seeds). A finished store is read back without deserializing it into RAM: as one memory map per chunk,
+or row by row through SimulationDataset for training sets too large to concatenate.
+'''
+
+class SimulationStore:
+
+    def __init__(self, directory, chunk_size = 10000):
+        #directory holding the manifest and column chunks. An existing store is reopened and its chunk size is kept
+        self.directory = directory
+        self.manifest_path = os.path.join(directory, 'manifest.json')
+        os.makedirs(directory, exist_ok = True)
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                self.manifest = json.load(f)
+        else:
+            self.manifest = {'chunk_size': int(chunk_size), 'n_rows': 0, 'columns': {}, 'master_seed': None}
+            self.write_manifest()
+        self.chunk_size = self.manifest['chunk_size']
+        self.n_written = self.manifest['n_rows']
+        self.open_chunks = {}
+
+    def __len__(self):
+        return self.manifest['n_rows']
+
+    def write_manifest(self):
+        # The manifest is replaced atomically, so it never describes rows that were not fully written
+        tmp_path = self.manifest_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.manifest, f, indent = 1)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.manifest_path)
+
+    def chunk_path(self, column, chunk_i):
+        return os.path.join(self.directory, f'{column}_{chunk_i:05d}.npy')
+
+    def define_columns(self, theta, x):
+        self.manifest['columns'] = {'theta': {'dtype': 'float32', 'shape': list(np.shape(theta))},
+                                    'x': {'dtype': 'float32', 'shape': list(np.shape(x))},
+                                    'seed': {'dtype': 'int64', 'shape': []},
+                                    'time': {'dtype': 'float64', 'shape': []}}
+        self.write_manifest()
+
+    def get_writable_chunk(self, column, chunk_i):
+        key = (column, chunk_i)
+        if key not in self.open_chunks:
+            # Only the chunk currently being filled is kept open for writing
+            for other in [k for k in self.open_chunks if k[1] != chunk_i]:
+                self.open_chunks.pop(other).flush()
+            path = self.chunk_path(column, chunk_i)
+            info = self.manifest['columns'][column]
+            if os.path.exists(path):
+                self.open_chunks[key] = np.lib.format.open_memmap(path, mode = 'r+')
+            else:
+                self.open_chunks[key] = np.lib.format.open_memmap(path, mode = 'w+', dtype = info['dtype'], shape = (self.chunk_size, *info['shape']))
+        return self.open_chunks[key]
+
+    def append(self, theta, x, seed = -1, sim_time = np.nan, commit = True):
+        '''
+        Appends one simulation. theta and x may be numpy arrays or torch tensors and are stored as float32.
+        With commit = False the row is written but only counted in the manifest at the next commit()
+        '''
+        theta, x = to_numpy(theta), to_numpy(x)
+        if not self.manifest['columns']:
+            self.define_columns(theta, x)
+        for column, value in (('theta', theta), ('x', x)):
+            if list(np.shape(value)) != self.manifest['columns'][column]['shape']:
+                raise ValueError(f'{column} has shape {np.shape(value)}, but the store holds {column} of shape {tuple(self.manifest["columns"][column]["shape"])}')
+
+        chunk_i, row_i = divmod(self.n_written, self.chunk_size)
+        for column, value in (('theta', theta), ('x', x), ('seed', seed), ('time', sim_time)):
+            self.get_writable_chunk(column, chunk_i)[row_i] = value
+        self.n_written += 1
+        if commit:
+            self.commit()
+
+    def commit(self):
+        # Flushes the written rows to disk, then records them in the manifest
+        if self.n_written == self.manifest['n_rows']:
+            return
+        for chunk in self.open_chunks.values():
+            chunk.flush()
+        self.manifest['n_rows'] = self.n_written
+        self.write_manifest()
+
+    def close(self):
+        self.commit()
+        for chunk in self.open_chunks.values():
+            chunk.flush()
+        self.open_chunks = {}
+
+    '''
+    Simulating into the store
+    '''
+
+    def get_seeds(self, num_simulations, master_seed):
+        # Per-simulation seeds depend only on the master seed and the simulation index, so resumed runs reuse them
+        if self.manifest['master_seed'] is None:
+            self.manifest['master_seed'] = int(master_seed)
+            self.write_manifest()
+        elif self.manifest['master_seed'] != master_seed:
+            raise ValueError(f'Store was created with master seed {self.manifest["master_seed"]}, not {master_seed}')
+        return np.random.SeedSequence(master_seed).generate_state(num_simulations, dtype = np.uint32).astype('int64')
+
+    def simulate(self, simulator, theta, master_seed = 0, verbose = False, commit_every = 100):
+        '''
+        Runs simulator(theta[i]) for every row of theta that is not yet in the store and appends the results, committing
+        the manifest every commit_every rows. numpy and torch are seeded per simulation, so rerunning after an interruption
+        continues from the last commit and reproduces the same simulations.
+        '''
+        theta = to_numpy(theta)
+        seeds = self.get_seeds(len(theta), master_seed)
+        n_done = len(self)
+        if n_done > len(theta):
+            raise ValueError(f'Store already holds {n_done} simulations, more than the {len(theta)} parameter sets given')
+        if n_done > 0 and not np.allclose(self.load('theta')[:n_done], theta[:n_done].astype('float32')):
+            raise ValueError('Parameters in the store do not match the first rows of theta, refusing to resume')
+
+        for i in range(n_done, len(theta)):
+            np.random.seed(seeds[i])
+            torch.manual_seed(int(seeds[i]))
+            start = time.perf_counter()
+            x = simulator(theta[i])
+            self.append(theta[i], x, seed = seeds[i], sim_time = time.perf_counter() - start, commit = (i + 1 - n_done) % commit_every == 0)
+            if verbose and (i + 1) % 100 == 0:
+                print(f'{i + 1}/{len(theta)} simulations stored')
+        self.close()
+
+    def simulate_for_sbi(self, simulator, proposal, num_simulations, master_seed = 0, verbose = False, commit_every = 100):
+        '''
+        Resumable counterpart of sbi's simulate_for_sbi. The parameters are drawn from proposal with a torch generator
+        seeded by master_seed, so a resumed run draws the same parameters. simulator receives a 1D torch tensor.
+        Returns a SimulationDataset of (theta, x) rows read from the memory-mapped chunks, which never loads the whole
+        training set into RAM; load_tensors() gives (theta, x) tensors for sets that fit in memory
+        '''
+        torch.manual_seed(master_seed)
+        theta = proposal.sample((num_simulations,))
+        self.simulate(lambda params: simulator(torch.as_tensor(params)), theta, master_seed = master_seed, verbose = verbose, commit_every = commit_every)
+        return self.dataset()
+
+    '''
+    Reading the store
+    '''
+
+    def load_chunks(self, column):
+        # Copy-on-write memory maps of every chunk that holds complete rows, trimmed to the stored rows
+        n_rows = len(self)
+        chunks = []
+        for chunk_i in range(int(np.ceil(n_rows/self.chunk_size))):
+            chunk = np.load(self.chunk_path(column, chunk_i), mmap_mode = 'c')
+            chunks.append(chunk[:min(self.chunk_size, n_rows - chunk_i*self.chunk_size)])
+        return chunks
+
+    def load(self, column):
+        '''
+        Returns the column as one array. This is a zero-copy memory map only when the store fits in a single chunk;
+        otherwise the chunks are concatenated into RAM (one memcpy, no parsing). Use load_chunks or dataset() for
+        stores larger than memory
+        '''
+        chunks = self.load_chunks(column)
+        if len(chunks) == 0:
+            info = self.manifest['columns'].get(column, {'dtype': 'float32', 'shape': []})
+            return np.zeros((0, *info['shape']), dtype = info['dtype'])
+        if len(chunks) == 1:
+            return chunks[0]
+        return np.concatenate(chunks)
+
+    def load_tensors(self, columns = ('theta', 'x')):
+        # torch tensors of the requested columns, e.g. theta, x = store.load_tensors() for inference.append_simulations.
+        # Memory-mapped for single-chunk stores, concatenated copies otherwise (see load)
+        return tuple(torch.from_numpy(self.load(column)) for column in columns)
+
+    def load_tensor_chunks(self, column):
+        # Zero-copy torch views of the column, one per chunk
+        return [torch.from_numpy(chunk) for chunk in self.load_chunks(column)]
+
+    def dataset(self, columns = ('theta', 'x')):
+        # torch Dataset reading rows straight from the memory-mapped chunks, for training sets too large to concatenate
+        return SimulationDataset(self, columns)
+
+class SimulationDataset(torch.utils.data.Dataset):
+
+    def __init__(self, store, columns = ('theta', 'x')):
+        self.chunk_size = store.chunk_size
+        self.n_rows = len(store)
+        self.chunks = [store.load_chunks(column) for column in columns]
+
+    def __len__(self):
+        return self.n_rows
+
+    def __getitem__(self, index):
+        chunk_i, row_i = divmod(index, self.chunk_size)
+        return tuple(torch.from_numpy(np.array(chunks[chunk_i][row_i])) for chunks in self.chunks)
+
+def to_numpy(value):
+    if isinstance(value, torch.Tensor):
+        return value.detach().cpu().numpy()
+    return np.asarray(value)
@@ -1,37 +1,68 @@
 import torch
 import numpy as np
 import scipy.interpolate as interp
+import hashlib
+import os
 import pdb
 
 class DMsignal:
     def __init__(self, directory, channel):
         self.channel = channel
         self.backFile = directory + 'AtProduction_gammas.dat'
-        self.all_data = np.genfromtxt(self.backFile, names = True)
+        self.all_data = self.load_table(self.backFile)
         self.mass_MeV = 0.
+        self.spectrum_interps = {}
+
+    def load_table(self, table_file):
+        '''
+        Returns the spectra table as a structured array. Parsing the text table is slow, so the first load writes a binary
+        copy (table_file with .npy suffix) next to it, together with the sha256 of the text table it was built from.
+        Later loads memory-map the binary copy, so processes share the same pages. If the checksum does not match
+        the text table is parsed again, and if the directory is not writable the parsed table is used without caching
+        '''
+        cache_file = os.path.splitext(table_file)[0] + '.npy'
+        checksum_file = cache_file + '.sha256'
+        with open(table_file, 'rb') as f:
+            checksum = hashlib.sha256(f.read()).hexdigest()
+        if os.path.exists(cache_file) and os.path.exists(checksum_file):
+            with open(checksum_file) as f:
+                if f.read().strip() == checksum:
+                    return np.load(cache_file, mmap_mode = 'r')
+
+        all_data = np.genfromtxt(table_file, names = True)
+        tmp_suffix = f'.{os.getpid()}.tmp'
+        try:
+            with open(cache_file + tmp_suffix, 'wb') as f:
+                np.save(f, all_data)
+            with open(checksum_file + tmp_suffix, 'w') as f:
+                f.write(checksum)
+            # The table is replaced before its checksum, so a reader never validates a partially written table
+            os.replace(cache_file + tmp_suffix, cache_file)
+            os.replace(checksum_file + tmp_suffix, checksum_file)
+        except OSError:
+            print('!!!!WARNING!!!!\n could not write DM spectra cache to ' + cache_file + '\n!!!!WARNING!!!!')
+            for tmp_file in (cache_file + tmp_suffix, checksum_file + tmp_suffix):
+                if os.path.exists(tmp_file):
+                    os.remove(tmp_file)
+            return all_data
+        return np.load(cache_file, mmap_mode = 'r')
         
+    def get_spectrum_interpolator(self, channel):
+        # Create an interpolation object (RectBivariateSpline) that interpolates the
+        # DM annihilation table of a channel in log10(mass) and log10(x) over the full
+        # mass range. It is built once per channel and reused for every mass
+        if channel not in self.spectrum_interps:
+            log10mass = np.log10(self.all_data['mDM'])
+            num_unique_mass = len(np.unique(log10mass))
+            log10mass_table = np.reshape(log10mass, (num_unique_mass, -1))
+            log10x_table = np.reshape(self.all_data['Log10x'], (num_unique_mass, -1))
+            dNdlog10x_table = np.reshape(self.all_data[channel], (num_unique_mass, -1))
+            self.spectrum_interps[channel] = interp.RectBivariateSpline(log10mass_table[:,0], log10x_table[0,:], dNdlog10x_table)
+        return self.spectrum_interps[channel]
+
     def set_spectrum_interpolator(self, channel, mass_MeV):
-        # Create an interpolation object (RectBivariateSpline) that
-        # interpolates the DM annihilation table in mass and energy
-        
-        # Restrict table to a range around the mass of the dark matter particle
-        # all this may not be necessary - could maybe just use the full table
-        # when constructing the interpolator.  
-        mass_GeV = mass_MeV/1000.
-        if type(mass_GeV) == type(torch.tensor([])):
-            near_desired_mass = np.where((self.all_data['mDM'] > 0.5*mass_GeV.numpy()) & (self.all_data['mDM'] < 2.0*mass_GeV.numpy()))[0]
-        else:
-            near_desired_mass = np.where((self.all_data['mDM'] > 0.5*mass_GeV) & (self.all_data['mDM'] < 2.0*mass_GeV))[0]
-        mass_inrange = self.all_data['mDM'][near_desired_mass]
-        log10x_inrange = self.all_data['Log10x'][near_desired_mass]
-        dNdlog10x_inrange = self.all_data[channel][near_desired_mass]
-        num_unique_mass = len(np.unique(mass_inrange))
-        num_unique_x =  int(len(dNdlog10x_inrange)/num_unique_mass)
-        log10x_table = np.reshape(log10x_inrange, (num_unique_mass,num_unique_x))
-        mass_table = np.reshape(mass_inrange, (num_unique_mass,num_unique_x))
-        dNdlog10x_table = np.reshape(dNdlog10x_inrange, (num_unique_mass,num_unique_x))
-        interp_func = interp.RectBivariateSpline(mass_table[:,0], log10x_table[0,:], dNdlog10x_table)
-        self.spectrum_interp = interp_func
+        self.spectrum_interp = self.get_spectrum_interpolator(channel)
+        self.channel = channel
         self.mass_MeV = mass_MeV
         
     def get_raw_data(self, channel, mass_MeV):
@@ -40,17 +71,26 @@ class DMsignal:
         return mass_MeV*10**self.all_data['Log10x'][i], self.all_data[channel][i]/(10**self.all_data['Log10x'][i]*np.log(10.))/mass_MeV
 
     def get_dNdE(self, desired_E_MeV, channel, mass_MeV):
-        #If the mass or channel is different from what we have stored
-        #then we need to re-initialize the spectrum interpolator
-        if (self.channel != channel or self.mass_MeV != mass_MeV):
-            self.set_spectrum_interpolator(channel, mass_MeV)
-            
-        x_input = desired_E_MeV/mass_MeV
-        mass_GeV = mass_MeV/1000.
+        '''
+        dN/dE (MeV^-1) per annihilation. desired_E_MeV and mass_MeV can be scalars, numpy arrays or torch tensors.
+        A scalar mass returns an array shaped like desired_E_MeV; an array of N_m masses returns (N_m, N_E),
+        one spectrum per mass, evaluated in a single call
+        '''
+        if isinstance(desired_E_MeV, torch.Tensor):
+            desired_E_MeV = desired_E_MeV.detach().cpu().numpy()
+        if isinstance(mass_MeV, torch.Tensor):
+            mass_MeV = mass_MeV.detach().cpu().numpy()
+        desired_E_MeV = np.asarray(desired_E_MeV, dtype = float)
+        mass_MeV = np.asarray(mass_MeV, dtype = float)
+        if mass_MeV.ndim > 0:
+            desired_E_MeV = np.ravel(desired_E_MeV)[None,:]
+            mass_MeV = np.ravel(mass_MeV)[:,None]
+        spectrum_interp = self.get_spectrum_interpolator(channel)
         
         desired_x = desired_E_MeV/mass_MeV
         desired_log10x = np.log10(desired_x)
-        dNdlog10x = self.spectrum_interp.ev(mass_GeV, desired_log10x)
+        log10mass_GeV = np.broadcast_to(np.log10(mass_MeV/1000.), desired_log10x.shape)
+        dNdlog10x = spectrum_interp.ev(log10mass_GeV, desired_log10x)
         dNdx = dNdlog10x/(desired_x*np.log(10.))
         dNdE_MeV = dNdx/mass_MeV
         return np.where(desired_E_MeV > mass_MeV, 0, dNdE_MeV)
@@ -8,123 +8,254 @@ from astropy.io import fits
 from astropy import wcs
 import healpy as hp
 import csv
+import hashlib
+import os
+import scipy.sparse
+
+'''
+Data products (parsed data files, interpolators, masks, reprojection and interpolation weights) are memoized once per
+process in data_products and shared by every FermiBackgrounds instance, including those used inside aegis source callables.
+Cached arrays are read-only; copy them before modifying.
+'''
+data_products = {}
 
 class FermiBackgrounds:
     
-    def __init__(self, fermi_data_path):
+    def __init__(self, fermi_data_path, cache_dir = None):
         #directory that holds Fermi data
         self.path = fermi_data_path
+        #directory where derived products (e.g. reprojection matrices) are cached between processes
+        if cache_dir is None:
+            cache_dir = self.path + '/data/FermiData/cache'
+        self.cache_dir = cache_dir
+        self.iso_file = self.path + '/data/FermiData/iso_P8R3_SOURCE_V3_v1.txt'
+        self.diffuse_file = self.path + '/data/FermiData/gll_iem_v07.fits'
+
+    def cached(self, key, compute):
+        # Returns data_products[key], calling compute() the first time the key is requested in this process
+        if key not in data_products:
+            product = compute()
+            if isinstance(product, np.ndarray):
+                product.setflags(write = False)
+            data_products[key] = product
+        return data_products[key]
                    
     def get_isotropic_background_spectrum(self):
-        # cm−2 s−1 sr−1 MeV−1
-        backFile = self.path + '/data/FermiData/iso_P8R3_SOURCE_V3_v1.txt'
-        with open(backFile, "r") as archive:
-            reader = csv.reader(archive, delimiter=' ')
-            e = []
-            dnde = []
-            for row in reader:
-                e.append(float(row[0]))
-                dnde.append(float(row[1]))
-        return np.array(e), np.array(dnde)        
+        # cm−2 s−1 sr−1 MeV−1, parsed once per process
+        def load():
+            with open(self.iso_file, "r") as archive:
+                reader = csv.reader(archive, delimiter=' ')
+                e = []
+                dnde = []
+                for row in reader:
+                    e.append(float(row[0]))
+                    dnde.append(float(row[1]))
+            e, dnde = np.array(e), np.array(dnde)
+            e.setflags(write = False)
+            dnde.setflags(write = False)
+            return e, dnde
+        return self.cached(('isotropic_spectrum', self.iso_file), load)
 
     def get_isotropic_background_spectrum_func(self):
-        ee, dnde = self.get_isotropic_background_spectrum()
         #should maybe use logarithmic interpolation here?
-        return interpolate.interp1d(ee, dnde)
+        return self.cached(('isotropic_spectrum_func', self.iso_file), lambda: interpolate.interp1d(*self.get_isotropic_background_spectrum()))
 
     def get_mean_isotropic_flux(self, Emin, Emax):
         # Do integral over energy to get total flux in cm-2 s-1 sr-1
+        return self.get_isotropic_band_fluxes(np.array([Emin, Emax]))[0]
+
+    def get_isotropic_band_fluxes(self, E_edges):
+        '''
+        Isotropic flux (cm-2 s-1 sr-1) integrated over every band between consecutive E_edges, in one vectorized call.
+        Each band uses the same 200-point log-spaced trapezoid rule as get_mean_isotropic_flux
+        '''
+        E_edges = np.asarray(E_edges, dtype = float)
+        def compute():
+            dnde_func = self.get_isotropic_background_spectrum_func()
+            e = np.geomspace(E_edges[:-1], E_edges[1:], 200)
+            de = e[1:] - e[:-1]
+            dnde = dnde_func(e)
+            return np.sum(0.5*de*(dnde[1:] + dnde[:-1]), axis = 0)
+        return self.cached(('isotropic_band_fluxes', self.iso_file, E_edges.tobytes()), compute)
+
+    def get_isotropic_diffuse_spectrum(self, param_index = 0):
+        '''
+        Spectrum callable for an aegis 'isotropic_diffuse' source: params[param_index] times the Fermi isotropic spectrum
+        (cm−2 s−1 sr−1 MeV−1). The data file is only read once per process
+        '''
         dnde_func = self.get_isotropic_background_spectrum_func()
-        e = np.geomspace(Emin, Emax, 200)
-        de = e[1:] - e[:-1]
-        dnde = dnde_func(e)
-        total_flux = np.sum(0.5*de*(dnde[1:] + dnde[:-1]))
-        return total_flux        
+        def spectrum(energy, params):
+            return params[param_index]*dnde_func(energy)
+        return spectrum
+
+    def get_partial_nonistropic_map_source(self, angular_cut, Emin, Emax, N_Ebins, N_side = 64, param_index = 0):
+        '''
+        Map callable for an aegis 'healpix_map' source: params[param_index] times the partial Galactic diffuse model.
+        The map is computed once and only rescaled per call, so the callable returns its arguments as map_key and aegis
+        reuses one sampling table for every parameter
+        '''
+        vals, energies, pix_i = self.get_partial_nonistropic_background(angular_cut, Emin, Emax, N_Ebins, N_side = N_side)
+        map_key = ('partial_nonistropic_map', self.diffuse_file, angular_cut, Emin, Emax, N_Ebins, N_side)
+        def healpix_map(params):
+            return params[param_index]*vals, energies, pix_i, N_side, map_key
+        return healpix_map
     
     def get_nonistropic_background(self, N_side = 64):
-        bg_file = self.path + '/data/FermiData/gll_iem_v07.fits'
-        bg_data = fits.open(bg_file)
-        w = wcs.WCS(bg_data[0].header)
-        dims = bg_data[0].shape
-        N_energy = dims[0]
-        N_pix = 12*N_side**2
-        map_all = np.zeros((N_energy, N_pix))
-        for ri in range(0,dims[1]):
-            cols = np.arange(0,dims[2])
-            coord = w.pixel_to_world(cols, ri,0)
-            l, b = coord[0].l.deg, coord[0].b.deg
-            good = np.where(np.isfinite(l))
-            vals_good = bg_data[0].data[:,ri,good]
+        # Full-sky Galactic diffuse model: every HEALPix pixel is the mean of the CAR pixels whose centers fall in it
+        with fits.open(self.diffuse_file, memmap = True) as bg_data:
+            dims = bg_data[0].shape
+            N_energy = dims[0]
+            reprojection = self.get_CAR_to_healpix_matrix(bg_data[0].header, dims, N_side)
+            cube = bg_data[0].data.reshape((N_energy, dims[1]*dims[2]))
+            map_all = np.asarray((reprojection @ cube.T).T, dtype = float)
+            energies = np.copy(bg_data[1].data['energy'])
+        return {'galactic_bg':map_all, 'energies_MeV':energies}
+
+    def get_CAR_to_healpix_matrix(self, header, dims, N_side):
+        '''
+        Sparse (N_pix, N_lat*N_lon) matrix averaging the CAR pixels of a map cube into HEALPix pixels.
+        The matrix depends only on the WCS and N_side, so it is built once and cached on disk in self.cache_dir
+        '''
+        w = wcs.WCS(header).celestial
+        key = hashlib.sha1((w.to_header_string() + str(dims[1:]) + str(N_side)).encode()).hexdigest()[:16]
+        if ('car_to_healpix', key) in data_products:
+            return data_products[('car_to_healpix', key)]
+        cache_file = self.cache_dir + f'/car_to_healpix_nside{N_side}_{key}.npz'
+        if os.path.exists(cache_file):
+            matrix = scipy.sparse.load_npz(cache_file)
+        else:
+            N_lat, N_lon = dims[1], dims[2]
+            N_pix = 12*N_side**2
+            cols, rows = np.meshgrid(np.arange(N_lon), np.arange(N_lat))
+            l, b = w.pixel_to_world_values(cols.ravel(), rows.ravel())
+            good = np.where(np.logical_and(np.isfinite(l), np.isfinite(b)))[0]
             pix_indices = hp.ang2pix(N_side, l[good], b[good], lonlat = True)
-            unique_pix = np.unique(pix_indices)
-            for ui in range(0,len(unique_pix)):
-                match = np.where(pix_indices == unique_pix[ui])[0]
-                #average over all pixels falling into this healpix pixel        
-                map_all[:,unique_pix[ui]] = np.mean((vals_good[:,0,:])[:,match], axis = 1)
-        return {'galactic_bg':map_all, 'energies_MeV':np.copy(bg_data[1].data['energy'])}
+            counts = np.bincount(pix_indices, minlength = N_pix)
+            matrix = scipy.sparse.csr_matrix((1./counts[pix_indices], (pix_indices, good)), shape = (N_pix, N_lat*N_lon))
+            try:
+                os.makedirs(self.cache_dir, exist_ok = True)
+                tmp_file = cache_file[:-4] + f'.{os.getpid()}.tmp.npz'
+                scipy.sparse.save_npz(tmp_file, matrix)
+                os.replace(tmp_file, cache_file)
+            except OSError:
+                print('!!!!WARNING!!!!\n could not write reprojection cache to ' + self.cache_dir + '\n!!!!WARNING!!!!')
+        data_products[('car_to_healpix', key)] = matrix
+        return matrix
     
     def get_partial_nonistropic_background(self, angular_cut, Emin, Emax, N_Ebins, N_side = 64):
-        file = self.path + '/data/FermiData/gll_iem_v07.fits'
-        hdul = fits.open(file)
-        energy = np.concatenate(hdul['ENERGIES'].data)
-        data = np.concatenate((hdul['PRIMARY'].data[:,:,1440:], hdul['PRIMARY'].data[:,:,:-1440]), axis=2)
-        data = np.flip(data, axis = 2)
-        data = np.concatenate((data, data[:,:, 0:1]), axis=2)
-        data = data.T
+        '''
+        Galactic diffuse model inside angular_cut of the Galactic center, linearly interpolated in lon, lat and energy
+        at the HEALPix pixel centers. The cube is memory mapped and only the entries needed for the interpolation are read.
+        The interpolation weights are cached per (angular_cut, N_side, energies)
+        '''
+        output_energies = np.linspace(Emin, Emax, N_Ebins + 1)
+        cube, energy = self.get_diffuse_cube()
+        key = ('partial_map_weights', self.diffuse_file, angular_cut, N_side, output_energies.tobytes())
+        planes, energy_weights, lat_i, lon_i, spatial_weights, close_pix_i = self.cached(key, lambda: self.get_partial_map_interpolation_weights(angular_cut, N_side, output_energies, cube.shape, energy))
+
+        # One gather of the 4 spatial corners on every needed energy plane, then one weighted sum over corners and planes
+        corners = cube[planes[:,None,None], lat_i[None,:,:], lon_i[None,:,:]]
+        vals = energy_weights @ np.sum(spatial_weights[None,:,:]*corners, axis = 1)
+        return vals, output_energies, close_pix_i
+
+    def get_diffuse_cube(self):
+        # Memory-mapped Galactic diffuse cube (N_E, N_lat, N_lon) and its energies, opened once per process
+        def load():
+            hdul = fits.open(self.diffuse_file, memmap = True)
+            return hdul['PRIMARY'].data, np.concatenate(hdul['ENERGIES'].data).astype(float)
+        return self.cached(('diffuse_cube', self.diffuse_file), load)
+
+    def get_partial_map_interpolation_weights(self, angular_cut, N_side, output_energies, cube_shape, energy):
+        '''
+        Trilinear interpolation weights of the pixel centers inside angular_cut.
+        The cube is stored with longitude decreasing from 180 deg; interpolation is done on a grid with longitude
+        increasing from 0 to 360 deg (the first column repeated at 360 deg), so grid column k is cube column (N_lon - 1 + N_lon/2 - k) % N_lon
+        '''
+        N_E, N_lat, N_lon = cube_shape
+        lon = np.linspace(0, 360, N_lon + 1)
+        lat = np.linspace(-90, 90, N_lat)
         center = hp.ang2vec(np.pi/2, 0)
         close_pix_i = hp.query_disc(N_side, center, angular_cut)
-        lon = np.linspace(0, 360, 2881)
-        lat = np.linspace(-90, 90, 1441)
-        npix = int(hp.nside2npix(N_side))
         angs_lon, angs_lat = hp.pix2ang(N_side, close_pix_i, lonlat=True)
-        output_energies = np.linspace(Emin, Emax, N_Ebins + 1)
-        vals = np.zeros((N_Ebins + 1, close_pix_i.size))
-        for ei, e in enumerate(output_energies):
-            angs_engs = np.array([angs_lon, angs_lat, e*np.ones(close_pix_i.size)]).T
-            vals[ei, :] = interpolate.interpn((lon, lat, energy), data, angs_engs)
-        return vals, output_energies, close_pix_i
+        if np.any(output_energies < energy[0]) or np.any(output_energies > energy[-1]):
+            raise ValueError('One of the requested energies is out of bounds of the Galactic diffuse model')
+
+        # Spatial corners and weights, shape (4, N_pix)
+        lon_0 = np.clip(np.searchsorted(lon, angs_lon, side = 'right') - 1, 0, N_lon - 1)
+        lat_0 = np.clip(np.searchsorted(lat, angs_lat, side = 'right') - 1, 0, N_lat - 2)
+        lon_frac = (angs_lon - lon[lon_0])/(lon[lon_0 + 1] - lon[lon_0])
+        lat_frac = (angs_lat - lat[lat_0])/(lat[lat_0 + 1] - lat[lat_0])
+        grid_lon_i = np.array([lon_0, lon_0 + 1, lon_0, lon_0 + 1])
+        lat_i = np.array([lat_0, lat_0, lat_0 + 1, lat_0 + 1])
+        spatial_weights = np.array([(1 - lon_frac)*(1 - lat_frac), lon_frac*(1 - lat_frac), (1 - lon_frac)*lat_frac, lon_frac*lat_frac])
+        lon_i = (N_lon - 1 + N_lon//2 - grid_lon_i) % N_lon
+
+        # Energy weights, shape (N_output_energies, N_planes), over only the planes that are needed
+        E_0 = np.clip(np.searchsorted(energy, output_energies, side = 'right') - 1, 0, N_E - 2)
+        E_frac = (output_energies - energy[E_0])/(energy[E_0 + 1] - energy[E_0])
+        planes = np.unique(np.concatenate((E_0, E_0 + 1)))
+        energy_weights = np.zeros((output_energies.size, planes.size))
+        energy_weights[np.arange(output_energies.size), np.searchsorted(planes, E_0)] += 1 - E_frac
+        energy_weights[np.arange(output_energies.size), np.searchsorted(planes, E_0 + 1)] += E_frac
+
+        return planes, energy_weights, lat_i, lon_i, spatial_weights, close_pix_i
 
     def get_masked_isotropic_flux(self, galactic_bg_file, gal_lat_cut, gal_cent_cut, Emin, Emax):
 
-        # Load galactic background model
-        import pickle as pk
-        gal_bg_data = pk.load(open(galactic_bg_file,'rb'))
+        # Load galactic background model (once per file)
+        gal_bg_data = self.load_galactic_bg_file(galactic_bg_file)
 
         # Galactic maps for each energy
         map_all = gal_bg_data['galactic_bg']
         N_pix = map_all.shape[1]
         N_side = hp.npix2nside(N_pix)
         
-        # Sum galactic model over energies
+        # Sum galactic model over energies: interpolation and trapezoid rule are linear in the map,
+        # so the energy integral of every pixel is one product with a quadrature weight vector
         E_cents = gal_bg_data['energies_MeV']
-        E_fine = np.exp(np.linspace(np.log(Emin), np.log(Emax), num = 200))
-        dE_fine = E_fine[1:] - E_fine[:-1]
-
-        gal_bg_map = np.zeros(N_pix)
-        for ii in range(0,N_pix):
-            #if (ii % 10000 == 0):
-            #    print(ii)
-            ff = interpolate.interp1d(E_cents, map_all[:,ii])
-            to_integrate = ff(E_fine)
-            gal_bg_map[ii] = np.sum(0.5*dE_fine*(to_integrate[1:] + to_integrate[:-1]))
+        weights = self.get_energy_quadrature_weights(E_cents, Emin, Emax)
 
         # Isotropic background model
         mean_iso_bg_flux = self.get_mean_isotropic_flux(Emin, Emax)
 
-        # Total background model
-        total_model = gal_bg_map + mean_iso_bg_flux
-
         # Get mask
         mask = self.get_mask(N_side, gal_lat_cut, gal_cent_cut)
         
-        # Our final estimate is mean over unmasked region
+        # Our final estimate is mean of the total background model over unmasked region
         in_mask = np.where(mask == 1)[0]
-        flux_estimate = np.mean(total_model[in_mask])
+        gal_bg_map = weights @ map_all[:, in_mask]
+        flux_estimate = np.mean(gal_bg_map + mean_iso_bg_flux)
 
         return flux_estimate
 
-    
+    def load_galactic_bg_file(self, galactic_bg_file):
+        # Pickled output of get_nonistropic_background, reloaded only if the file changes
+        import pickle as pk
+        def load():
+            with open(galactic_bg_file, 'rb') as f:
+                return pk.load(f)
+        return self.cached(('galactic_bg_file', galactic_bg_file, os.path.getmtime(galactic_bg_file)), load)
+
+    def get_energy_quadrature_weights(self, E_cents, Emin, Emax):
+        '''
+        Weights w such that w @ values(E_cents) is the trapezoid integral from Emin to Emax (200 log-spaced points)
+        of the linear interpolation of values(E_cents)
+        '''
+        def compute():
+            E_fine = np.exp(np.linspace(np.log(Emin), np.log(Emax), num = 200))
+            dE_fine = E_fine[1:] - E_fine[:-1]
+            trapezoid = np.zeros(E_fine.size)
+            trapezoid[1:] += 0.5*dE_fine
+            trapezoid[:-1] += 0.5*dE_fine
+            interpolation_matrix = interpolate.interp1d(E_cents, np.eye(np.size(E_cents)), axis = 0)(E_fine)
+            return trapezoid @ interpolation_matrix
+        return self.cached(('quadrature_weights', np.asarray(E_cents).tobytes(), Emin, Emax), compute)
+
     def get_mask(self, N_side, gal_lat_cut, gal_cent_cut):
+        # Masks are cached per (N_side, gal_lat_cut, gal_cent_cut) and returned read-only
+        return self.cached(('mask', N_side, gal_lat_cut, gal_cent_cut), lambda: self.compute_mask(N_side, gal_lat_cut, gal_cent_cut))
+
+    def compute_mask(self, N_side, gal_lat_cut, gal_cent_cut):
         N_pix = hp.nside2npix(N_side)
     
         # Mask that combines galactic latitude cut and galactic center cut
@@ -15,23 +15,49 @@ class Fermi_Bubbles:
         self.path = data_path
         spectrum_data = np.loadtxt(self.path + '/data/Fermi_Bubbles/1005_5480_fig14_whole_bubble.csv', delimiter=',', skiprows=1)
         self.spectrum = self.get_interpolated_spectrum(spectrum_data[:,0], spectrum_data[:,1])
+        self.template = None
+        self.roi_templates = {}
 
     def get_interpolated_spectrum(self, data_x, data_y):
         dNdE = data_y/data_x**2/1e3 #flux/Mev
         f = interpolate.interp1d(np.log10(data_x*1e3), np.log10(dNdE), fill_value = 'extrapolate')
         return lambda e: 10**f(np.log10(e))
         
+    def get_template(self):
+        # Memory-mapped full-sky bubble template, with its normalization computed once
+        if self.template is None:
+            data = np.load(self.path + '/data/Fermi_Bubbles/template_bub.npy', mmap_mode = 'r')
+            self.template = (data, np.sum(data)*(4*np.pi/data.size))
+        return self.template
+
+    def get_roi_template(self, angular_cut, N_side):
+        # Template interpolated onto the pixels within angular_cut of the Galactic center and normalized per sr, cached per (angular_cut, N_side)
+        key = (angular_cut, N_side)
+        if key not in self.roi_templates:
+            data, normalization = self.get_template()
+            center = hp.ang2vec(np.pi/2, 0)
+            close_pix_i = hp.query_disc(N_side, center, angular_cut)
+            angs = hp.pix2ang(N_side, close_pix_i)
+            raw_map = hp.get_interp_val(data, angs[0], angs[1])/normalization
+            raw_map.setflags(write = False)
+            close_pix_i.setflags(write = False)
+            self.roi_templates[key] = (raw_map, close_pix_i)
+        return self.roi_templates[key]
+        
     def get_partial_map(self, angular_cut, Emin, Emax, N_Ebins, N_side = 64):
-        file = self.path + '/data/Fermi_Bubbles/template_bub.npy'
-        data = np.load(file)
-        center = hp.ang2vec(np.pi/2, 0)
-        close_pix_i = hp.query_disc(N_side, center, angular_cut)
-        npix = int(hp.nside2npix(N_side))
-        angs = hp.pix2ang(N_side, close_pix_i)
-        raw_map = hp.get_interp_val(data, angs[0], angs[1])
+        raw_map, close_pix_i = self.get_roi_template(angular_cut, N_side)
         output_energies = np.linspace(Emin, Emax, N_Ebins + 1)
-        vals = np.zeros((N_Ebins + 1, close_pix_i.size))
-        for ei, e in enumerate(output_energies):
-            normalization = self.spectrum(e)/(4*np.pi/data.size)/np.sum(data)
-            vals[ei, :] = raw_map*normalization
-        return vals, output_energies, close_pix_i
\ No newline at end of file
+        vals = self.spectrum(output_energies)[:,None]*raw_map[None,:]
+        return vals, output_energies, close_pix_i
+
+    def get_partial_map_source(self, angular_cut, Emin, Emax, N_Ebins, N_side = 64, param_index = 0):
+        '''
+        Map callable for an aegis 'healpix_map' source: params[param_index] times the partial bubble map. The map is
+        computed once and only rescaled per call, so the callable returns its arguments as map_key and aegis reuses one
+        sampling table for every parameter
+        '''
+        vals, energies, pix_i = self.get_partial_map(angular_cut, Emin, Emax, N_Ebins, N_side = N_side)
+        map_key = ('partial_bubble_map', self.path, angular_cut, Emin, Emax, N_Ebins, N_side)
+        def healpix_map(params):
+            return params[param_index]*vals, energies, pix_i, N_side, map_key
+        return healpix_map
@@ -1,5 +1,7 @@
 import numpy as np
 import healpy as hp
+import os
+import scipy.interpolate as interpolate
 
 class smoothDM():
 
@@ -11,6 +13,8 @@ class smoothDM():
         self.halo_dist = kwargs['halo_dist']
         self.Rs = kwargs['Rs']
         self.set_mass_func(kwargs['mass_func'])
+        self.geometries = {}
+        self.J_emulator = None
 
     def get_pixels(self):
         pix_i = np.linspace(0, self.N_pix-1, self.N_pix, dtype = 'int')
@@ -19,22 +23,103 @@ class smoothDM():
 
         return close_pix_i
 
+    def get_los_geometry(self, pix):
+        '''
+        Galactocentric radius r at the start of every line-of-sight step (N_pix x N_steps) and the step lengths dl,
+        cached per (N_side, theta_cutoff, halo_dist, Rs) and pixel set since only the halo parameters change between calls
+        '''
+        key = (self.N_side, self.theta_cutoff, self.halo_dist, self.Rs, np.asarray(pix).tobytes())
+        if key not in self.geometries:
+            theta = hp.rotator.angdist(hp.pix2ang(self.N_side, pix), (np.pi/2, 0))
+            l = np.concatenate((np.flip(np.exp(np.linspace(np.log(self.halo_dist + 1), 0, 1000))) - 1, np.exp(np.linspace(np.log(self.halo_dist), np.log(self.halo_dist + 2*self.Rs), 1000))[1:]))
+            dl = l[1:] - l[:-1]
+            r = np.sqrt(l[None,:-1]**2 + self.halo_dist**2 - 2*l[None,:-1]*self.halo_dist*np.cos(theta)[:,None])
+            r.setflags(write = False)
+            dl.setflags(write = False)
+            self.geometries[key] = (r, dl)
+        return self.geometries[key]
+
     def J_factor(self, pix, mass_func_params):
-        theta = hp.rotator.angdist(hp.pix2ang(self.N_side, pix), (np.pi/2, 0))
-        l = np.concatenate((np.flip(np.exp(np.linspace(np.log(self.halo_dist + 1), 0, 1000))) - 1, np.exp(np.linspace(np.log(self.halo_dist), np.log(self.halo_dist + 2*self.Rs), 1000))[1:]))
-        dl = l[1:] - l[:-1]
-        r = np.sqrt(l**2 + self.halo_dist**2 - 2*np.tile(l, (np.size(theta), 1))*self.halo_dist*np.cos(np.tile(theta, (np.size(l),1)).T))
-        J = np.sum(self.mass_func(r[:,:-1], *mass_func_params)**2*np.tile(dl, (np.size(theta), 1)), axis = 1)
+        r, dl = self.get_los_geometry(pix)
+        J = self.mass_func(r, *mass_func_params)**2 @ dl
         
         return J
 
-    def get_map(self, DM_mass, cross_sec, dNdE, mass_func_params):
+    def get_map(self, DM_mass, cross_sec, dNdE, mass_func_params, emulate = False):
+        # emulate = True interpolates J from the emulator built by build_J_emulator instead of integrating it
         pix = self.get_pixels()
-        J = self.J_factor(pix, mass_func_params)
-        flux = cross_sec/(8*np.pi*DM_mass**2)*np.tile(dNdE, (np.size(pix), 1))*(np.tile(J, (np.size(dNdE), 1)).T)
+        if emulate:
+            J = self.J_factor_emulated(pix, mass_func_params)
+        else:
+            J = self.J_factor(pix, mass_func_params)
+        flux = cross_sec/(8*np.pi*DM_mass**2)*J[:,None]*np.asarray(dNdE)[None,:]
 
         return flux, pix
     
+    '''
+    J-factor emulator
+    '''
+    def build_J_emulator(self, r_s_grid, gamma_grid, emulator_file = None, method = 'cubic', validate = True):
+        '''
+        Tabulates the gNFW J-factor of every ROI pixel with rho_s = 1 over a grid in (r_s, gamma). Since J scales as rho_s**2,
+        J for any (r_s, rho_s, gamma) inside the grid is rho_s**2 times the interpolation of log J in (log r_s, gamma).
+        If validate, J is also integrated at every grid cell center and the largest relative interpolation error is stored
+        in J_emulator['max_rel_error'] as the error bound of the emulator.
+        With emulator_file, a table built for the same geometry and grids is loaded instead of recomputed, and a new table is saved there
+        '''
+        if self.mass_func != self.gNFW:
+            raise Exception('The J-factor emulator is only implemented for the gNFW profile')
+        r_s_grid = np.asarray(r_s_grid, dtype = float)
+        gamma_grid = np.asarray(gamma_grid, dtype = float)
+        pix = self.get_pixels()
+        setup = np.array([self.N_side, self.theta_cutoff, self.halo_dist, self.Rs])
+
+        table = None
+        if emulator_file is not None and os.path.exists(emulator_file):
+            stored = np.load(emulator_file)
+            if np.array_equal(stored['setup'], setup) and np.array_equal(stored['r_s_grid'], r_s_grid) and np.array_equal(stored['gamma_grid'], gamma_grid):
+                table, max_rel_error = stored['log_J'], float(stored['max_rel_error'])
+            else:
+                print('!!!!WARNING!!!!\n ' + emulator_file + ' was built for a different geometry or grid, rebuilding it\n!!!!WARNING!!!!')
+        if table is None:
+            table = np.log(np.array([[self.J_factor(pix, (r_s, 1., gamma)) for gamma in gamma_grid] for r_s in r_s_grid]))
+            max_rel_error = np.nan
+
+        interpolator = interpolate.RegularGridInterpolator((np.log(r_s_grid), gamma_grid), table, method = method)
+        if validate and np.isnan(max_rel_error):
+            r_s_mid = np.sqrt(r_s_grid[1:]*r_s_grid[:-1])
+            gamma_mid = 0.5*(gamma_grid[1:] + gamma_grid[:-1])
+            max_rel_error = 0.
+            for r_s in r_s_mid:
+                for gamma in gamma_mid:
+                    J = self.J_factor(pix, (r_s, 1., gamma))
+                    J_interp = np.exp(interpolator([np.log(r_s), gamma])[0])
+                    max_rel_error = max(max_rel_error, np.max(np.abs(J_interp/J - 1)))
+
+        if emulator_file is not None:
+            tmp_file = emulator_file + f'.{os.getpid()}.tmp.npz'
+            np.savez(tmp_file, setup = setup, r_s_grid = r_s_grid, gamma_grid = gamma_grid, log_J = table, max_rel_error = max_rel_error)
+            os.replace(tmp_file, emulator_file)
+
+        self.J_emulator = {'pix': pix,
+                           'r_s_range': (r_s_grid[0], r_s_grid[-1]),
+                           'gamma_range': (gamma_grid[0], gamma_grid[-1]),
+                           'interpolator': interpolator,
+                           'max_rel_error': max_rel_error}
+        return self.J_emulator
+
+    def J_factor_emulated(self, pix, mass_func_params):
+        # J from the emulator; pix must be the ROI pixels the emulator was built for
+        if self.J_emulator is None:
+            raise Exception('No J-factor emulator, call build_J_emulator first')
+        if not np.array_equal(pix, self.J_emulator['pix']):
+            raise Exception('The J-factor emulator was built for a different set of pixels')
+        r_s, rho_s, gamma = mass_func_params
+        if not (self.J_emulator['r_s_range'][0] <= r_s <= self.J_emulator['r_s_range'][1] and self.J_emulator['gamma_range'][0] <= gamma <= self.J_emulator['gamma_range'][1]):
+            raise Exception(f'(r_s, gamma) = ({r_s}, {gamma}) is outside the J-factor emulator grid')
+        log_J = self.J_emulator['interpolator']([np.log(r_s), gamma])[0]
+        return rho_s**2*np.exp(log_J)
+
     '''
     Spacial distribution functions
     '''
@@ -0,0 +1,54 @@
+import os
+import sys
+
+import healpy as hp
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import aegis
+
+FERMI_DIR = os.path.join(os.path.dirname(__file__), '..', 'FERMI_files')
+OBS_INFO = {'psf_fits_path': os.path.join(FERMI_DIR, 'psf_P8R3_ULTRACLEANVETO_V2_PSF.fits'),
+            'edisp_fits_path': os.path.join(FERMI_DIR, 'edisp_P8R3_ULTRACLEANVETO_V2_PSF.fits'),
+            'event_type': 'PSF3', 'exposure_map': None}
+N_SIDE = 16
+N_EBINS = 4
+N_SIMS = 30
+
+def isotropic_spectrum(energy, params):
+    return params[0]*1e-10*(energy/1000.)**-2.3
+
+MAP_N_SIDE = 32
+MAP_I = hp.query_disc(MAP_N_SIDE, hp.ang2vec(np.pi/2, 0), np.radians(35))
+MAP_E = np.geomspace(500, 200000, 30)
+MAP_VALS = np.outer(1e-10*(MAP_E/1000.)**-2.4, 1 + 3*np.cos(hp.pix2ang(MAP_N_SIDE, MAP_I)[1]))
+
+def map_source(params):
+    return params[0]*MAP_VALS, MAP_E, MAP_I, MAP_N_SIDE
+
+@pytest.mark.parametrize('source, source_class', [(isotropic_spectrum, 'isotropic_diffuse'), (map_source, 'healpix_map')])
+def test_expected_map_boundary_pixels_match_simulations(source, source_class):
+    '''
+    The expected counts of the ROI pixels crossing the mask boundary (and of the whole ROI) agree with the mean of
+    simulated get_roi_map_summary(mock_observe(...)) maps, with a generation region larger than the mask
+    '''
+    my_aegis = aegis.aegis([[source]], [source_class], [[], []], [1000, 100000], [1e33, 1e36], 20, 1e4,
+                           angular_cut = np.radians(20), lat_cut = np.radians(2), energy_range_gen = [500, 200000],
+                           angular_cut_gen = np.radians(25), lat_cut_gen = np.radians(1))
+    params = [1.0]
+    roi_pix_i = my_aegis.get_roi_pix_indices(N_SIDE)
+    boundary = my_aegis.get_region_coverage(N_SIDE, my_aegis.angular_cut_mask, my_aegis.lat_cut_mask)[roi_pix_i] < 1
+    expected = my_aegis.expected_map(params, OBS_INFO, N_SIDE, N_EBINS, Ebinspace = 'log', roi_pix_i = roi_pix_i, grains = 300, as_tensor = False)
+
+    np.random.seed(0)
+    boundary_counts, total_counts = [], []
+    for _ in range(N_SIMS):
+        source_info = my_aegis.create_sources(params, grains = 300)
+        photon_info = my_aegis.generate_photons_from_sources(params, source_info, grains = 300)
+        roi_map = my_aegis.get_roi_map_summary(my_aegis.mock_observe(photon_info, OBS_INFO), N_SIDE, N_EBINS, Ebinspace = 'log', roi_pix_i = roi_pix_i, as_tensor = False)
+        boundary_counts.append(np.sum(roi_map[boundary]))
+        total_counts.append(np.sum(roi_map))
+
+    for counts, mean in [(boundary_counts, np.sum(expected[boundary])), (total_counts, np.sum(expected))]:
+        assert abs(np.mean(counts) - mean) < 4*np.std(counts)/np.sqrt(N_SIMS)
@@ -0,0 +1,51 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import aegis
+
+FERMI_DIR = os.path.join(os.path.dirname(__file__), '..', 'FERMI_files')
+OBS_INFO = {'psf_fits_path': os.path.join(FERMI_DIR, 'psf_P8R3_ULTRACLEANVETO_V2_PSF.fits'),
+            'edisp_fits_path': os.path.join(FERMI_DIR, 'edisp_P8R3_ULTRACLEANVETO_V2_PSF.fits'),
+            'event_type': 'PSF3', 'exposure_map': None}
+
+def RL(r, l, params):
+    return params[0]*np.exp(-r/2)*(l/1e34)**-1.8/1e34
+
+def spectrum(energy, params = None):
+    return energy**-2.2
+
+def make_aegis(instrument):
+    return aegis.aegis([[RL, spectrum]], ['isotropic_faint_single_spectrum'], [[], []], [1000, 100000], [1e33, 1e36], 20, 1e4,
+                       angular_cut = np.radians(20), lat_cut = np.radians(2), energy_range_gen = [500, 200000],
+                       instrument = instrument, instrument_final_stage = 'get_roi_map_summary')
+
+def test_stage_counts_follow_sources_and_photons():
+    '''
+    The n_in/n_out of every stage of a known run: sources for the draw stages (multi-photon plus single-photon, starting
+    from no sources), photons for the photon stages and for the ROI map summary
+    '''
+    params = [1.0]
+    np.random.seed(0)
+    _, luminosities, single_p_radii = make_aegis(False).draw_luminosities_and_radii(params, RL, grains = 300, epsilon = 0.1, roi_restricted = True, flux_truncated = True)
+    N_drawn = luminosities.size + single_p_radii.size
+    assert single_p_radii.size > 0
+
+    my_aegis = make_aegis(True)
+    np.random.seed(0)
+    source_info = my_aegis.create_sources(params, grains = 300, epsilon = 0.1)
+    photon_info = my_aegis.generate_photons_from_sources(params, source_info, grains = 300)
+    obs_photon_info = my_aegis.mock_observe(photon_info, OBS_INFO)
+    roi_map = my_aegis.get_roi_map_summary(obs_photon_info, 16, 4, as_tensor = False)
+    stages = {stage['stage']: stage for stage in my_aegis.get_simulation_record()['stages'] if stage['depth'] <= 1}
+
+    N_sources = source_info['luminosities'].size + source_info['single_p_distances'].size
+    N_photons = photon_info['energies'].size
+    N_observed = obs_photon_info['energies'].size
+    assert (stages['draw_luminosities_and_radii']['n_in'], stages['draw_luminosities_and_radii']['n_out']) == (0, N_drawn)
+    assert (stages['create_sources']['n_in'], stages['create_sources']['n_out']) == (0, N_sources)
+    assert (stages['generate_photons_from_sources']['n_in'], stages['generate_photons_from_sources']['n_out']) == (N_sources, N_photons)
+    assert (stages['mock_observe']['n_in'], stages['mock_observe']['n_out']) == (N_photons, N_observed)
+    assert (stages['get_roi_map_summary']['n_in'], stages['get_roi_map_summary']['n_out']) == (N_observed, int(np.sum(roi_map)))
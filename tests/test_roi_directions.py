@@ -0,0 +1,48 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import aegis
+
+N_DIRECTIONS = 200000
+
+def RL(r, l, params):
+    return params[0]*np.exp(-r/2)*(l/1e34)**-1.8/1e34
+
+def spectrum(energy, params = None):
+    return energy**-2.2
+
+def earth_view(my_aegis, radius, angles):
+    # Cosine of the angle to the Galactic center, |sin(b)| and acceptance of galactocentric directions seen from Earth
+    x = my_aegis.GC_to_earth + radius*np.sin(angles[:,0])*np.cos(angles[:,1])
+    y = radius*np.sin(angles[:,0])*np.sin(angles[:,1])
+    z = radius*np.cos(angles[:,0])
+    distances = np.sqrt(x**2 + y**2 + z**2)
+    cos_gc, sin_b = x/distances, np.abs(z/distances)
+    return cos_gc, sin_b, (cos_gc >= np.cos(my_aegis.angular_cut_gen)) & (sin_b >= np.sin(my_aegis.lat_cut_gen))
+
+@pytest.mark.parametrize('angular_cut, lat_cut', [(20, 5), (100, 10), (60, 10)])
+@pytest.mark.parametrize('radius', [2., 7.9, 15.])
+def test_roi_directions_exclude_latitude_strip(angular_cut, lat_cut, radius):
+    '''
+    With a nonzero latitude cut, get_roi_fraction matches the accepted share of isotropic directions, and
+    draw_directions_in_roi only draws accepted directions, distributed as the accepted isotropic ones
+    '''
+    my_aegis = aegis.aegis([[RL, spectrum]], ['isotropic_faint_single_spectrum'], [[], []], [1000, 100000], [1e33, 1e36], 20, 1e4,
+                           angular_cut = np.radians(angular_cut), lat_cut = np.radians(lat_cut), energy_range_gen = [500, 200000])
+    np.random.seed(0)
+    directions = np.random.normal(size = (N_DIRECTIONS, 3))
+    directions /= np.linalg.norm(directions, axis = 1)[:,None]
+    isotropic = np.stack((np.arccos(directions[:,2]), np.arctan2(directions[:,1], directions[:,0]) % (2*np.pi)), axis = 1)
+    cos_gc, sin_b, accepted = earth_view(my_aegis, radius, isotropic)
+
+    fraction = float(my_aegis.get_roi_fraction(radius))
+    assert abs(fraction - np.mean(accepted)) < 4*np.sqrt(fraction*(1 - fraction)/N_DIRECTIONS) + 1e-4
+
+    drawn_cos_gc, drawn_sin_b, drawn_accepted = earth_view(my_aegis, radius, my_aegis.draw_directions_in_roi(np.full(N_DIRECTIONS, radius)))
+    assert np.mean(drawn_accepted) > 0.998
+    for values, drawn in [(cos_gc[accepted], drawn_cos_gc[drawn_accepted]), (sin_b[accepted], drawn_sin_b[drawn_accepted])]:
+        assert abs(np.mean(values) - np.mean(drawn)) < 4*np.std(values)*np.sqrt(1/values.size + 1/drawn.size)